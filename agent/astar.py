@@ -1,65 +1,29 @@
-import heapq
 import matplotlib.pyplot as plt
 import torch
-import json
+import numpy as np
 import random
-from torch.utils.data import Dataset
 from value_network import ValueNetwork
-from value_network import CubeDataset
 from environment import RubiksCubeEnv
-import time
+from cube_simulator import generate_actions, get_pruning_table
+from heuristic_cache import HeuristicCache
+from profiler import NULL_PROFILER, Profiler, summarize_records, write_records
+from solvers import BidirectionalSolver, WeightedAStarSolver, make_heuristic
 from tqdm import tqdm
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def one_hot_encode(cube_state):
-  # Convert the cube state to the input format expected by the model
-  state_oh = []
-
-  # Iterate over each face's colors
-  for face in cube_state:
-    for pair in face:
-      for color in pair:
-        # Create a one-hot encoded vector for this color
-        color_oh = [0] * 6
-        color_oh[color] = 1
-        state_oh.extend(color_oh)
-
-  return torch.tensor(state_oh, dtype=torch.float)
-
-
-def heuristic(cube_state, model):
-  """ Estimate the cost to solve the cube from the given state using the given model """
-  # state_oh = one_hot_encode(cube_state)
-  # Add batch dimension and move to device
-  state_oh = cube_state.unsqueeze(0).to(device)
-
-  with torch.no_grad():
-    cost_estimate = model(state_oh).item()  # Get the heuristic value
-  return cost_estimate
-
-
-def reconstruct_path(came_from, current_state):
-  """ Reconstruct the path from the start state to the current state using the came_from dictionary"""
-  total_path = [current_state]
-  while current_state in came_from:
-    current_state, action = came_from[current_state]
-    # Prepend action because we are tracing back the path
-    total_path.insert(0, action)
-  return total_path
-
-
-def generate_all_possible_actions(cube_size):
-  """ Generate all possible actions for the given cube size """
-  actions = []
-  for side in [0, 1]:
-    for layer in range(cube_size):
-      for angle in [0, 1]:
-        action = (side, layer, angle)
-        actions.append(action)
-
-  return actions
+def load_model(network_path, cube_size):
+  """ Load the heuristic network, either an inference export (.pt, see export_network.py) or a ValueNetwork
+  state dict (.pth) """
+  if network_path.endswith('.pt'):
+    model = torch.jit.load(network_path, map_location=device)
+  else:
+    # 144 for 2x2x2, 324 for 3x3x3, 576 for 4x4x4
+    model = ValueNetwork(6 * 6 * cube_size * cube_size).to(device)
+    model.load_state_dict(torch.load(network_path, map_location=device))
+  model.eval()
+  return model
 
 
 def reverse_move(action):
@@ -67,100 +31,63 @@ def reverse_move(action):
   return (action[0], action[1], 1 - action[2])
 
 
-def astar_search(model, env, initial_scramble=2, max_explored_states=200, lambda_weight=1):
+def astar_search(model, env, initial_scramble=2, max_explored_states=200, lambda_weight=1, batch_size=1,
+                 heuristic_cache=None, heuristic_fn=None, profiler=NULL_PROFILER, frontier=None):
   """ Perform an A* search to solve the cube from the given state using the given model
   lambda_weight is a parameter that can be used to adjust the weight of the heuristic in the f score
   to control the tradeoff between the heuristic and the cost to reach the current state.
+  batch_size is the number of nodes with the lowest f score expanded per iteration (batch weighted A*),
+  the children of all of them are scored with a single forward pass of the model.
+  heuristic_cache is an optional HeuristicCache for this model, shared between searches.
+  heuristic_fn(states) -> list of floats replaces the model when given, e.g. the exact 2x2x2
+  pattern_database.PatternDatabaseHeuristic.
+  profiler times the encoding, inference and search phases, see profiler.py, give env the same profiler to
+  include its I/O.
+  frontier is an optional backward frontier (a BackwardFrontier or its path, see backward_frontier.py), the
+  search then stops as soon as it reaches a state of it.
+  See solvers.py for the other search strategies and their statistics.
   """
   env.reset(0)
-  initial_actions = []
 
-  # Scramble the cube with random actions
+  # Scramble the cube with random actions, skipping those that undo or repeat the last ones
+  all_actions = generate_actions(env.cube_size)
+  pruning_table = get_pruning_table(env.cube_size)
+  second_last, last = -1, -1
   for _ in range(initial_scramble):
-    action = random.choice(generate_all_possible_actions(env.cube_size))
-    env.step(action)
-    initial_actions.append(action)
-
-  initial_state = env.get_state()
-  initial_state_encoded = one_hot_encode(initial_state)
-  initial_path = []
-
-  # Initialize the open and closed sets
-  open_set = set([tuple(initial_state_encoded.tolist())])
-  closed_set = set()
-
-  # Initialize the g and f scores for each state
-  g_score = {tuple(initial_state_encoded.tolist()): 0}
-  f_score = {tuple(initial_state_encoded.tolist()): heuristic(
-    initial_state_encoded, model) * lambda_weight}
-  came_from = {tuple(initial_state_encoded.tolist()): initial_path}
-
-  explored_states_count = 0
-
-  while open_set and explored_states_count < max_explored_states:
-    explored_states_count += 1
-    current_encoded = min(open_set, key=lambda o: f_score[o])
-    current_path = came_from[current_encoded]
-
-    # Reset to the initial state and reapply the actions to get to the current state
-    env.reset(0)
-    for action in initial_actions + current_path:
-      env.step(action)
-
-    # Check if the current state is the goal state
-    if env.is_solved(env.get_state()):
-      return current_path
-
-    open_set.remove(current_encoded)
-    closed_set.add(current_encoded)
-
-    # Generate all possible actions and apply them to the current state
-    for action in generate_all_possible_actions(env.cube_size):
-      env.step(action)
-      new_state = env.get_state()
-      new_state_encoded = one_hot_encode(new_state)
-      new_path = current_path + [action]
-
-      if tuple(new_state_encoded.tolist()) in closed_set:
-        env.step(reverse_move(action))  # Reverse the action to undo it
-        continue
-
-      tentative_g_score = g_score[current_encoded] + 1
-      tentative_f_score = tentative_g_score + \
-          heuristic(new_state_encoded, model) * lambda_weight
-
-      # If the new state is not in the open set or the new path has a lower f score, update the open set and scores
-      if tuple(new_state_encoded.tolist()) not in open_set or tentative_f_score < f_score.get(tuple(new_state_encoded.tolist()), float('inf')):
-        open_set.add(tuple(new_state_encoded.tolist()))
-        came_from[tuple(new_state_encoded.tolist())] = new_path
-        g_score[tuple(new_state_encoded.tolist())] = tentative_g_score
-        f_score[tuple(new_state_encoded.tolist())] = tentative_f_score
-
-      env.step(reverse_move(action))  # Reverse the action to undo it
-
-  print("Reached maximum number of explored states without finding a solution.")
-  return None
+    action_index = random.choice(np.flatnonzero(pruning_table[second_last, last]).tolist())
+    env.step(all_actions[action_index])
+    second_last, last = last, action_index
+
+  # The environment is only needed for the scrambled start state, the search itself runs on the move tables
+  heuristic_fn = make_heuristic(model, heuristic_fn, heuristic_cache, profiler)
+  if frontier is None:
+    solver = WeightedAStarSolver(heuristic_fn, env.cube_size, max_explored_states, lambda_weight, batch_size,
+                                 profiler=profiler)
+  else:
+    solver = BidirectionalSolver(heuristic_fn, env.cube_size, frontier, max_explored_states, lambda_weight,
+                                 batch_size, profiler=profiler)
+  actions, _ = solver.solve(env.get_state())
+  if actions is None:
+    print("Reached maximum number of explored states without finding a solution.")
+  return actions
 
 
-def test_astar(model_paths, cube_sizes, costs_to_go, env_setup):
-  """ Test the A* search algorithm with the given model paths, cube sizes, and costs_to_go"""
+def test_astar(model_paths, cube_sizes, costs_to_go, env_setup, heuristic_cache_size=0, profile_path=None,
+               trace_path=None):
+  """ Test the A* search algorithm with the given model paths, cube sizes, and costs_to_go
+  With heuristic_cache_size > 0 all searches over one cube size share a HeuristicCache of that many entries.
+  profile_path writes a per-solve profiler record as JSON lines, trace_path a Chrome trace of all solves."""
   solve_rates = {size: [] for size in cube_sizes}
   move_counts = {size: [] for size in cube_sizes}
+  profiling = profile_path is not None or trace_path is not None
+  profiler = Profiler(trace=trace_path is not None) if profiling else NULL_PROFILER
+  records = []
 
   for size in cube_sizes:
     network_path = model_paths[size]
-    if size == 2:
-      model = ValueNetwork(144).to(device)
-      # costs_to_go = range(0, 12)
-    elif size == 3:
-      model = ValueNetwork(324).to(device)
-      # costs_to_go = range(0, 15)
-    elif size == 4:
-      model = ValueNetwork(576).to(device)
-      # costs_to_go = range(0, 15)
-    model.load_state_dict(torch.load(network_path, map_location=device))
-    model.eval()
-    env = RubiksCubeEnv(**env_setup, cube_size=size)
+    model = load_model(network_path, size)
+    env = RubiksCubeEnv(**env_setup, cube_size=size, profiler=profiler)
+    heuristic_cache = HeuristicCache(heuristic_cache_size) if heuristic_cache_size > 0 else None
 
     for cost_to_go in costs_to_go:
       print(f"Testing {size}x{size}x{size} cube with cost_to_go {cost_to_go}")
@@ -169,7 +96,11 @@ def test_astar(model_paths, cube_sizes, costs_to_go, env_setup):
       test_cases = 10
 
       for _ in tqdm(range(test_cases)):
-        actions = astar_search(model, env, cost_to_go)
+        profiler.reset()
+        actions = astar_search(model, env, cost_to_go, heuristic_cache=heuristic_cache, profiler=profiler)
+        if profiling:
+          records.append(profiler.take_record(cube_size=size, cost_to_go=cost_to_go, solved=actions is not None,
+                                              solution_length=len(actions) if actions is not None else None))
 
         if actions is not None:
           solve_count += 1
@@ -181,6 +112,19 @@ def test_astar(model_paths, cube_sizes, costs_to_go, env_setup):
       solve_rates[size].append(solve_rate)
       move_counts[size].append(avg_moves)
 
+    if heuristic_cache is not None:
+      stats = heuristic_cache.stats()
+      print(f"Heuristic cache: {stats['entries']} entries, hit rate {stats['hit_rate']:.2%}, "
+            f"{stats['memory_bytes'] / 2**20:.1f} MiB")
+
+  if records:
+    for phase, row in summarize_records(records).items():
+      print(f"{phase:12s} {row['seconds']:8.3f}s {row['share']:6.1%}")
+  if profile_path is not None:
+    write_records(profile_path, records)
+  if trace_path is not None:
+    profiler.write_chrome_trace(trace_path)
+
   return solve_rates, move_counts
 
 
@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import socket
+import struct
+import time
+
+import numpy as np
+
+from environment import (LENGTH_PREFIX, OP_APPLY_MOVES, OP_GET_STATE, OP_INITIALIZE, OP_IS_SOLVED, OP_NEIGHBOURS,
+                         OP_RESET, OP_STEP, STATUS_OK, decode_neighbours, decode_state, decode_step, parse_range)
+
+# Errors after which a connection is closed and has to be reopened
+_CONNECTION_ERRORS = (OSError, EOFError, asyncio.TimeoutError)
+
+
+class AsyncRubiksCubeEnv:
+  """ asyncio client of one cube server, the Godot ServerNode or simulator_server.py, over the binary
+  protocol (see RubiksCubeEnv)
+
+  Methods mirror RubiksCubeEnv and return the same values. Concurrent calls on one connection are
+  serialized by a lock, steps(actions) pipelines a sequence in one round trip. A request that fails with a
+  connection error or times out closes the connection and raises ConnectionError, server errors raise
+  RuntimeError and keep it open. connect() opens it again with a freshly initialized, solved cube.
+  """
+  def __init__(self, server_address, server_port, cube_size=3, animation_enabled=False, headless=True,
+               timeout=10.0):
+    self.server_address = server_address
+    self.server_port = server_port
+    self.cube_size = cube_size
+    self.animation_enabled = animation_enabled
+    self.headless = headless
+    self.timeout = timeout
+
+    self.reader = None
+    self.writer = None
+    self.lock = asyncio.Lock()
+    # How often the connection was opened, more than once means the cube was reset by a reconnect
+    self.connects = 0
+
+  @property
+  def connected(self):
+    return self.writer is not None
+
+  async def connect(self):
+    """ (Re)open the connection, switch it to the binary protocol and initialize the cube """
+    async with self.lock:
+      self._close()
+      reader, writer = await asyncio.wait_for(asyncio.open_connection(self.server_address, self.server_port),
+                                              self.timeout)
+      try:
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.write(b"protocol:binary")
+        await writer.drain()
+        if await asyncio.wait_for(self._read_json(reader), self.timeout) != {'status': 'binary'}:
+          raise ConnectionError(f"{self.server_address}:{self.server_port} does not support the binary protocol")
+        self.reader, self.writer = reader, writer
+        response, = await self._exchange([bytes([OP_INITIALIZE, self.cube_size, int(self.animation_enabled),
+                                                 int(self.headless)])])
+        if response[0] != STATUS_OK:
+          raise RuntimeError(f"Server error: {response[1:].decode()}")
+      except BaseException:
+        writer.close()
+        self.reader = self.writer = None
+        raise
+      self.connects += 1
+
+  async def close(self):
+    async with self.lock:
+      self._close()
+
+  async def reset(self, no_moves):
+    """ Reset the environment and receive the initial state """
+    return decode_state(await self._request(struct.pack('<BH', OP_RESET, no_moves)), self.cube_size)
+
+  async def step(self, action):
+    """ Send the action to the server and receive the next state, reward and done flag """
+    return decode_step(await self._request(bytes([OP_STEP, *action])), self.cube_size)
+
+  async def steps(self, actions):
+    """ Apply a sequence of actions in one round trip, returns the [state, reward, done] after each """
+    payloads = await self._requests([bytes([OP_STEP, *action]) for action in actions])
+    return [decode_step(payload, self.cube_size) for payload in payloads]
+
+  async def apply_moves(self, actions):
+    """ Apply a sequence of actions and return only the final [state, reward, done] """
+    payload = bytes(value for action in actions for value in action)
+    response = await self._request(struct.pack('<BH', OP_APPLY_MOVES, len(actions)) + payload)
+    return decode_step(response, self.cube_size)
+
+  async def generate_neighbours(self):
+    """ Generate neighbouring states by applying every possible move """
+    return decode_neighbours(await self._request(bytes([OP_NEIGHBOURS])), self.cube_size)
+
+  async def get_state(self):
+    """ Get state of the environment """
+    return decode_state(await self._request(bytes([OP_GET_STATE])), self.cube_size)
+
+  async def is_solved(self, state):
+    """ Check if the cube is in a solved state """
+    return (await self._request(bytes([OP_IS_SOLVED]) + np.asarray(state, dtype=np.uint8).tobytes()))[0]
+
+  async def ping(self):
+    """ Health check, a cheap request that fails when the connection or the server is broken """
+    await self._request(bytes([OP_GET_STATE]))
+
+  async def _request(self, payload):
+    return (await self._requests([payload]))[0]
+
+  async def _requests(self, payloads):
+    """ Send all requests before reading the responses, returns their payloads without the status byte """
+    async with self.lock:
+      if self.writer is None:
+        raise ConnectionError(f"Not connected to {self.server_address}:{self.server_port}")
+      responses = await self._exchange(payloads)
+    for response in responses:
+      if response[0] != STATUS_OK:
+        raise RuntimeError(f"Server error: {response[1:].decode()}")
+    return [response[1:] for response in responses]
+
+  async def _exchange(self, payloads):
+    """ Write the request frames and read one response frame per request, with the lock held """
+    try:
+      self.writer.write(b''.join(LENGTH_PREFIX.pack(len(payload)) + payload for payload in payloads))
+      await self.writer.drain()
+      return [await asyncio.wait_for(self._read_frame(), self.timeout) for _ in payloads]
+    except _CONNECTION_ERRORS as error:
+      self._close()
+      raise ConnectionError(f"Connection to {self.server_address}:{self.server_port} lost: {error!r}") from error
+
+  async def _read_frame(self):
+    length, = LENGTH_PREFIX.unpack(await self.reader.readexactly(LENGTH_PREFIX.size))
+    return await self.reader.readexactly(length)
+
+  async def _read_json(self, reader):
+    """ Read a single JSON value, the text protocol has no framing """
+    decoder = json.JSONDecoder()
+    buffer = b''
+    while True:
+      data = await reader.read(65536)
+      if not data:
+        raise ConnectionError("Server closed the connection")
+      buffer += data
+      try:
+        return decoder.raw_decode(buffer.decode().lstrip())[0]
+      except json.JSONDecodeError:
+        pass
+
+  def _close(self):
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = self.writer = None
+
+
+class AsyncCubeEnvPool:
+  """ One AsyncRubiksCubeEnv per server port, driven concurrently from a single event loop
+
+  Environment i is the server on ports[i]. The *_many methods run one request per environment at the same
+  time, e.g. `await pool.step_many(actions)` applies actions[i] to environment i. acquire() instead lends
+  one connected environment for exclusive use, for workers that each run their own episodes.
+
+  A health check pings idle connections every health_check_interval seconds and reopens broken ones,
+  backing off exponentially up to max_backoff seconds between attempts. A reopened environment starts
+  from the solved cube, env.connects counts the (re)connections. Note that the Godot server quits when its
+  client disconnects, reconnecting to it needs a supervisor that restarts it.
+  """
+  def __init__(self, server_address, ports, cube_size=3, animation_enabled=False, headless=True, timeout=10.0,
+               health_check_interval=5.0, max_backoff=30.0):
+    self.envs = [AsyncRubiksCubeEnv(server_address, port, cube_size, animation_enabled, headless, timeout)
+                 for port in ports]
+    self.cube_size = cube_size
+    self.health_check_interval = health_check_interval
+    self.max_backoff = max_backoff
+
+    self._busy = set()
+    self._available = None
+    self._health_check = None
+    # Per environment: seconds to wait before the next reconnect attempt, and when it is due
+    self._backoff = {}
+    self._retry_at = {}
+
+  async def start(self, require_all=False):
+    """ Connect every environment and start the health check. Environments that fail to connect are
+    retried by the health check, unless require_all. Raises ConnectionError if none connected. """
+    self._available = asyncio.Condition()
+    results = await asyncio.gather(*(env.connect() for env in self.envs), return_exceptions=True)
+    failures = [(env, result) for env, result in zip(self.envs, results) if isinstance(result, BaseException)]
+    if failures and (require_all or len(failures) == len(self.envs)):
+      await self.close()
+      env, error = failures[0]
+      raise ConnectionError(f"{len(failures)} of {len(self.envs)} environments failed to connect, "
+                            f"port {env.server_port}: {error!r}")
+    for env, _ in failures:
+      self._schedule_retry(env)
+    self._health_check = asyncio.create_task(self._health_check_loop())
+    return self
+
+  async def close(self):
+    if self._health_check is not None:
+      self._health_check.cancel()
+      with contextlib.suppress(asyncio.CancelledError):
+        await self._health_check
+      self._health_check = None
+    await asyncio.gather(*(env.close() for env in self.envs))
+
+  async def __aenter__(self):
+    return await self.start()
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
+
+  def __len__(self):
+    return len(self.envs)
+
+  def connected(self):
+    """ Indices of the connected environments """
+    return [i for i, env in enumerate(self.envs) if env.connected]
+
+  @contextlib.asynccontextmanager
+  async def acquire(self):
+    """ Wait for a connected environment nobody else acquired and lend it """
+    async with self._available:
+      env = await self._available.wait_for(self._idle_env)
+      self._busy.add(env)
+    try:
+      yield env
+    finally:
+      async with self._available:
+        self._busy.discard(env)
+        self._available.notify_all()
+
+  async def reset_many(self, no_moves, envs=None, return_exceptions=False):
+    """ Reset environments (all by default) with no_moves scramble moves each, returns their states """
+    envs = self._select(envs)
+    return await asyncio.gather(*(env.reset(no_moves) for env in envs), return_exceptions=return_exceptions)
+
+  async def step_many(self, actions, envs=None, return_exceptions=False):
+    """ Apply actions[i] to environment envs[i] (i by default), returns their [state, reward, done] """
+    envs = self._select(envs, len(actions))
+    return await asyncio.gather(*(env.step(action) for env, action in zip(envs, actions)),
+                                return_exceptions=return_exceptions)
+
+  async def apply_moves_many(self, action_sequences, envs=None, return_exceptions=False):
+    """ Apply action_sequences[i] to environment envs[i] (i by default), returns the final
+    [state, reward, done] of each """
+    envs = self._select(envs, len(action_sequences))
+    return await asyncio.gather(*(env.apply_moves(actions) for env, actions in zip(envs, action_sequences)),
+                                return_exceptions=return_exceptions)
+
+  async def get_states(self, envs=None, return_exceptions=False):
+    envs = self._select(envs)
+    return await asyncio.gather(*(env.get_state() for env in envs), return_exceptions=return_exceptions)
+
+  def stats(self):
+    return {'envs': len(self.envs), 'connected': len(self.connected()),
+            'reconnects': sum(max(env.connects - 1, 0) for env in self.envs)}
+
+  def _select(self, envs, count=None):
+    if envs is None:
+      envs = range(len(self.envs) if count is None else count)
+    return [self.envs[i] for i in envs]
+
+  def _idle_env(self):
+    for env in self.envs:
+      if env.connected and env not in self._busy:
+        return env
+    return None
+
+  def _schedule_retry(self, env):
+    backoff = self._backoff.get(env, self.health_check_interval / 2)
+    self._retry_at[env] = time.monotonic() + backoff
+    self._backoff[env] = min(backoff * 2, self.max_backoff)
+
+  async def _health_check_loop(self):
+    while True:
+      await asyncio.sleep(self.health_check_interval)
+      await asyncio.gather(*(self._check(env) for env in self.envs))
+
+  async def _check(self, env):
+    """ Ping an idle connection, reopen a broken one once its backoff passed """
+    if env.connected:
+      if env.lock.locked():
+        # Busy with a request, which has its own timeout
+        return
+      try:
+        await env.ping()
+        return
+      except (ConnectionError, RuntimeError):
+        await env.close()
+        self._schedule_retry(env)
+    if time.monotonic() < self._retry_at.get(env, 0):
+      return
+    try:
+      await env.connect()
+    except (*_CONNECTION_ERRORS, RuntimeError):
+      self._schedule_retry(env)
+      return
+    self._backoff.pop(env, None)
+    async with self._available:
+      self._available.notify_all()
+
+
+async def _main(args):
+  servers = []
+  if args.stand_in:
+    from simulator_server import start_servers
+    servers = await start_servers(args.host, args.ports, seed=0)
+
+  rng = np.random.default_rng(0)
+  async with AsyncCubeEnvPool(args.host, args.ports, args.cube_size) as pool:
+    await pool.reset_many(0)
+    actions = [(int(rng.integers(2)), int(rng.integers(args.cube_size)), int(rng.integers(2)))
+               for _ in range(args.steps)]
+
+    # The same number of steps on every environment, one environment after another
+    start = time.perf_counter()
+    for env in pool.envs:
+      for action in actions:
+        await env.step(action)
+    sequential = time.perf_counter() - start
+
+    # All environments at once, one step_many per step
+    start = time.perf_counter()
+    for action in actions:
+      await pool.step_many([action] * len(pool))
+    concurrent = time.perf_counter() - start
+
+    num_steps = args.steps * len(pool)
+    print(f"{len(pool)} environments, {args.steps} steps each: sequential {num_steps / sequential:,.0f} steps/s, "
+          f"step_many {num_steps / concurrent:,.0f} steps/s ({pool.stats()})")
+
+  for server in servers:
+    server.close()
+
+
+if __name__ == "__main__":
+  """ Drive the environments on a port range concurrently and compare with stepping them one by one:
+  python async_environment.py --ports 4242-4249 --steps 1000
+  --stand-in starts simulator_server.py stand-ins on those ports in the same process """
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--ports', type=parse_range, default=parse_range('4242'))
+  parser.add_argument('--cube-size', type=int, default=3)
+  parser.add_argument('--steps', type=int, default=1000)
+  parser.add_argument('--stand-in', action='store_true', help='serve the ports with simulator stand-ins')
+  asyncio.run(_main(parser.parse_args()))
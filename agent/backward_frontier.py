@@ -0,0 +1,208 @@
+import argparse
+import os
+import struct
+import time
+
+import numpy as np
+
+from cube_simulator import generate_actions, get_move_tables, get_rotation_tables, get_solved_state, pack_states
+from dataset_format import _replace_atomically
+
+# Every state within a fixed number of moves of a solved cube, for meet-in-the-middle search.
+#
+# The states are stored in an open addressing hash table with linear probing, keyed by the packed state
+# (cube_simulator.pack_states) and holding the distance to solved and the move that leads one step closer.
+# Frontier file layout:
+#   header  - magic, format version, cube size, depth, key width, table capacity and state count
+#   keys    - capacity x key width uint8 packed states
+#   depths  - capacity uint8 distances to solved, EMPTY for free slots
+#   moves   - capacity uint8 action indices taking a state one move closer to solved
+MAGIC = b'RCBF'
+VERSION = 1
+HEADER_FORMAT = '<4sHBBB3xQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+EMPTY = 255
+# The table is kept at most half full
+MAX_LOAD = 0.5
+
+_HASH_SEED = np.uint64(0xcbf29ce484222325)
+_HASH_MULTIPLIER = np.uint64(0x9e3779b97f4a7c15)
+
+
+def _hash(keys):
+  """ 64 bit hashes of a (N, key width) uint8 array of packed states """
+  keys = np.ascontiguousarray(keys, dtype=np.uint8)
+  padding = -keys.shape[1] % 8
+  if padding:
+    keys = np.pad(keys, ((0, 0), (0, padding)))
+  hashes = np.full(len(keys), _HASH_SEED, dtype=np.uint64)
+  for word in keys.view('<u8').T:
+    hashes = (hashes ^ word) * _HASH_MULTIPLIER
+    hashes ^= hashes >> np.uint64(32)
+  return hashes
+
+
+class BackwardFrontier:
+  """ States within depth moves of a solved cube, see build_backward_frontier
+
+  keys, depths and moves are the hash table arrays, usually memory-mapped by load_backward_frontier.
+  """
+  def __init__(self, cube_size, depth, keys, depths, moves, num_states):
+    self.cube_size = cube_size
+    self.depth = depth
+    self.keys = keys
+    self.depths = depths
+    self.moves = moves
+    self.num_states = num_states
+    self.mask = len(depths) - 1
+
+    self.move_tables = get_move_tables(cube_size)
+    self.actions = generate_actions(cube_size)
+
+  def __len__(self):
+    return self.num_states
+
+  def lookup(self, keys):
+    """ Table slot of every packed state of a (N, key width) array, -1 for the states not in the frontier """
+    keys = np.asarray(keys, dtype=np.uint8)
+    slots = (_hash(keys) & np.uint64(self.mask)).astype(np.intp)
+    found = np.full(len(keys), -1, dtype=np.intp)
+    # Probe every query in step until it reaches its key or a free slot
+    pending = np.arange(len(keys))
+    while len(pending):
+      pending_slots = slots[pending]
+      free = self.depths[pending_slots] == EMPTY
+      match = ~free & (self.keys[pending_slots] == keys[pending]).all(axis=1)
+      found[pending[match]] = pending_slots[match]
+      pending = pending[~(free | match)]
+      slots[pending] = (slots[pending] + 1) & self.mask
+    return found
+
+  def distances(self, keys):
+    """ Distance to solved of every packed state, -1 for the states not in the frontier """
+    slots = self.lookup(keys)
+    distances = np.full(len(slots), -1, dtype=np.int64)
+    distances[slots >= 0] = self.depths[slots[slots >= 0]]
+    return distances
+
+  def solution(self, state):
+    """ Actions that solve a state of the frontier, following the stored moves """
+    state = np.asarray(state, dtype=np.uint8).reshape(-1)
+    actions = []
+    while True:
+      slot = self.lookup(pack_states(state[np.newaxis]))[0]
+      if slot < 0:
+        raise ValueError("The state is not in the backward frontier")
+      if self.depths[slot] == 0:
+        return actions
+      move = int(self.moves[slot])
+      actions.append(self.actions[move])
+      state = state[self.move_tables[move]]
+
+
+def build_backward_frontier(cube_size, depth, log=True):
+  """ Breadth-first search backwards from the solved cube in all of its 24 orientations
+
+  A state one layer further out is reached with the inverse of an action, astar.reverse_move, which is
+  action index a ^ 1. Applying the action itself leads back, so it is stored as the state's move.
+  """
+  tables = get_move_tables(cube_size)
+  num_actions = len(tables)
+  inverse_tables = tables[np.arange(num_actions) ^ 1]
+
+  layer = get_solved_state(cube_size)[get_rotation_tables(cube_size)]
+  key_width = pack_states(layer[:1]).shape[1]
+  key_type = np.dtype((np.void, key_width))
+
+  layer_keys = pack_states(layer).view(key_type).ravel()
+  previous_keys = np.empty(0, dtype=key_type)
+  keys, depths, moves = [layer_keys], [np.zeros(len(layer), dtype=np.uint8)], [np.zeros(len(layer), dtype=np.uint8)]
+  for current_depth in range(1, depth + 1):
+    children = layer[:, inverse_tables].reshape(-1, layer.shape[1])
+    children_keys, first = np.unique(pack_states(children).view(key_type).ravel(), return_index=True)
+    # Moves are invertible, so a child is either one layer further out or in the previous or current layer
+    new = ~(np.isin(children_keys, layer_keys) | np.isin(children_keys, previous_keys))
+    previous_keys, layer_keys = layer_keys, children_keys[new]
+    layer = children[first[new]]
+    keys.append(layer_keys)
+    depths.append(np.full(len(layer), current_depth, dtype=np.uint8))
+    moves.append((first[new] % num_actions).astype(np.uint8))
+    if log:
+      print(f"Depth {current_depth}: {len(layer):,} states")
+
+  keys = np.concatenate(keys).view(np.uint8).reshape(-1, key_width)
+  depths = np.concatenate(depths)
+  moves = np.concatenate(moves)
+
+  # Insert all states into the hash table at once, one state per free slot and round
+  capacity = 1 << max(int(np.ceil(np.log2(len(keys) / MAX_LOAD))), 4)
+  table_keys = np.zeros((capacity, key_width), dtype=np.uint8)
+  table_depths = np.full(capacity, EMPTY, dtype=np.uint8)
+  table_moves = np.zeros(capacity, dtype=np.uint8)
+  slots = (_hash(keys) & np.uint64(capacity - 1)).astype(np.intp)
+  pending = np.arange(len(keys))
+  while len(pending):
+    pending_slots = slots[pending]
+    free = table_depths[pending_slots] == EMPTY
+    free_slots, first = np.unique(pending_slots[free], return_index=True)
+    inserted = pending[free][first]
+    table_keys[free_slots] = keys[inserted]
+    table_depths[free_slots] = depths[inserted]
+    table_moves[free_slots] = moves[inserted]
+
+    placed = np.zeros(len(keys), dtype=bool)
+    placed[inserted] = True
+    pending = pending[~placed[pending]]
+    slots[pending] = (slots[pending] + 1) & (capacity - 1)
+
+  return BackwardFrontier(cube_size, depth, table_keys, table_depths, table_moves, len(keys))
+
+
+def save_backward_frontier(path, frontier):
+  """ Store the hash table in the frontier file format, which load_backward_frontier memory-maps """
+  def write(f):
+    f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, frontier.cube_size, frontier.depth,
+                        frontier.keys.shape[1], len(frontier.depths), frontier.num_states))
+    f.write(np.ascontiguousarray(frontier.keys).tobytes())
+    f.write(np.ascontiguousarray(frontier.depths).tobytes())
+    f.write(np.ascontiguousarray(frontier.moves).tobytes())
+  _replace_atomically(path, write)
+
+
+def load_backward_frontier(path):
+  """ Memory-map a frontier written by save_backward_frontier """
+  with open(path, 'rb') as f:
+    magic, version, cube_size, depth, key_width, capacity, num_states = struct.unpack(HEADER_FORMAT,
+                                                                                      f.read(HEADER_SIZE))
+  if magic != MAGIC:
+    raise ValueError(f"{path} is not a backward frontier")
+  if version != VERSION:
+    raise ValueError(f"{path} has unsupported frontier version {version}")
+
+  keys = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=(capacity, key_width))
+  depths = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE + keys.size, shape=(capacity,))
+  moves = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE + keys.size + capacity, shape=(capacity,))
+  return BackwardFrontier(cube_size, depth, keys, depths, moves, num_states)
+
+
+if __name__ == "__main__":
+  """ Precompute the backward frontier of a cube size once:
+  python backward_frontier.py 3 --depth 5
+  then pass it to solvers.BidirectionalSolver or astar_search(..., frontier=...) """
+  parser = argparse.ArgumentParser()
+  parser.add_argument('cube_size', type=int)
+  parser.add_argument('--depth', type=int, default=None,
+                      help='moves from solved, by default 8 for 2x2x2, 5 for 3x3x3 and 4 for larger cubes')
+  parser.add_argument('--path', default=None, help='by default ./data/backward_frontier_{n}x{n}x{n}.bin')
+  args = parser.parse_args()
+
+  n = args.cube_size
+  depth = args.depth if args.depth is not None else {2: 8, 3: 5}.get(n, 4)
+  path = args.path or f'./data/backward_frontier_{n}x{n}x{n}.bin'
+
+  start = time.perf_counter()
+  frontier = build_backward_frontier(n, depth)
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  save_backward_frontier(path, frontier)
+  print(f"{len(frontier):,} states within {depth} moves, {os.path.getsize(path) / 2**20:.1f} MiB written to "
+        f"{path} in {time.perf_counter() - start:.1f}s")
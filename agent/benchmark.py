@@ -0,0 +1,286 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+import torch
+
+from cube_simulator import apply_move, generate_actions, get_pruning_table, get_solved_state
+from encoding import encode_states
+from environment import parse_range
+from inference_server import InferenceError, InferenceServer, format_metrics
+from solvers import SOLVERS, WeightedAStarSolver, make_heuristic
+
+RESULT_FIELDS = ['id', 'cube_size', 'depth', 'solved', 'solution_length', 'wall_time', 'nodes_expanded',
+                 'nodes_per_second', 'peak_nodes']
+
+# Per-process state of the pool workers, set by _init_worker
+_worker_models = None
+_worker_solver = None
+_worker_inference = None
+
+
+def make_scramble_suite(cube_sizes, depths, cases_per_depth, seed=0):
+  """ Seeded scramble cases, each {'id', 'cube_size', 'depth', 'actions', 'state'}
+
+  Moves that undo or repeat the last ones are redrawn, see cube_simulator.get_pruning_table. Every case has
+  its own RNG seeded from (seed, cube size, depth, case), so adding cube sizes or depths leaves the other
+  cases unchanged.
+  """
+  cases = []
+  for cube_size in cube_sizes:
+    actions = generate_actions(cube_size)
+    pruning_table = get_pruning_table(cube_size)
+    for depth in depths:
+      for case in range(cases_per_depth):
+        rng = np.random.default_rng([seed, cube_size, depth, case])
+        state = get_solved_state(cube_size)
+        scramble = []
+        while len(scramble) < depth:
+          action_index = int(rng.integers(len(actions)))
+          second_last, last = ([-1, -1] + scramble)[-2:]
+          if not pruning_table[second_last, last, action_index]:
+            continue
+          scramble.append(action_index)
+          state = apply_move(state, action_index, cube_size)
+        cases.append({'id': len(cases), 'cube_size': cube_size, 'depth': depth,
+                      'actions': [list(actions[action_index]) for action_index in scramble],
+                      'state': state.tolist()})
+  return cases
+
+
+def save_scramble_suite(path, cases):
+  with open(path, 'w') as f:
+    json.dump({'cases': cases}, f)
+
+
+def load_scramble_suite(path):
+  with open(path, 'r') as f:
+    return json.load(f)['cases']
+
+
+def _load_models(model_paths):
+  """ Load the model of every cube size and run one forward pass each, so one-time initialization does not
+  count towards the first case's wall time """
+  from astar import load_model, device
+
+  models = {cube_size: load_model(path, cube_size) for cube_size, path in model_paths.items()}
+  for cube_size, model in models.items():
+    with torch.no_grad():
+      model(encode_states(get_solved_state(cube_size)[np.newaxis], device))
+  return models
+
+
+class _RemoteHeuristic:
+  """ heuristic_fn of a pool worker that has the shared InferenceServer process evaluate its states """
+  def __init__(self, worker_id, cube_size, requests, responses):
+    self.worker_id = worker_id
+    self.cube_size = cube_size
+    self.requests = requests
+    self.responses = responses
+
+  def __call__(self, states):
+    self.requests.put((self.worker_id, self.cube_size, np.ascontiguousarray(states, dtype=np.uint8),
+                       time.perf_counter()))
+    values = self.responses.get()
+    if isinstance(values, InferenceError):
+      raise values
+    return values
+
+
+def _inference_worker(model_paths, requests, responses, ready, metrics, max_batch_size, max_wait_us):
+  """ Serve the heuristic requests of all pool workers with an InferenceServer. Sets ready once the models
+  are loaded and puts the server metrics on the metrics queue when stopped. """
+  from astar import device
+
+  server = InferenceServer(_load_models(model_paths), max_batch_size, max_wait_us, device, requests, responses)
+  ready.set()
+  server.serve_forever()
+  metrics.put(server.metrics())
+
+
+def _init_worker(model_paths, solver_name, solver_kwargs, worker_ids, requests, responses):
+  """ Give a pool worker its own models, or a connection to the shared inference process """
+  global _worker_models, _worker_solver, _worker_inference
+  # Processes share the machine, one thread each avoids oversubscribing the cores
+  torch.set_num_threads(1)
+  _worker_solver = (solver_name, solver_kwargs)
+  if requests is None:
+    _worker_models = _load_models(model_paths)
+  else:
+    worker_id = worker_ids.get()
+    _worker_inference = (worker_id, requests, responses[worker_id])
+
+
+def _solve_case(case):
+  """ Solve one scramble case in a pool worker and return its result record """
+  solver_name, solver_kwargs = _worker_solver
+  cube_size = case['cube_size']
+  if _worker_inference is None:
+    heuristic_fn = make_heuristic(_worker_models[cube_size])
+  else:
+    worker_id, requests, responses = _worker_inference
+    heuristic_fn = _RemoteHeuristic(worker_id, cube_size, requests, responses)
+
+  if 'frontier' in solver_kwargs:
+    solver_kwargs = dict(solver_kwargs, frontier=solver_kwargs['frontier'].format(n=cube_size))
+  solver = SOLVERS[solver_name](heuristic_fn, cube_size, **solver_kwargs)
+  start = time.perf_counter()
+  actions, stats = solver.solve(case['state'])
+  return {'id': case['id'], 'cube_size': cube_size, 'depth': case['depth'], 'solved': actions is not None,
+          'solution_length': stats['solution_length'], 'wall_time': time.perf_counter() - start,
+          'nodes_expanded': stats['nodes_expanded'], 'nodes_per_second': stats['nodes_per_second'],
+          'peak_nodes': stats['peak_nodes']}
+
+
+def run_benchmark(cases, model_paths, solver_name='astar', solver_kwargs=None, num_workers=None,
+                  shared_inference=False, max_batch_size=4096, max_wait_us=1000):
+  """ Solve every case in a pool of worker processes, returns the result records in case order and the
+  inference server metrics (None without shared_inference)
+
+  Every worker holds its own simulator tables and solver. By default every worker also holds its own
+  models. With shared_inference a single extra process holds the models and batches the heuristic calls
+  of all concurrent searches, see InferenceServer for max_batch_size and max_wait_us.
+  """
+  solver_kwargs = solver_kwargs or {}
+  num_workers = num_workers or multiprocessing.cpu_count()
+  model_paths = {cube_size: model_paths[cube_size] for cube_size in {case['cube_size'] for case in cases}}
+
+  worker_ids = requests = responses = inference = None
+  if shared_inference:
+    worker_ids = multiprocessing.Queue()
+    for worker_id in range(num_workers):
+      worker_ids.put(worker_id)
+    requests = multiprocessing.Queue()
+    responses = [multiprocessing.Queue() for _ in range(num_workers)]
+    ready = multiprocessing.Event()
+    metrics = multiprocessing.Queue()
+    inference = multiprocessing.Process(target=_inference_worker,
+                                        args=(model_paths, requests, responses, ready, metrics, max_batch_size,
+                                              max_wait_us),
+                                        daemon=True)
+    inference.start()
+    while not ready.wait(timeout=1.0):
+      if not inference.is_alive():
+        raise RuntimeError(f"The inference process exited with code {inference.exitcode} before its models "
+                           f"were loaded")
+
+  results = []
+  inference_metrics = None
+  try:
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(model_paths, solver_name, solver_kwargs, worker_ids, requests,
+                                        responses)) as pool:
+      for result in pool.imap_unordered(_solve_case, cases):
+        results.append(result)
+        print(f"Solved {len(results)}/{len(cases)} cases", end='\r')
+    print()
+  finally:
+    if inference is not None:
+      requests.put(None)
+      while inference_metrics is None:
+        try:
+          inference_metrics = metrics.get(timeout=1.0)
+        except queue.Empty:
+          if not inference.is_alive() and metrics.empty():
+            raise RuntimeError(f"The inference process exited with code {inference.exitcode}")
+      inference.join()
+  return sorted(results, key=lambda result: result['id']), inference_metrics
+
+
+def summarize(results):
+  """ Solve rate, average moves, wall time and nodes/sec per (cube size, depth) """
+  summary = {}
+  for key in sorted({(result['cube_size'], result['depth']) for result in results}):
+    group = [result for result in results if (result['cube_size'], result['depth']) == key]
+    solved = [result for result in group if result['solved']]
+    summary[key] = {
+      'solve_rate': len(solved) / len(group),
+      'average_moves': float(np.mean([result['solution_length'] for result in solved])) if solved else 0.0,
+      'wall_time': float(np.mean([result['wall_time'] for result in group])),
+      'nodes_per_second': float(np.mean([result['nodes_per_second'] for result in group])),
+    }
+  return summary
+
+
+def write_results(path, results, metadata=None):
+  """ Write the result records as CSV when the path ends in .csv, as JSON with the metadata otherwise """
+  with open(path, 'w', newline='') as f:
+    if path.endswith('.csv'):
+      writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+      writer.writeheader()
+      writer.writerows(results)
+    else:
+      json.dump({'metadata': metadata or {}, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+  """ Create a scramble suite, then benchmark a set of networks on it:
+  python benchmark.py suite data/suite.json --cube-sizes 2 3 4 --depths 0-14
+  python benchmark.py run data/suite.json results.json --workers 8 """
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  suite = subparsers.add_parser('suite', help='write a seeded scramble suite')
+  suite.add_argument('suite_path')
+  suite.add_argument('--cube-sizes', type=int, nargs='+', default=[2, 3, 4])
+  suite.add_argument('--depths', type=parse_range, default=parse_range('0-14'))
+  suite.add_argument('--cases-per-depth', type=int, default=10)
+  suite.add_argument('--seed', type=int, default=0)
+
+  run = subparsers.add_parser('run', help='solve every case of a suite')
+  run.add_argument('suite_path')
+  run.add_argument('results_path', help='.json or .csv')
+  run.add_argument('--network-pattern', default='./networks/best_value_network_{n}x{n}x{n}.pth')
+  run.add_argument('--solver', choices=sorted(SOLVERS), default='astar')
+  run.add_argument('--max-explored-states', type=int, default=200)
+  run.add_argument('--batch-size', type=int, default=None, help='nodes expanded per A* iteration')
+  run.add_argument('--no-move-pruning', action='store_true', help='expand every action of every node')
+  run.add_argument('--frontier-pattern', default='./data/backward_frontier_{n}x{n}x{n}.bin',
+                   help='backward frontier files of the bidirectional solver')
+  run.add_argument('--workers', type=int, default=None)
+  run.add_argument('--shared-inference', action='store_true',
+                   help='batch heuristic calls of all workers in one inference process')
+  run.add_argument('--max-batch-size', type=int, default=4096, help='states per shared inference batch')
+  run.add_argument('--max-wait-us', type=int, default=1000,
+                   help='how long the shared inference waits for a batch to fill up')
+
+  args = parser.parse_args()
+
+  if args.command == 'suite':
+    cases = make_scramble_suite(args.cube_sizes, args.depths, args.cases_per_depth, args.seed)
+    save_scramble_suite(args.suite_path, cases)
+    print(f"Wrote {len(cases)} cases to {args.suite_path}")
+  else:
+    cases = load_scramble_suite(args.suite_path)
+    model_paths = {cube_size: args.network_pattern.format(n=cube_size)
+                   for cube_size in {case['cube_size'] for case in cases}}
+    solver_kwargs = {'max_explored_states': args.max_explored_states}
+    if args.batch_size is not None:
+      # Only the A* based solvers expand nodes in batches
+      if not issubclass(SOLVERS[args.solver], WeightedAStarSolver):
+        parser.error(f"--batch-size does not apply to the {args.solver} solver")
+      solver_kwargs['batch_size'] = args.batch_size
+    if args.no_move_pruning:
+      solver_kwargs['prune_moves'] = False
+    if args.solver == 'bidirectional':
+      solver_kwargs['frontier'] = args.frontier_pattern
+
+    start = time.perf_counter()
+    results, inference_metrics = run_benchmark(cases, model_paths, args.solver, solver_kwargs, args.workers,
+                                               args.shared_inference, args.max_batch_size, args.max_wait_us)
+    elapsed = time.perf_counter() - start
+
+    write_results(args.results_path, results, {'suite': args.suite_path, 'model_paths': model_paths,
+                                               'solver': args.solver, 'solver_kwargs': solver_kwargs,
+                                               'shared_inference': args.shared_inference,
+                                               'inference_metrics': inference_metrics, 'wall_time': elapsed})
+    for (cube_size, depth), row in summarize(results).items():
+      print(f"{cube_size}x{cube_size}x{cube_size} depth {depth:2d}: solve rate {row['solve_rate']:.0%}, "
+            f"{row['average_moves']:.1f} moves, {row['wall_time']:.3f}s, {row['nodes_per_second']:,.0f} nodes/s")
+    if inference_metrics is not None:
+      print(f"Shared inference: {format_metrics(inference_metrics)}")
+    print(f"{len(results)} cases in {elapsed:.1f}s, results written to {args.results_path}")
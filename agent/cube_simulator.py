@@ -0,0 +1,431 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Face order and colors follow Cube.gd (CubeSide / FaceColor enums)
+TOP, BOTTOM, LEFT, RIGHT, FRONT, BACK = range(6)
+NUM_FACES = 6
+
+
+def generate_actions(cube_size):
+  """ Generate all (side, layer, angle) actions, the row order of the move tables """
+  return [(side, layer, angle)
+          for side in [0, 1]
+          for layer in range(cube_size)
+          for angle in [0, 1]]
+
+
+def action_to_index(action, cube_size):
+  """ Map a (side, layer, angle) action to its row in the move tables """
+  side, layer, angle = action
+  return (side * cube_size + layer) * 2 + angle
+
+
+def _sticker_positions(cube_size):
+  """ Positions of every sticker in get_cube_state order, in doubled integer coordinates
+
+  Mirrors Cube.get_initial_faces_and_positions: TOP/BOTTOM rows are indexed by x and columns by z,
+  LEFT/RIGHT rows by y and columns by z, FRONT/BACK rows by y and columns by x.
+  Pieces sit at 2 * index - (cube_size - 1) and stickers one unit further along the face normal.
+  """
+  n = cube_size
+  far = n  # (cube_size - 1) + 1
+  coords = 2 * np.arange(n) - (n - 1)
+  rows, cols = np.meshgrid(coords, coords, indexing='ij')
+  rows, cols = rows.ravel(), cols.ravel()
+  fixed = np.full(n * n, far)
+
+  positions = np.empty((NUM_FACES, n * n, 3), dtype=np.int64)
+  positions[TOP] = np.stack([rows, fixed, cols], axis=1)
+  positions[BOTTOM] = np.stack([rows, -fixed, cols], axis=1)
+  positions[LEFT] = np.stack([-fixed, rows, cols], axis=1)
+  positions[RIGHT] = np.stack([fixed, rows, cols], axis=1)
+  positions[FRONT] = np.stack([cols, rows, -fixed], axis=1)
+  positions[BACK] = np.stack([cols, rows, fixed], axis=1)
+  return positions.reshape(-1, 3)
+
+
+def _sticker_normals(cube_size):
+  """ Outward unit normal of every sticker in get_cube_state order """
+  normals = np.array([[0, 1, 0], [0, -1, 0], [-1, 0, 0],
+                      [1, 0, 0], [0, 0, -1], [0, 0, 1]], dtype=np.int64)
+  return np.repeat(normals, cube_size * cube_size, axis=0)
+
+
+def _rotate(positions, side, angle):
+  """ Rotate positions the way Cube.rotate_pieces does (angle 0 is +90 degrees, 1 is -90 degrees) """
+  x, y, z = positions[:, 0], positions[:, 1], positions[:, 2]
+  if side == 0:  # Y axis (TOP)
+    return np.stack([z, y, -x], axis=1) if angle == 0 else np.stack([-z, y, x], axis=1)
+  # X axis (LEFT)
+  return np.stack([x, -z, y], axis=1) if angle == 0 else np.stack([x, z, -y], axis=1)
+
+
+@lru_cache(maxsize=None)
+def get_move_tables(cube_size):
+  """ Precompute sticker permutation tables of shape (4 * cube_size, 6 * cube_size ** 2)
+
+  Applying action `a` to a flat state is the gather `state[tables[a]]`.
+  """
+  n = cube_size
+  positions = _sticker_positions(n)
+  centers = positions - _sticker_normals(n)
+  index_of = {tuple(p): i for i, p in enumerate(positions.tolist())}
+
+  actions = generate_actions(n)
+  tables = np.empty((len(actions), len(positions)), dtype=np.intp)
+  for a, (side, layer, angle) in enumerate(actions):
+    if side == 0:
+      # TOP layer 0 is the top-most slice (y index cube_size - 1 - layer)
+      moving = centers[:, 1] == (n - 1) - 2 * layer
+    else:
+      # LEFT layer 0 is the left-most slice (x index layer)
+      moving = centers[:, 0] == 2 * layer - (n - 1)
+
+    perm = np.arange(len(positions))
+    sources = np.flatnonzero(moving)
+    destinations = [index_of[tuple(p)] for p in _rotate(positions[sources], side, angle).tolist()]
+    perm[destinations] = sources
+    tables[a] = perm
+
+  tables.setflags(write=False)
+  return tables
+
+
+@lru_cache(maxsize=None)
+def get_pruning_table(cube_size):
+  """ Actions worth trying after the last two, as a (4 * n + 1, 4 * n + 1, 4 * n) bool array indexed by
+  [second to last action, last action, action], index -1 standing for no move yet
+
+  A move is pruned when the moves before it already reach the same state with fewer moves, or with as many
+  in a canonical order, so every state keeps one of its shortest move sequences:
+    - it undoes the last move (a ^ 1),
+    - it turns a lower layer of the same side as the last move, layers of a side commute so a run of them
+      is only tried in increasing layer order,
+    - it repeats the last move with angle 1, two such turns equal two angle 0 turns of the layer,
+    - it repeats the last two moves, three quarter turns equal one turn the other way.
+  Turning every layer of a side turns the whole cube but is not pruned: only TOP and LEFT layers turn, so
+  a whole-cube turn changes which layers the following moves reach and skipping it loses states.
+  """
+  actions = generate_actions(cube_size)
+  num_actions = len(actions)
+  table = np.ones((num_actions + 1, num_actions + 1, num_actions), dtype=bool)
+  for last, (side, layer, angle) in enumerate(actions):
+    for action, (new_side, new_layer, _) in enumerate(actions):
+      if action == last ^ 1 or (new_side == side and new_layer < layer) or (action == last and angle == 1):
+        table[:, last, action] = False
+    table[last, last, last] = False
+
+  table.setflags(write=False)
+  return table
+
+
+def pruned_branching_factor(cube_size, depth=100):
+  """ Growth rate of the move sequences get_pruning_table allows, the moves per step a search expands
+  instead of 4 * cube_size, from the number of sequences of length depth and depth - 1 """
+  table = get_pruning_table(cube_size).astype(np.float64)
+  # Sequences per (second to last, last) action, normalized every step to stay finite
+  counts = np.zeros(table.shape[:2])
+  counts[-1, -1] = 1
+  growth = 0.0
+  for _ in range(depth):
+    extended = np.zeros_like(counts)
+    extended[:, :-1] = np.einsum('ij,ijk->jk', counts, table)
+    growth = extended.sum() / counts.sum()
+    counts = extended / extended.sum()
+  return growth
+
+
+@lru_cache(maxsize=None)
+def get_solved_state(cube_size):
+  """ Flat solved state, every sticker colored with its face index """
+  state = np.repeat(np.arange(NUM_FACES, dtype=np.uint8), cube_size * cube_size)
+  state.setflags(write=False)
+  return state
+
+
+def apply_move(state, action_index, cube_size):
+  """ Apply a single action (by index) to a flat state and return the new state """
+  return state[get_move_tables(cube_size)[action_index]]
+
+
+def actions_to_indices(actions, cube_size):
+  """ Map a sequence of (side, layer, angle) actions to an array of move table indices """
+  actions = np.asarray(actions, dtype=np.intp).reshape(-1, 3)
+  return (actions[:, 0] * cube_size + actions[:, 1]) * 2 + actions[:, 2]
+
+
+def apply_moves(states, action_indices):
+  """ Apply one action per state in a single vectorized gather
+
+  states is a (N, 6, n, n) uint8 array and action_indices a (N,) array of move table indices.
+  Returns the (N, 6, n, n) successor states.
+  """
+  states = np.asarray(states, dtype=np.uint8)
+  cube_size = states.shape[-1]
+  flat = states.reshape(len(states), -1)
+  perms = get_move_tables(cube_size)[np.asarray(action_indices, dtype=np.intp)]
+  return np.take_along_axis(flat, perms, axis=1).reshape(states.shape)
+
+
+def expand_states(states):
+  """ Apply every action to every state in a single call
+
+  states is a (N, 6, n, n) uint8 array. Returns a (N, 4 * n, 6, n, n) array whose [i, a] entry is
+  states[i] after action index a.
+  """
+  states = np.asarray(states, dtype=np.uint8)
+  cube_size = states.shape[-1]
+  tables = get_move_tables(cube_size)
+  children = states.reshape(len(states), -1)[:, tables]
+  return children.reshape(len(states), len(tables), NUM_FACES, cube_size, cube_size)
+
+
+def random_scrambles(cube_size, scramble_depths, rng):
+  """ Scramble a batch of solved cubes, cube i with scramble_depths[i] random moves
+
+  Every move is drawn from the actions get_pruning_table allows after the two before it, so unlike
+  Cube.scramble_cube no moves are spent undoing or repeating earlier ones. Returns a (N, 6, n, n) array.
+  """
+  depths = np.asarray(scramble_depths, dtype=np.int64)
+  tables = get_move_tables(cube_size)
+  pruning_table = get_pruning_table(cube_size)
+
+  states = np.tile(get_solved_state(cube_size), (len(depths), 1))
+  # Last two action indices of every cube, -1 before its first moves
+  second_last_actions = np.full(len(depths), -1)
+  last_actions = np.full(len(depths), -1)
+  for move in range(depths.max(initial=0)):
+    active = np.flatnonzero(depths > move)
+    allowed = pruning_table[second_last_actions[active], last_actions[active]]
+    # Draw uniformly from the allowed actions of each cube
+    draws = rng.integers(allowed.sum(axis=1))
+    actions = (allowed.cumsum(axis=1) > draws[:, np.newaxis]).argmax(axis=1)
+
+    states[active] = np.take_along_axis(states[active], tables[actions], axis=1)
+    second_last_actions[active] = last_actions[active]
+    last_actions[active] = actions
+  return states.reshape(len(depths), NUM_FACES, cube_size, cube_size)
+
+
+def pack_states(states):
+  """ Pack a batch of sticker arrays into 3 bits per sticker
+
+  states is any (N, ...) uint8 array, returns a (N, ceil(3 * stickers / 8)) uint8 array.
+  """
+  states = np.asarray(states, dtype=np.uint8)
+  states = states.reshape(len(states), -1)
+  bits = (states[:, :, None] >> np.array([2, 1, 0], dtype=np.uint8)) & 1
+  return np.packbits(bits.reshape(len(states), -1), axis=1)
+
+
+def pack_state(state):
+  """ Compact hashable key of a single state (3 bits per sticker) """
+  return pack_states(np.asarray(state, dtype=np.uint8).reshape(1, -1))[0].tobytes()
+
+
+@lru_cache(maxsize=None)
+def get_rotation_tables(cube_size):
+  """ Sticker permutations of the 24 whole-cube rotations, as a (24, 6 * cube_size ** 2) array with the
+  identity first
+
+  Turning every layer of a side rotates the whole cube, so these are generated by the two rotations
+  made of the actions of side 0 and of side 1. A rotated state is the gather `state[tables[r]]`.
+  """
+  tables = get_move_tables(cube_size)
+  generators = []
+  for side in [0, 1]:
+    rotation = np.arange(tables.shape[1])
+    for layer in range(cube_size):
+      rotation = rotation[tables[action_to_index((side, layer, 0), cube_size)]]
+    generators.append(rotation)
+
+  identity = np.arange(tables.shape[1])
+  rotations = {identity.tobytes(): identity}
+  frontier = [identity]
+  while frontier:
+    rotation = frontier.pop()
+    for generator in generators:
+      rotated = rotation[generator]
+      if rotated.tobytes() not in rotations:
+        rotations[rotated.tobytes()] = rotated
+        frontier.append(rotated)
+
+  rotations = np.array(list(rotations.values()))
+  rotations.setflags(write=False)
+  return rotations
+
+
+@lru_cache(maxsize=None)
+def get_solved_keys(cube_size):
+  """ Packed keys of the solved cube in each of its 24 orientations
+
+  The solved states reachable with the action set are all whole-cube orientations of get_solved_state.
+  """
+  solved_state = get_solved_state(cube_size)
+  return frozenset(pack_state(solved_state[rotation]) for rotation in get_rotation_tables(cube_size))
+
+
+@lru_cache(maxsize=None)
+def get_symmetry_tables(cube_size):
+  """ Sticker permutations of the 8 whole-cube rotations that keep the action set unchanged
+
+  Only TOP (Y axis) and LEFT (X axis) layers can be turned, so the symmetries are the rotations that
+  keep the Z axis in place up to direction: they map X and Y layer turns onto X and Y layer turns.
+  Returns a (8, 6 * cube_size ** 2) array, the identity first.
+  """
+  positions = _sticker_positions(cube_size)
+  index_of = {tuple(p): i for i, p in enumerate(positions.tolist())}
+
+  tables = []
+  for axes in [(0, 1, 2), (1, 0, 2)]:
+    for signs in [(1, 1, 1), (-1, -1, 1), (1, -1, -1), (-1, 1, -1),
+                  (1, -1, 1), (-1, 1, 1), (1, 1, -1), (-1, -1, -1)]:
+      rotation = np.zeros((3, 3), dtype=np.int64)
+      rotation[[0, 1, 2], axes] = signs
+      if round(np.linalg.det(rotation)) != 1:
+        continue
+      rotated = positions @ rotation.T
+      table = np.empty(len(positions), dtype=np.intp)
+      table[[index_of[tuple(p)] for p in rotated.tolist()]] = np.arange(len(positions))
+      tables.append(table)
+
+  tables = np.array(tables)
+  tables.setflags(write=False)
+  return tables
+
+
+def canonical_keys(states):
+  """ Packed keys that are equal for states related by a symmetry of get_symmetry_tables and a relabelling
+  of the colors, which leave the distance to a solved state unchanged
+
+  Each of the symmetric variants has its colors renumbered in order of first appearance and the smallest
+  packed variant is the key. states is a (N, ...) uint8 array, returns a list of N bytes objects.
+  """
+  states = np.asarray(states, dtype=np.uint8)
+  states = states.reshape(len(states), -1)
+  cube_size = int(round(np.sqrt(states.shape[1] // NUM_FACES)))
+  variants = states[:, get_symmetry_tables(cube_size)].astype(np.intp)
+
+  # Rank colors by the position of their first sticker
+  first_sticker = (variants[..., None] == np.arange(NUM_FACES)).argmax(axis=2)
+  color_rank = np.argsort(np.argsort(first_sticker, axis=2), axis=2)
+  relabelled = np.take_along_axis(color_rank, variants, axis=2).astype(np.uint8)
+
+  packed = pack_states(relabelled.reshape(-1, states.shape[1])).reshape(len(states), len(variants[0]), -1)
+  return [min(variant.tobytes() for variant in state_variants) for state_variants in packed]
+
+
+def is_solved_state(state, cube_size):
+  """ Check whether every face of the state has a single color """
+  faces = np.asarray(state, dtype=np.uint8).reshape(NUM_FACES, cube_size * cube_size)
+  return bool((faces == faces[:, :1]).all())
+
+
+def solved_mask(states):
+  """ Boolean (N,) mask of the solved states in a (N, ...) batch """
+  faces = np.asarray(states, dtype=np.uint8).reshape(len(states), NUM_FACES, -1)
+  return (faces == faces[:, :, :1]).all(axis=(1, 2))
+
+
+class CubeSimulator:
+  """ In-process drop-in replacement for RubiksCubeEnv backed by NumPy permutation tables """
+  def __init__(self, cube_size=3, seed=None):
+    self.cube_size = cube_size
+
+    # Define observation and action spaces
+    self.observation_space = self._define_observation_space(cube_size)
+    self.action_space = self._define_action_space(cube_size)
+
+    self.move_tables = get_move_tables(cube_size)
+    self.solved_state = get_solved_state(cube_size)
+    self.state = self.solved_state.copy()
+    self.rng = np.random.default_rng(seed)
+
+  def _define_observation_space(self, cube_size):
+    # Each face of the cube can have a value from 0 to 5 (6 colors)
+    return {'low': 0, 'high': 5, 'shape': (6, cube_size, cube_size)}
+
+  def _define_action_space(self, cube_size):
+    # Actions: side (2 options) vertical or horizontal, layer (range(cube_size)), angle (2 options)
+    return {'side': [0, 2], 'layer': range(cube_size), 'angle': range(2)}
+
+  def reset(self, no_moves):
+    """ Reset to the solved state and scramble with no_moves random moves (like Cube.scramble_cube) """
+    self.state = self.solved_state.copy()
+    pruning_table = get_pruning_table(self.cube_size)
+    second_last_action, last_action = -1, -1
+    i = 0
+    while i < no_moves:
+      action = (int(self.rng.integers(2)), int(self.rng.integers(self.cube_size)), int(self.rng.integers(2)))
+      action_index = action_to_index(action, self.cube_size)
+      # Ensure the new move does not undo or repeat the last ones, see get_pruning_table
+      if not pruning_table[second_last_action, last_action, action_index]:
+        continue
+      self.state = self.state[self.move_tables[action_index]]
+      second_last_action, last_action = last_action, action_index
+      i += 1
+    return self.get_state()
+
+  def step(self, action):
+    """ Apply the action and return the next state, reward and done flag """
+    self.state = self.state[self.move_tables[action_to_index(action, self.cube_size)]]
+    done = int(is_solved_state(self.state, self.cube_size))
+    return [self.get_state(), done, done]
+
+  def generate_neighbours(self):
+    """ Generate neighbouring states by applying every possible move """
+    neighbours = self.state[self.move_tables]
+    return {action: neighbour.reshape(6, self.cube_size, self.cube_size).tolist()
+            for action, neighbour in zip(generate_actions(self.cube_size), neighbours)}
+
+  def get_state(self):
+    """ Get state of the environment """
+    return self.state.reshape(6, self.cube_size, self.cube_size).tolist()
+
+  def set_state(self, state):
+    """ Overwrite the current state with a (6, n, n) or flat sticker array """
+    self.state = np.asarray(state, dtype=np.uint8).reshape(-1).copy()
+
+  def is_solved(self, state):
+    """ Check if the cube is in a solved state """
+    return int(is_solved_state(state, self.cube_size))
+
+  def close(self):
+    """ Nothing to release, kept for interface parity with RubiksCubeEnv """
+    pass
+
+
+if __name__ == "__main__":
+  """ Testing """
+  import time
+
+  env = CubeSimulator(cube_size=3, seed=0)
+  print(env.action_space)
+  print(env.observation_space)
+  print(env.reset(0))
+
+  tables = get_move_tables(3)
+  state = get_solved_state(3).copy()
+  actions = np.random.default_rng(0).integers(len(tables), size=1_000_000)
+  start = time.perf_counter()
+  for a in actions:
+    state = state[tables[a]]
+  elapsed = time.perf_counter() - start
+  print(f"{len(actions) / elapsed:,.0f} single moves/sec")
+
+  for cube_size in [2, 3, 4]:
+    tables = get_move_tables(cube_size)
+    states = np.broadcast_to(get_solved_state(cube_size).reshape(6, cube_size, cube_size),
+                             (100_000, 6, cube_size, cube_size))
+    action_indices = np.random.default_rng(0).integers(len(tables), size=len(states))
+    start = time.perf_counter()
+    states = apply_moves(states, action_indices)
+    children = expand_states(states)
+    elapsed = time.perf_counter() - start
+    print(f"{cube_size}x{cube_size}x{cube_size}: {len(states) + children.shape[0] * children.shape[1]:,} "
+          f"batched moves in {elapsed:.3f}s")
+
+  for cube_size in [2, 3, 4, 5]:
+    print(f"{cube_size}x{cube_size}x{cube_size}: branching factor {4 * cube_size} without and "
+          f"{pruned_branching_factor(cube_size):.2f} with move pruning")
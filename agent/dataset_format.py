@@ -0,0 +1,170 @@
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Binary dataset layout:
+#   header  - magic, format version, cube size and sample count (HEADER_SIZE bytes)
+#   states  - num_samples x 6 x cube_size x cube_size uint8 sticker colors
+#   costs   - num_samples uint8 cost-to-go labels
+MAGIC = b'RCUB'
+VERSION = 1
+HEADER_FORMAT = '<4sHBxQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Sharded datasets are a directory of binary datasets plus a JSON manifest
+MANIFEST_NAME = 'manifest.json'
+
+
+def write_header(f, cube_size, num_samples):
+  """ Write the dataset header at the current position of an open binary file """
+  f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, cube_size, num_samples))
+
+
+def read_header(file_path):
+  """ Read the header of a binary dataset """
+  with open(file_path, 'rb') as f:
+    magic, version, cube_size, num_samples = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+  if magic != MAGIC:
+    raise ValueError(f"{file_path} is not a binary cube dataset")
+  if version != VERSION:
+    raise ValueError(f"{file_path} has unsupported dataset version {version}")
+  return {'version': version, 'cube_size': cube_size, 'num_samples': num_samples}
+
+
+def write_dataset(file_path, states, costs_to_go, cube_size):
+  """ Write states (N, 6, n, n) and their costs to go (N,) as a binary dataset """
+  states = np.ascontiguousarray(states, dtype=np.uint8).reshape(-1, 6, cube_size, cube_size)
+  costs_to_go = np.ascontiguousarray(costs_to_go, dtype=np.uint8)
+  if len(states) != len(costs_to_go):
+    raise ValueError("states and costs_to_go must have the same length")
+
+  with open(file_path, 'wb') as f:
+    write_header(f, cube_size, len(states))
+    f.write(states.tobytes())
+    f.write(costs_to_go.tobytes())
+
+
+def open_dataset(file_path):
+  """ Memory-map a binary dataset, returning read-only (states, costs_to_go) arrays """
+  header = read_header(file_path)
+  cube_size, num_samples = header['cube_size'], header['num_samples']
+  states_shape = (num_samples, 6, cube_size, cube_size)
+
+  states = np.memmap(file_path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=states_shape)
+  costs_to_go = np.memmap(file_path, dtype=np.uint8, mode='r',
+                          offset=HEADER_SIZE + states.size, shape=(num_samples,))
+  return states, costs_to_go
+
+
+def read_manifest(directory):
+  """ Read the manifest of a sharded dataset directory """
+  with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+    return json.load(f)
+
+
+def _replace_atomically(file_path, write):
+  """ Write a file through a temporary file so a crash never leaves a half-written one behind """
+  tmp_path = file_path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    write(f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, file_path)
+
+
+class ShardedDatasetWriter:
+  """ Streams samples into fixed-size binary shards and keeps a manifest of the completed ones
+
+  Reopening a directory resumes after its last completed shard, num_samples tells how many samples
+  are already stored. Samples added after the last completed shard are lost on a crash.
+  """
+  def __init__(self, directory, cube_size, shard_size=100_000):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+    if os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+      self.manifest = read_manifest(directory)
+      if self.manifest['cube_size'] != cube_size or self.manifest['shard_size'] != shard_size:
+        raise ValueError(f"{directory} holds a dataset with a different cube size or shard size")
+    else:
+      self.manifest = {'version': VERSION, 'cube_size': cube_size, 'shard_size': shard_size,
+                       'num_samples': 0, 'shards': []}
+
+    self.cube_size = cube_size
+    self.shard_size = shard_size
+    self.states = np.empty((shard_size, 6, cube_size, cube_size), dtype=np.uint8)
+    self.costs_to_go = np.empty(shard_size, dtype=np.uint8)
+    self.buffered = 0
+
+  @property
+  def num_samples(self):
+    """ Number of samples stored in completed shards """
+    return self.manifest['num_samples']
+
+  def add(self, state, cost_to_go):
+    """ Buffer a sample, writing out the shard once it is full """
+    self.states[self.buffered] = state
+    self.costs_to_go[self.buffered] = cost_to_go
+    self.buffered += 1
+    if self.buffered == self.shard_size:
+      self.flush()
+
+  def add_batch(self, states, costs_to_go):
+    """ Buffer a batch of samples, writing out shards as they fill up """
+    start = 0
+    while start < len(states):
+      count = min(self.shard_size - self.buffered, len(states) - start)
+      self.states[self.buffered:self.buffered + count] = states[start:start + count]
+      self.costs_to_go[self.buffered:self.buffered + count] = costs_to_go[start:start + count]
+      self.buffered += count
+      start += count
+      if self.buffered == self.shard_size:
+        self.flush()
+
+  def flush(self):
+    """ Write the buffered samples as a new shard and record it in the manifest """
+    if self.buffered == 0:
+      return
+
+    shard_name = f'shard_{len(self.manifest["shards"]):05d}.bin'
+    states, costs_to_go = self.states[:self.buffered], self.costs_to_go[:self.buffered]
+
+    def write_shard(f):
+      write_header(f, self.cube_size, len(states))
+      f.write(states.tobytes())
+      f.write(costs_to_go.tobytes())
+
+    _replace_atomically(os.path.join(self.directory, shard_name), write_shard)
+
+    self.manifest['shards'].append({'file': shard_name,
+                                    'num_samples': int(self.buffered),
+                                    'depth_histogram': np.bincount(costs_to_go).tolist()})
+    self.manifest['num_samples'] += int(self.buffered)
+    _replace_atomically(os.path.join(self.directory, MANIFEST_NAME),
+                        lambda f: f.write(json.dumps(self.manifest, indent=2).encode()))
+    self.buffered = 0
+
+  def close(self):
+    """ Write out the last, possibly partial, shard """
+    self.flush()
+
+
+def convert_json_dataset(json_path, binary_path):
+  """ Convert a JSON dataset written by generate_data into the binary format """
+  with open(json_path, 'r') as f:
+    data = json.load(f)
+
+  states = np.array([sample['state'] for sample in data], dtype=np.uint8)
+  costs_to_go = np.array([sample['cost_to_go'] for sample in data], dtype=np.uint8)
+  write_dataset(binary_path, states, costs_to_go, states.shape[-1])
+  return len(data)
+
+
+if __name__ == "__main__":
+  """ Convert a JSON dataset: python dataset_format.py data/in.json data/out.bin """
+  json_path, binary_path = sys.argv[1], sys.argv[2]
+  num_samples = convert_json_dataset(json_path, binary_path)
+  print(f"Converted {num_samples} samples from {json_path} to {binary_path}")
@@ -0,0 +1,113 @@
+import copy
+import queue
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from tqdm import tqdm
+
+from cube_simulator import expand_states, random_scrambles, solved_mask
+from encoding import encode_states
+from value_network import ValueNetwork, device, writer
+
+
+def _prefetch(iterator, depth=2):
+  """ Run an iterator in a background thread so producing the next item overlaps consuming the current one """
+  items = queue.Queue(maxsize=depth)
+  done = object()
+
+  def produce():
+    for item in iterator:
+      items.put(item)
+    items.put(done)
+
+  threading.Thread(target=produce, daemon=True).start()
+  while (item := items.get()) is not done:
+    yield item
+
+
+def _expanded_chunks(states, chunk_size):
+  """ Yield (start, encoded children, solved children mask) for chunks of chunk_size parent states """
+  for start in range(0, len(states), chunk_size):
+    children = expand_states(states[start:start + chunk_size])
+    children = children.reshape(children.shape[0] * children.shape[1], -1)
+    yield start, encode_states(children), torch.from_numpy(solved_mask(children))
+
+
+def compute_bellman_targets(target_model, states, chunk_size=1000):
+  """ Bellman targets 1 + min over children of the target network's cost to go, with solved children
+  costing 0 and solved states themselves getting a target of 0. Children of the next chunk are expanded
+  and encoded in a background thread while the current chunk is evaluated. """
+  num_actions = 4 * states.shape[-1]
+  targets = torch.empty(len(states))
+
+  target_model.eval()
+  with torch.no_grad():
+    for start, children_encoded, children_solved in _prefetch(_expanded_chunks(states, chunk_size)):
+      children_costs = target_model(children_encoded.to(device)).squeeze(1).cpu()
+      children_costs[children_solved] = 0
+      # Network estimates are not bounded below, keep targets non-negative
+      children_costs.clamp_(min=0)
+      targets[start:start + len(children_costs) // num_actions] = \
+          1 + children_costs.view(-1, num_actions).min(dim=1).values
+
+  targets[torch.from_numpy(solved_mask(states))] = 0
+  return targets.unsqueeze(1)
+
+
+def train_davi(model, optimizer, criterion, cube_size, iterations=1000, states_per_iteration=100_000,
+               batch_size=10_000, max_scramble_moves=30, update_target_every=10, chunk_size=1000, seed=None,
+               cube_size_name='2x2x2'):
+  """ Train the model with approximate value iteration (DeepCubeA): every iteration scrambles new states,
+  labels them with Bellman targets from a frozen target network and regresses the model onto them.
+  The target network is refreshed from the model every update_target_every iterations. """
+  model.to(device)
+  target_model = copy.deepcopy(model)
+  rng = np.random.default_rng(seed)
+
+  for iteration in tqdm(range(iterations)):
+    depths = rng.integers(1, max_scramble_moves + 1, size=states_per_iteration)
+    states = random_scrambles(cube_size, depths, rng)
+    targets = compute_bellman_targets(target_model, states, chunk_size)
+
+    model.train()
+    total_loss = torch.zeros((), device=device)
+    order = rng.permutation(len(states))
+    num_batches = 0
+    for start in range(0, len(order), batch_size):
+      rows = order[start:start + batch_size]
+      data, target = encode_states(states[rows], device), targets[rows].to(device)
+      optimizer.zero_grad()
+      loss = criterion(model(data), target)
+      loss.backward()
+      optimizer.step()
+      total_loss += loss.detach()
+      num_batches += 1
+
+    average_loss = total_loss.item() / num_batches
+    writer.add_scalar('DAVI Loss', average_loss, iteration)
+    writer.add_scalar('DAVI Mean Target', targets.mean().item(), iteration)
+
+    if (iteration + 1) % update_target_every == 0:
+      target_model.load_state_dict(model.state_dict())
+      torch.save(model.state_dict(), f'networks/davi_value_network_{cube_size_name}.pth')
+      print(f'Iteration {iteration}, average loss {average_loss:.4f}, updated target network')
+
+
+if __name__ == "__main__":
+  cube_size = 2
+  # cube_size = 3
+  # cube_size = 4
+  cube_size_name = f'{cube_size}x{cube_size}x{cube_size}'
+
+  model = ValueNetwork(6 * 6 * cube_size * cube_size).to(device)
+  # Starting from a network trained on scramble lengths speeds up the first iterations
+  # model.load_state_dict(torch.load(f'networks/best_value_network_{cube_size_name}.pth', map_location=device))
+
+  optimizer = optim.Adam(model.parameters(), lr=1e-3)
+  criterion = nn.MSELoss()
+
+  train_davi(model, optimizer, criterion, cube_size, iterations=1000, cube_size_name=cube_size_name)
+  writer.close()
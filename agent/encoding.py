@@ -0,0 +1,32 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+NUM_COLORS = 6
+
+
+def encode_states(states, device=None):
+  """ One-hot encode a batch of cube states into a (batch, stickers * 6) float tensor
+
+  states can be a NumPy array, a (possibly pinned) torch tensor or nested lists of shape
+  (batch, 6, n, n) or (batch, 6 * n * n). When a device is given the compact uint8 stickers are moved
+  there first and expanded on the device.
+  """
+  if not torch.is_tensor(states):
+    states = np.ascontiguousarray(states, dtype=np.uint8)
+    if not states.flags.writeable:
+      # torch.from_numpy warns on read-only arrays such as memory-mapped datasets
+      states = states.copy()
+    states = torch.from_numpy(states)
+  if device is not None:
+    states = states.to(device, non_blocking=True)
+
+  stickers = states.reshape(states.shape[0], -1).long()
+  return F.one_hot(stickers, NUM_COLORS).reshape(stickers.shape[0], -1).float()
+
+
+def one_hot_encode(state, device=None):
+  """ One-hot encode a single cube state into a flat float tensor """
+  if not torch.is_tensor(state):
+    state = np.asarray(state, dtype=np.uint8)
+  return encode_states(state.reshape(1, -1), device)[0]
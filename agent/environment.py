@@ -1,14 +1,63 @@
 import socket
 import json
+import struct
 import threading
 
+import numpy as np
+
+from cube_simulator import generate_actions
+from profiler import NULL_PROFILER
+
+# Binary protocol, see ServerNode.gd: every message is a little-endian u32 payload length followed by the
+# payload. Requests start with an opcode byte, responses with a status byte.
+(OP_INITIALIZE, OP_RESET, OP_STEP, OP_GET_STATE, OP_APPLY_MOVES, OP_NEIGHBOURS, OP_IS_SOLVED,
+ OP_BENCHMARK) = range(1, 9)
+STATUS_OK, STATUS_ERROR = 0, 1
+LENGTH_PREFIX = struct.Struct('<I')
+
+
+def decode_state(payload, cube_size):
+  """ (6, n, n) nested state lists from the sticker bytes of a binary response """
+  return np.frombuffer(payload, dtype=np.uint8).reshape(6, cube_size, cube_size).tolist()
+
+
+def decode_step(payload, cube_size):
+  """ [state, reward, done] from a state followed by the solved flag """
+  done = payload[-1]
+  return [decode_state(payload[:-1], cube_size), done, done]
+
+
+def decode_neighbours(payload, cube_size):
+  """ {action: state} from the states of a NEIGHBOURS response, one per action in move table order """
+  states = np.frombuffer(payload, dtype=np.uint8).reshape(-1, 6, cube_size, cube_size)
+  return {action: state.tolist() for action, state in zip(generate_actions(cube_size), states)}
+
+
+def parse_range(text):
+  """ '4242-4249' or '4242' into a list of ints, for port and depth ranges on the command line """
+  start, _, stop = text.partition('-')
+  return list(range(int(start), int(stop or start) + 1))
+
 
 class RubiksCubeEnv:
-  """ TCP client and an environment wrapper class """
-  def __init__(self, server_address, server_port, cube_size=3, animation_enabled=False):
+  """ TCP client and an environment wrapper class
+
+  protocol is 'binary' (length-prefixed frames with states as sticker bytes, batch commands and
+  pipelining), 'json' (the original text commands) or 'auto' to use the binary protocol when the server
+  supports it and fall back to JSON otherwise.
+
+  headless makes the server keep only a sticker array updated through move tables instead of rotating the
+  scene nodes, the cube is redrawn once a later client initializes with headless off.
+
+  profiler (see profiler.py) times sending and waiting for responses as the env_io phase and counts
+  round_trips, bytes_sent and bytes_received.
+  """
+  def __init__(self, server_address, server_port, cube_size=3, animation_enabled=False, protocol='auto',
+               headless=False, profiler=NULL_PROFILER):
     self.server_address = server_address
     self.server_port = server_port
     self.cube_size = cube_size
+    self.profiler = profiler
 
     # Define observation and action spaces
     self.observation_space = self._define_observation_space(cube_size)
@@ -17,11 +66,27 @@ class RubiksCubeEnv:
     # Initialize server connection
     self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.socket.connect((server_address, server_port))
+    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._buffer = b''
+
+    self.binary = False
+    if protocol != 'json':
+      self._send("protocol:binary")
+      self.binary = self._receive() == {'status': 'binary'}
+      if protocol == 'binary' and not self.binary:
+        raise ConnectionError("The server does not support the binary protocol")
 
     # Ideally this would be run BEFORE the environment is created but we can just reset so w/e
-    command = f"initialize:{cube_size},{int(animation_enabled)}"
-    self._send(command)
-    print(self._receive())
+    if self.binary:
+      self._request(bytes([OP_INITIALIZE, cube_size, int(animation_enabled), int(headless)]))
+    else:
+      # Servers without headless mode only accept two parameters
+      command = f"initialize:{cube_size},{int(animation_enabled)}" + (",1" if headless else "")
+      self._send(command)
+      response = self._receive()
+      if 'error' in response:
+        raise RuntimeError(f"Server error: {response['error']}")
+      print(response)
 
   def _define_observation_space(self, cube_size):
     # Each face of the cube can have a value from 0 to 5 (6 colors)
@@ -33,18 +98,51 @@ class RubiksCubeEnv:
 
   def reset(self, no_moves):
     """ Reset the environment and receive the initial state """
+    if self.binary:
+      return decode_state(self._request(struct.pack('<BH', OP_RESET, no_moves)), self.cube_size)
     self._send(f"reset:{no_moves}")
     return self._receive()
 
   def step(self, action):
     """ Send the action to the server and receive the next state, reward and done flag """
+    if self.binary:
+      return decode_step(self._request(bytes([OP_STEP, *action])), self.cube_size)
     side_action = 0 if action[0] == 0 else 2
     action_str = f"{side_action},{action[1]},{action[2]}"
     self._send(f"step:{action_str}")
     return self._receive()
 
+  def steps(self, actions):
+    """ Apply a sequence of actions and return the [state, reward, done] after each of them
+
+    With the binary protocol all requests are sent before the first response is read, so the sequence
+    costs a single round trip.
+    """
+    if not self.binary:
+      return [self.step(action) for action in actions]
+    for action in actions:
+      self._send_frame(bytes([OP_STEP, *action]))
+    if actions:
+      self.profiler.count('round_trips')
+    return [decode_step(self._receive_frame(), self.cube_size) for _ in actions]
+
+  def apply_moves(self, actions):
+    """ Apply a sequence of actions and return only the final [state, reward, done] """
+    if not self.binary:
+      result = None
+      for action in actions:
+        result = self.step(action)
+      return result if result is not None else [self.get_state(), 0, 0]
+    payload = bytes(value for action in actions for value in action)
+    response = self._request(struct.pack('<BH', OP_APPLY_MOVES, len(actions)) + payload)
+    return decode_step(response, self.cube_size)
+
   def generate_neighbours(self):
     """ Generate neighbouring states by applying every possible move """
+    if self.binary:
+      # A single request, the server applies and undoes every action itself
+      return decode_neighbours(self._request(bytes([OP_NEIGHBOURS])), self.cube_size)
+
     neighbours = {}
 
     for side in [0, 1]:
@@ -65,26 +163,93 @@ class RubiksCubeEnv:
 
   def get_state(self):
     """ Get state of the environment """
+    if self.binary:
+      return decode_state(self._request(bytes([OP_GET_STATE])), self.cube_size)
     self._send("get_state")
     return self._receive()
 
   def is_solved(self, state):
     """ Check if the cube is in a solved state """
+    if self.binary:
+      return self._request(bytes([OP_IS_SOLVED]) + np.asarray(state, dtype=np.uint8).tobytes())[0]
     self._send(f"is_solved:{state}")
     return self._receive()
 
+  def benchmark(self, num_steps=10000):
+    """ Have the server apply num_steps random moves, reading the state after each, and time them there.
+    Returns {'steps', 'seconds', 'steps_per_second'}, the cube is left scrambled. """
+    if self.binary:
+      seconds, = struct.unpack('<d', self._request(struct.pack('<BI', OP_BENCHMARK, num_steps)))
+    else:
+      self._send(f"benchmark:{num_steps}")
+      seconds = self._receive()['seconds']
+    return {'steps': num_steps, 'seconds': seconds, 'steps_per_second': num_steps / seconds if seconds > 0 else 0.0}
+
   def close(self):
     """ Close the socket """
     self.socket.close()
 
   def _send(self, message):
     """ Send message to server """
-    self.socket.sendall(message.encode())
+    data = message.encode()
+    with self.profiler.phase('env_io'):
+      self.socket.sendall(data)
+    self.profiler.count('bytes_sent', len(data))
 
   def _receive(self):
-    """ Receive response from server """
-    response = self.socket.recv(4096)
-    return json.loads(response.decode())
+    """ Receive a JSON response from server, reading until the whole value has arrived """
+    self.profiler.count('round_trips')
+    with self.profiler.phase('env_io'):
+      return self._receive_json()
+
+  def _receive_json(self):
+    decoder = json.JSONDecoder()
+    while True:
+      text = self._buffer.decode().lstrip()
+      if text:
+        try:
+          response, end = decoder.raw_decode(text)
+          self._buffer = text[end:].encode()
+          return response
+        except json.JSONDecodeError:
+          pass
+      self._buffer += self._recv_some()
+
+  def _send_frame(self, payload):
+    """ Send a length-prefixed binary request """
+    data = LENGTH_PREFIX.pack(len(payload)) + payload
+    with self.profiler.phase('env_io'):
+      self.socket.sendall(data)
+    self.profiler.count('bytes_sent', len(data))
+
+  def _receive_frame(self):
+    """ Receive a length-prefixed binary response, returns its payload without the status byte. Pipelined
+    responses share a round trip, so callers count round_trips. """
+    with self.profiler.phase('env_io'):
+      length, = LENGTH_PREFIX.unpack(self._receive_exactly(LENGTH_PREFIX.size))
+      response = self._receive_exactly(length)
+    if response[0] != STATUS_OK:
+      raise RuntimeError(f"Server error: {response[1:].decode()}")
+    return response[1:]
+
+  def _request(self, payload):
+    """ Send a binary request and wait for its response """
+    self._send_frame(payload)
+    self.profiler.count('round_trips')
+    return self._receive_frame()
+
+  def _receive_exactly(self, num_bytes):
+    while len(self._buffer) < num_bytes:
+      self._buffer += self._recv_some()
+    data, self._buffer = self._buffer[:num_bytes], self._buffer[num_bytes:]
+    return data
+
+  def _recv_some(self):
+    data = self.socket.recv(65536)
+    if not data:
+      raise ConnectionError("Server closed the connection")
+    self.profiler.count('bytes_received', len(data))
+    return data
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from cube_simulator import random_scrambles
+from encoding import encode_states
+from value_network import ValueNetwork
+
+
+def fold_batchnorm(linear, batchnorm):
+  """ Return a Linear layer computing batchnorm(linear(x)) with the batch norm running statistics """
+  scale = batchnorm.weight / torch.sqrt(batchnorm.running_var + batchnorm.eps)
+  folded = nn.Linear(linear.in_features, linear.out_features)
+  with torch.no_grad():
+    folded.weight.copy_(linear.weight * scale.unsqueeze(1))
+    folded.bias.copy_((linear.bias - batchnorm.running_mean) * scale + batchnorm.bias)
+  return folded
+
+
+def fold_value_network(model):
+  """ Copy of a ValueNetwork with every BatchNorm folded into the Linear layer before it """
+  folded = copy.deepcopy(model).cpu().eval()
+  folded.fc1, folded.bn1 = fold_batchnorm(folded.fc1, folded.bn1), nn.Identity()
+  folded.fc2, folded.bn2 = fold_batchnorm(folded.fc2, folded.bn2), nn.Identity()
+  for block in folded.res_blocks:
+    block.fc1, block.bn1 = fold_batchnorm(block.fc1, block.bn1), nn.Identity()
+    block.fc2, block.bn2 = fold_batchnorm(block.fc2, block.bn2), nn.Identity()
+  return folded
+
+
+def export_value_network(model, input_size, export_path, quantize=False):
+  """ Fold batch norms, optionally apply dynamic int8 quantization to the Linear layers (CPU only) and save
+  the result as TorchScript, which astar.load_model loads in place of the state dict """
+  exported = fold_value_network(model)
+  if quantize:
+    exported = torch.ao.quantization.quantize_dynamic(exported, {nn.Linear}, dtype=torch.qint8)
+
+  with torch.no_grad():
+    scripted = torch.jit.trace(exported, torch.zeros(1, input_size))
+  scripted = torch.jit.freeze(scripted.eval())
+  torch.jit.save(scripted, export_path)
+  return scripted
+
+
+def held_out_states(cube_size, num_states, max_scramble_moves, seed=0):
+  """ Encoded scrambles with depths spread evenly from 0 to max_scramble_moves """
+  rng = np.random.default_rng(seed)
+  depths = np.arange(num_states) % (max_scramble_moves + 1)
+  return encode_states(random_scrambles(cube_size, depths, rng))
+
+
+def check_parity(reference, exported, states_encoded, batch_size=4096):
+  """ Compare the cost estimates of the exported model with the original one """
+  with torch.no_grad():
+    expected = torch.cat([reference(batch) for batch in states_encoded.split(batch_size)]).squeeze(1)
+    actual = torch.cat([exported(batch) for batch in states_encoded.split(batch_size)]).squeeze(1)
+  errors = (actual - expected).abs()
+  return {'max_abs_error': errors.max().item(),
+          'mean_abs_error': errors.mean().item(),
+          'rounded_agreement': (actual.round() == expected.round()).float().mean().item()}
+
+
+def benchmark(model, input_size, batch_sizes=(1, 4, 16, 64, 256, 1024, 4096), min_time=0.5):
+  """ Measure latency per call and states per second for each batch size """
+  results = []
+  with torch.no_grad():
+    for batch_size in batch_sizes:
+      data = torch.zeros(batch_size, input_size)
+      data[:, ::6] = 1
+      model(data)  # Warm up
+
+      calls = 0
+      start = time.perf_counter()
+      while time.perf_counter() - start < min_time:
+        model(data)
+        calls += 1
+      elapsed = time.perf_counter() - start
+      results.append({'batch_size': batch_size,
+                      'latency_ms': 1000 * elapsed / calls,
+                      'states_per_second': batch_size * calls / elapsed})
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Export a ValueNetwork for fast CPU inference in A*')
+  parser.add_argument('network_path', help='ValueNetwork state dict (.pth)')
+  parser.add_argument('export_path', help='TorchScript output (.pt)')
+  parser.add_argument('--cube-size', type=int, default=2)
+  parser.add_argument('--quantize', action='store_true', help='dynamic int8 quantization of Linear layers')
+  parser.add_argument('--held-out-states', type=int, default=10_000)
+  parser.add_argument('--max-scramble-moves', type=int, default=15)
+  parser.add_argument('--benchmark', action='store_true', help='compare latency and throughput across batch sizes')
+  args = parser.parse_args()
+
+  input_size = 6 * 6 * args.cube_size * args.cube_size
+  model = ValueNetwork(input_size)
+  model.load_state_dict(torch.load(args.network_path, map_location='cpu'))
+  model.eval()
+
+  exported = export_value_network(model, input_size, args.export_path, quantize=args.quantize)
+  print(f"Saved {'quantized ' if args.quantize else ''}TorchScript model to {args.export_path}")
+
+  states_encoded = held_out_states(args.cube_size, args.held_out_states, args.max_scramble_moves)
+  parity = check_parity(model, exported, states_encoded)
+  print(f"Max abs error {parity['max_abs_error']:.4f}, mean abs error {parity['mean_abs_error']:.4f}, "
+        f"rounded agreement {parity['rounded_agreement']:.2%}")
+
+  if args.benchmark:
+    for name, candidate in [('original', model), ('exported', exported)]:
+      for result in benchmark(candidate, input_size):
+        print(f"{name:>8} batch {result['batch_size']:>5}: {result['latency_ms']:8.3f} ms, "
+              f"{result['states_per_second']:12,.0f} states/s")
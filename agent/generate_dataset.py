@@ -1,33 +1,124 @@
 import os
-import json
+import multiprocessing
+from contextlib import ExitStack
 import numpy as np
 from environment import RubiksCubeEnv
+from cube_simulator import random_scrambles
+from dataset_format import ShardedDatasetWriter
 from tqdm import tqdm
 import time
 
 
-def generate_data(env, num_samples, min_scramble_moves, max_scramble_moves, file_path, log_every_n=10_000):
-  """ Generate a dataset of scrambled Rubik's Cube states and their cost to go."""
-  data = []
-
+def scramble_depths(num_samples, min_scramble_moves, max_scramble_moves, seed=0):
+  """ Scramble depth of every sample in generation order """
   # Generate a list of no_moves values uniformly distributed across the range
   no_moves_list = np.linspace(
     min_scramble_moves, max_scramble_moves, num_samples, dtype=int)
+  # Shuffle it with a fixed seed so every shard mixes all depths and a resumed run continues the same order
+  return np.random.default_rng(seed).permutation(no_moves_list)
+
+
+def generate_data(env, num_samples, min_scramble_moves, max_scramble_moves, output_dir, shard_size=100_000,
+                  log_every_n=10_000, seed=0):
+  """ Generate a dataset of scrambled Rubik's Cube states and their cost to go.
+  Samples are streamed into binary shards in output_dir, running again with the same arguments resumes
+  after the last completed shard."""
+  writer = ShardedDatasetWriter(output_dir, env.cube_size, shard_size)
 
-  for i, no_moves in enumerate(no_moves_list):
+  no_moves_list = scramble_depths(num_samples, min_scramble_moves, max_scramble_moves, seed)
+
+  if writer.num_samples > 0:
+    print(f"Resuming after {writer.num_samples} samples already in {output_dir}")
+
+  for i in range(writer.num_samples, num_samples):
+    no_moves = int(no_moves_list[i])
     state = env.reset(no_moves)
-    data.append({'state': state, 'cost_to_go': int(no_moves)})
+    writer.add(state, no_moves)
 
     if (i + 1) % log_every_n == 0 or i == num_samples - 1:
       samples_processed = i + 1
 
       print(f"Processed {samples_processed}/{num_samples} samples. ")
 
-  with open(file_path, 'w') as f:
-    json.dump(data, f)
+  writer.close()
 
   print(
-    f"Generated {num_samples} samples and saved to {file_path}")
+    f"Generated {num_samples} samples and saved to {output_dir}")
+
+
+# Environment of the current worker process, created by _init_worker
+_worker_env = None
+
+
+def _init_worker(cube_size, server_address, server_ports):
+  """ Give a pool worker its own Godot connection on a port nobody else uses, or none for the simulator """
+  global _worker_env
+  if server_ports is not None:
+    _worker_env = RubiksCubeEnv(server_address, server_ports.get(), cube_size)
+
+
+def _generate_chunk(task):
+  """ Generate the samples of one chunk of a shard in a pool worker """
+  shard_index, chunk_index, depths, cube_size, seed = task
+  if _worker_env is None:
+    # Seeding per chunk rather than per worker keeps the output independent of scheduling
+    rng = np.random.default_rng([seed, shard_index, chunk_index])
+    states = random_scrambles(cube_size, depths, rng)
+  else:
+    states = np.array([_worker_env.reset(int(no_moves)) for no_moves in depths], dtype=np.uint8)
+  return states, depths
+
+
+def generate_data_parallel(cube_size, num_samples, min_scramble_moves, max_scramble_moves, output_dir,
+                           shard_size=100_000, num_workers=None, seed=0, server_address='127.0.0.1',
+                           server_ports=None, chunk_size=10_000):
+  """ Generate the same sharded dataset as generate_data with a pool of worker processes.
+  Every shard is split into chunks of chunk_size samples spread over all workers, each chunk is scrambled
+  with the NumPy simulator and an RNG seeded from (seed, shard index, chunk index), and the chunks are joined
+  in order before their shard is written, so the output only depends on the arguments. Pass server_ports to
+  have each worker drive its own Godot instance instead (one worker per port, Godot scrambles are not seeded)."""
+  writer = ShardedDatasetWriter(output_dir, cube_size, shard_size)
+  no_moves_list = scramble_depths(num_samples, min_scramble_moves, max_scramble_moves, seed)
+
+  if writer.num_samples > 0:
+    print(f"Resuming after {writer.num_samples} samples already in {output_dir}")
+
+  tasks = []
+  for shard_index, shard_start in enumerate(range(writer.num_samples, num_samples, shard_size),
+                                            start=len(writer.manifest['shards'])):
+    shard_end = min(shard_start + shard_size, num_samples)
+    for chunk_index, start in enumerate(range(shard_start, shard_end, chunk_size)):
+      tasks.append((shard_index, chunk_index, no_moves_list[start:min(start + chunk_size, shard_end)],
+                    cube_size, seed))
+
+  samples_processed = writer.num_samples
+  with ExitStack() as stack:
+    ports = None
+    if server_ports is not None:
+      num_workers = len(server_ports)
+      # The manager process holding the port queue is shut down on leaving the stack
+      ports = stack.enter_context(multiprocessing.Manager()).Queue()
+      for port in server_ports:
+        ports.put(port)
+
+    pool = stack.enter_context(multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                                    initargs=(cube_size, server_address, ports)))
+    # imap keeps the chunk order no matter which worker finishes first
+    chunks = []
+    for i, (states, depths) in enumerate(pool.imap(_generate_chunk, tasks)):
+      chunks.append((states, depths))
+      # Write a shard once its last chunk is in
+      if i + 1 == len(tasks) or tasks[i + 1][0] != tasks[i][0]:
+        states, depths = (np.concatenate(parts) for parts in zip(*chunks))
+        chunks = []
+        writer.add_batch(states, depths)
+        samples_processed += len(depths)
+        print(f"Processed {samples_processed}/{num_samples} samples. ")
+
+  writer.close()
+
+  print(
+    f"Generated {num_samples} samples and saved to {output_dir}")
 
 
 if __name__ == "__main__":
@@ -41,12 +132,16 @@ if __name__ == "__main__":
   min_scramble_moves = 0
   max_scramble_moves = 12  # for 2x2x2
   # max_scramble_moves = 15  # for 3x3x3 and 4x4x4
-  file_path = 'data/rubiks_cube_data_2x2x2.json'
-  # file_path = 'data/rubiks_cube_data_3x3x3.json'
-  # file_path = 'data/rubiks_cube_data_4x4x4.json'
+  output_dir = 'data/rubiks_cube_data_2x2x2'
+  # output_dir = 'data/rubiks_cube_data_3x3x3'
+  # output_dir = 'data/rubiks_cube_data_4x4x4'
 
   env = RubiksCubeEnv(server_address, server_port,
                       cube_size, animation_enabled)
   generate_data(env, num_samples, min_scramble_moves,
-                max_scramble_moves, file_path)
+                max_scramble_moves, output_dir)
   env.close()
+
+  # Parallel generation with the NumPy simulator, or one Godot instance per port with server_ports
+  # generate_data_parallel(cube_size, num_samples, min_scramble_moves,
+  #                        max_scramble_moves, output_dir, num_workers=os.cpu_count())
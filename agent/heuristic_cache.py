@@ -0,0 +1,73 @@
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+from cube_simulator import canonical_keys
+
+
+class HeuristicCache:
+  """ Bounded LRU cache of heuristic values keyed by canonical state (see cube_simulator.canonical_keys)
+
+  States that are color relabellings or action-preserving rotations of each other share one network
+  evaluation, the value of whichever of them was evaluated first. A cache belongs to one model and cube
+  size and can be shared by any number of searches with them.
+  """
+  def __init__(self, max_entries=1_000_000):
+    self.max_entries = max_entries
+    self.values = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    # Bytes held by the cached keys and values themselves, the OrderedDict is added in memory_bytes
+    self.entry_bytes = 0
+
+  def evaluate(self, states, evaluate_fn):
+    """ Heuristic values of a (N, ...) batch of states, calling evaluate_fn(states) -> list of floats once
+    for the states that are not cached """
+    keys = canonical_keys(states)
+    values = [self.values.get(key) for key in keys]
+
+    missing = {}
+    for i, (key, value) in enumerate(zip(keys, values)):
+      if value is None:
+        # Symmetric states in the same batch are evaluated once
+        missing.setdefault(key, i)
+      else:
+        self.values.move_to_end(key)
+    self.hits += len(keys) - len(missing)
+    self.misses += len(missing)
+
+    if missing:
+      computed = dict(zip(missing, evaluate_fn(np.asarray(states)[list(missing.values())])))
+      for key, value in computed.items():
+        self._insert(key, value)
+      values = [computed[key] if value is None else value for key, value in zip(keys, values)]
+    return values
+
+  def _insert(self, key, value):
+    """ Add an entry, evicting the least recently used one when full """
+    self.values[key] = value
+    self.entry_bytes += sys.getsizeof(key) + sys.getsizeof(value)
+    if len(self.values) > self.max_entries:
+      old_key, old_value = self.values.popitem(last=False)
+      self.entry_bytes -= sys.getsizeof(old_key) + sys.getsizeof(old_value)
+
+  @property
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.0
+
+  @property
+  def memory_bytes(self):
+    """ Approximate memory held by the cache """
+    return sys.getsizeof(self.values) + self.entry_bytes
+
+  def stats(self):
+    """ Summary of the cache usage """
+    return {'entries': len(self.values), 'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hit_rate, 'memory_bytes': self.memory_bytes}
+
+  def clear(self):
+    """ Drop all entries and reset the counters """
+    self.values.clear()
+    self.hits = self.misses = self.entry_bytes = 0
@@ -0,0 +1,207 @@
+import argparse
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from encoding import encode_states
+
+
+class InferenceError(RuntimeError):
+  """ A forward pass of the InferenceServer failed, sent to clients in other processes in place of their
+  values """
+
+
+class InferenceServer:
+  """ Batches heuristic requests of many concurrent searches into single forward passes
+
+  A request is (client, cube_size, states, submit_time) on the request queue, states being a (N, stickers)
+  uint8 array and submit_time a time.perf_counter() reading. After the first request of a batch arrives the
+  server keeps collecting until the batch holds max_batch_size states, max_wait_us microseconds have
+  passed, or every one of num_clients clients has a request in the batch. It then runs one forward pass
+  per cube size in the batch and replies to each request.
+
+  In-process clients get their heuristic_fn from heuristic_fn(cube_size) and are answered through a
+  Future. Clients in other processes share a multiprocessing.Queue of requests, use their index into
+  responses as client and get their values from that response queue. When the forward pass of a cube size
+  fails, its in-process clients get the exception through their Future, the others an InferenceError on
+  their response queue, and the server keeps serving.
+  """
+  def __init__(self, models, max_batch_size=4096, max_wait_us=1000, device=None, requests=None,
+               responses=None, num_clients=None):
+    self.models = models
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_us / 1e6
+    self.device = device
+    self.requests = requests if requests is not None else queue.Queue()
+    self.responses = responses
+    self.num_clients = num_clients if num_clients is not None else (len(responses) if responses else None)
+    self.thread = None
+
+    # Metrics, latencies are kept for the most recent requests only
+    self.latencies = collections.deque(maxlen=100_000)
+    self.queue_depths = collections.deque(maxlen=100_000)
+    self.batch_sizes = collections.Counter()
+    self.num_batches = 0
+    self.num_states = 0
+    self.inference_seconds = 0.0
+
+  def heuristic_fn(self, cube_size):
+    """ heuristic_fn(states) -> list of floats for solvers running in threads of this process """
+    def evaluate(states):
+      future = Future()
+      self.requests.put((future, cube_size, np.ascontiguousarray(states, dtype=np.uint8), time.perf_counter()))
+      return future.result()
+    return evaluate
+
+  def start(self):
+    """ Serve in a background thread of this process """
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    """ Answer the requests already queued, then stop serving """
+    self.requests.put(None)
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+  def serve_forever(self):
+    """ Serve until a None request arrives """
+    running = True
+    while running:
+      batch, running = self._collect_batch()
+      if batch:
+        self._evaluate(batch)
+
+  def _collect_batch(self):
+    """ Wait for a request, then gather more until the batching policy closes the batch """
+    request = self.requests.get()
+    if request is None:
+      return [], False
+    try:
+      self.queue_depths.append(self.requests.qsize())
+    except NotImplementedError:
+      # multiprocessing.Queue.qsize is not available on every platform
+      pass
+
+    batch = [request]
+    num_states = len(request[2])
+    deadline = time.perf_counter() + self.max_wait
+    while num_states < self.max_batch_size and len(batch) != self.num_clients:
+      timeout = deadline - time.perf_counter()
+      if timeout <= 0:
+        break
+      try:
+        request = self.requests.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if request is None:
+        return batch, False
+      batch.append(request)
+      num_states += len(request[2])
+    return batch, True
+
+  def _evaluate(self, batch):
+    """ One forward pass per cube size, then reply to every request """
+    start = time.perf_counter()
+    for cube_size in {request[1] for request in batch}:
+      requests = [request for request in batch if request[1] == cube_size]
+      states = np.concatenate([request[2] for request in requests])
+      try:
+        with torch.no_grad():
+          values = self.models[cube_size](encode_states(states, self.device)).squeeze(1).tolist()
+      except Exception as error:
+        for client, *_ in requests:
+          self._reply_error(client, error, cube_size)
+        continue
+
+      offset = 0
+      for client, _, client_states, submit_time in requests:
+        self._reply(client, values[offset:offset + len(client_states)])
+        offset += len(client_states)
+        self.latencies.append(time.perf_counter() - submit_time)
+
+      self.batch_sizes[1 << max(len(states) - 1, 0).bit_length()] += 1
+      self.num_batches += 1
+      self.num_states += len(states)
+    self.inference_seconds += time.perf_counter() - start
+
+  def _reply(self, client, values):
+    if isinstance(client, Future):
+      client.set_result(values)
+    else:
+      self.responses[client].put(values)
+
+  def _reply_error(self, client, error, cube_size):
+    if isinstance(client, Future):
+      client.set_exception(error)
+    else:
+      # The original exception may not survive pickling, its description does
+      self.responses[client].put(InferenceError(f"Inference for cube size {cube_size} failed: {error!r}"))
+
+  def metrics(self):
+    """ Summary of the served requests: latency percentiles in microseconds, queue depth seen when a batch
+    starts, and the batch size histogram with batches counted by the power of two their size rounds up to """
+    latencies = np.array(self.latencies) * 1e6
+    return {
+      'num_batches': self.num_batches,
+      'num_states': self.num_states,
+      'mean_batch_size': self.num_states / self.num_batches if self.num_batches else 0.0,
+      'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+      'mean_queue_depth': float(np.mean(self.queue_depths)) if self.queue_depths else 0.0,
+      'max_queue_depth': max(self.queue_depths, default=0),
+      'p50_latency_us': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+      'p99_latency_us': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+      'states_per_second': self.num_states / self.inference_seconds if self.inference_seconds > 0 else 0.0,
+    }
+
+
+def format_metrics(metrics):
+  """ One line summary of InferenceServer.metrics """
+  return (f"{metrics['num_batches']} batches, mean batch {metrics['mean_batch_size']:.1f} states, "
+          f"queue depth {metrics['mean_queue_depth']:.1f} mean / {metrics['max_queue_depth']} max, "
+          f"latency p50 {metrics['p50_latency_us']:.0f}us p99 {metrics['p99_latency_us']:.0f}us, "
+          f"{metrics['states_per_second']:,.0f} states/s")
+
+
+if __name__ == "__main__":
+  """ Solve scrambles with concurrent A* searches in threads that share one server:
+  python inference_server.py networks/best_value_network_3x3x3.pth --cube-size 3 --concurrency 1 8 32 """
+  from astar import device, load_model
+  from cube_simulator import random_scrambles
+  from solvers import WeightedAStarSolver
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('network_path')
+  parser.add_argument('--cube-size', type=int, default=3)
+  parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+  parser.add_argument('--num-scrambles', type=int, default=64)
+  parser.add_argument('--scramble-depth', type=int, default=8)
+  parser.add_argument('--max-explored-states', type=int, default=200)
+  parser.add_argument('--max-batch-size', type=int, default=4096)
+  parser.add_argument('--max-wait-us', type=int, default=1000)
+  args = parser.parse_args()
+
+  model = load_model(args.network_path, args.cube_size)
+  states = random_scrambles(args.cube_size, [args.scramble_depth] * args.num_scrambles, np.random.default_rng(0))
+
+  for concurrency in args.concurrency:
+    server = InferenceServer({args.cube_size: model}, args.max_batch_size, args.max_wait_us, device,
+                             num_clients=concurrency).start()
+    solver = WeightedAStarSolver(server.heuristic_fn(args.cube_size), args.cube_size, args.max_explored_states)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+      runs = list(executor.map(lambda state: solver.solve(state)[1], states))
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    nodes_expanded = sum(run['nodes_expanded'] for run in runs)
+    print(f"{concurrency:3d} concurrent searches: {nodes_expanded / elapsed:,.0f} nodes/s, "
+          f"{format_metrics(server.metrics())}")
@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from cube_simulator import apply_move, apply_moves, expand_states, get_move_tables, random_scrambles
+from dataset_format import write_dataset
+from encoding import encode_states, one_hot_encode
+from solvers import device
+
+CUBE_SIZES = [2, 3, 4]
+BATCH_SIZES = [1, 64, 1024]
+# States per batched move and encoding call, samples per dataset
+NUM_STATES = 1024
+NUM_SAMPLES = 20_000
+# The fixed scramble set of the search benchmarks
+SEARCH_SEED = 0
+SEARCH_DEPTHS = [6] * 3
+SEARCH_MAX_EXPLORED_STATES = 50
+
+# name -> (unit, setup), setup() returns (run, units per call), run being one call of the benchmark
+BENCHMARKS = {}
+
+_temporary_directory = None
+
+
+def benchmark(name, unit):
+  """ Register a benchmark setup under name """
+  def register(setup):
+    BENCHMARKS[name] = (unit, setup)
+    return setup
+  return register
+
+
+def _workdir():
+  """ Temporary directory for the benchmark datasets, removed when the process exits """
+  global _temporary_directory
+  if _temporary_directory is None:
+    _temporary_directory = tempfile.TemporaryDirectory()
+  return _temporary_directory.name
+
+
+def _scrambled_states(cube_size, num_states, seed=0):
+  return random_scrambles(cube_size, np.full(num_states, 20), np.random.default_rng(seed))
+
+
+def _value_network(cube_size):
+  """ ValueNetwork with seeded random weights, the weights do not change the cost of a forward pass """
+  from value_network import ValueNetwork
+
+  torch.manual_seed(0)
+  return ValueNetwork(6 * 6 * cube_size * cube_size).to(device).eval()
+
+
+def _register_benchmarks():
+  for cube_size in CUBE_SIZES:
+    def moves_single(cube_size=cube_size):
+      state = _scrambled_states(cube_size, 1)[0].reshape(-1)
+      get_move_tables(cube_size)
+      return lambda: apply_move(state, 0, cube_size), 1
+
+    def moves_batch(cube_size=cube_size):
+      states = _scrambled_states(cube_size, NUM_STATES)
+      action_indices = np.random.default_rng(0).integers(4 * cube_size, size=NUM_STATES)
+      return lambda: apply_moves(states, action_indices), NUM_STATES
+
+    def moves_expand(cube_size=cube_size):
+      states = _scrambled_states(cube_size, NUM_STATES)
+      return lambda: expand_states(states), NUM_STATES * 4 * cube_size
+
+    def encoding_single(cube_size=cube_size):
+      state = _scrambled_states(cube_size, 1)[0]
+      return lambda: one_hot_encode(state), 1
+
+    def encoding_batch(cube_size=cube_size):
+      states = _scrambled_states(cube_size, NUM_STATES)
+      return lambda: encode_states(states), NUM_STATES
+
+    def dataset_json(cube_size=cube_size):
+      from value_network import CubeDataset
+
+      path = os.path.join(_workdir(), f'dataset_{cube_size}.json')
+      states = _scrambled_states(cube_size, NUM_SAMPLES)
+      with open(path, 'w') as f:
+        json.dump([{'state': state.tolist(), 'cost_to_go': 20} for state in states], f)
+
+      def load():
+        with open(path, 'r') as f:
+          CubeDataset(json.load(f))
+      return load, NUM_SAMPLES
+
+    def dataset_binary(cube_size=cube_size):
+      from value_network import CubeDataset
+
+      path = os.path.join(_workdir(), f'dataset_{cube_size}.bin')
+      write_dataset(path, _scrambled_states(cube_size, NUM_SAMPLES), np.full(NUM_SAMPLES, 20), cube_size)
+
+      def load():
+        dataset = CubeDataset(path)
+        # Touch every sample so reading the pages counts like parsing the JSON does
+        np.asarray(dataset.states).sum()
+        np.asarray(dataset.costs_to_go).sum()
+      return load, NUM_SAMPLES
+
+    def search_astar(cube_size=cube_size):
+      from solvers import WeightedAStarSolver, make_heuristic
+
+      states = random_scrambles(cube_size, SEARCH_DEPTHS, np.random.default_rng(SEARCH_SEED))
+      solver = WeightedAStarSolver(make_heuristic(_value_network(cube_size)), cube_size,
+                                   SEARCH_MAX_EXPLORED_STATES)
+
+      def solve():
+        return sum(solver.solve(state)[1]['nodes_expanded'] for state in states)
+      # The search is deterministic, every call expands as many nodes as this warm-up
+      return solve, solve()
+
+    benchmark(f'moves.single[{cube_size}]', 'moves')(moves_single)
+    benchmark(f'moves.batch[{cube_size}]', 'moves')(moves_batch)
+    benchmark(f'moves.expand[{cube_size}]', 'moves')(moves_expand)
+    benchmark(f'encoding.single[{cube_size}]', 'states')(encoding_single)
+    benchmark(f'encoding.batch[{cube_size}]', 'states')(encoding_batch)
+    for batch_size in BATCH_SIZES:
+      def network_forward(cube_size=cube_size, batch_size=batch_size):
+        model = _value_network(cube_size)
+        states_encoded = encode_states(_scrambled_states(cube_size, batch_size), device)
+
+        def forward():
+          with torch.no_grad():
+            # Reading the result back waits for the forward pass on a GPU too
+            model(states_encoded).sum().item()
+        return forward, batch_size
+      benchmark(f'network.forward[{cube_size},b{batch_size}]', 'states')(network_forward)
+    benchmark(f'dataset.load_json[{cube_size}]', 'samples')(dataset_json)
+    benchmark(f'dataset.load_binary[{cube_size}]', 'samples')(dataset_binary)
+    benchmark(f'search.astar[{cube_size}]', 'nodes')(search_astar)
+
+
+_register_benchmarks()
+
+
+def time_benchmark(run, min_time=0.2, repeat=5):
+  """ Time run like timeit: after a warm-up call, find the number of calls lasting at least min_time, then
+  time repeat rounds of that many calls. Returns the seconds per call of every round. """
+  run()
+  number = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(number):
+      run()
+    elapsed = time.perf_counter() - start
+    if elapsed >= min_time:
+      break
+    number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+
+  rounds = [elapsed / number]
+  for _ in range(repeat - 1):
+    start = time.perf_counter()
+    for _ in range(number):
+      run()
+    rounds.append((time.perf_counter() - start) / number)
+  return rounds
+
+
+def run_benchmarks(pattern=None, min_time=0.2, repeat=5):
+  """ Run the benchmarks whose name matches the pattern regex, returns {name: result} """
+  results = {}
+  for name, (unit, setup) in BENCHMARKS.items():
+    if pattern is not None and not re.search(pattern, name):
+      continue
+    run, units = setup()
+    rounds = time_benchmark(run, min_time, repeat)
+    median = statistics.median(rounds)
+    results[name] = {'unit': unit, 'units_per_call': units, 'median_seconds': median, 'min_seconds': min(rounds),
+                     'stdev_seconds': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+                     'units_per_second': units / median if median > 0 else 0.0}
+    print(f"{name:32s} {_format_seconds(median):>10s}  {results[name]['units_per_second']:>14,.0f} {unit}/s")
+  return results
+
+
+def environment_info():
+  """ What the results depend on besides the code, stored next to them """
+  return {'python': platform.python_version(), 'numpy': np.__version__, 'torch': torch.__version__,
+          'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+          'torch_threads': torch.get_num_threads(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def save_results(path, results):
+  with open(path, 'w') as f:
+    json.dump({'environment': environment_info(), 'results': results}, f, indent=2)
+
+
+def load_results(path):
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def compare(baseline, results, threshold=0.2):
+  """ Compare median times per call against a baseline, returns rows of
+  (name, baseline seconds, seconds, ratio, status) with status 'regression' when a benchmark got more than
+  threshold slower, 'improvement' when it got more than threshold faster """
+  rows = []
+  for name in sorted(set(baseline) | set(results)):
+    if name not in results or name not in baseline:
+      rows.append((name, baseline.get(name, {}).get('median_seconds'), results.get(name, {}).get('median_seconds'),
+                   None, 'missing' if name not in results else 'new'))
+      continue
+    before, after = baseline[name]['median_seconds'], results[name]['median_seconds']
+    ratio = after / before if before > 0 else float('inf')
+    status = 'regression' if ratio > 1 + threshold else 'improvement' if ratio < 1 / (1 + threshold) else 'ok'
+    rows.append((name, before, after, ratio, status))
+  return rows
+
+
+def format_report(rows):
+  lines = [f"{'benchmark':32s} {'baseline':>10s} {'current':>10s} {'ratio':>7s}  status"]
+  for name, before, after, ratio, status in rows:
+    lines.append(f"{name:32s} {_format_seconds(before):>10s} {_format_seconds(after):>10s} "
+                 f"{f'{ratio:.2f}x' if ratio is not None else '-':>7s}  {status}")
+  return '\n'.join(lines)
+
+
+def _format_seconds(seconds):
+  if seconds is None:
+    return '-'
+  for unit, scale in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+    if seconds >= scale:
+      return f"{seconds / scale:.3g}{unit}"
+  return f"{seconds / 1e-9:.3g}ns"
+
+
+if __name__ == "__main__":
+  """ Measure, store a baseline, and compare later runs against it:
+  python microbenchmarks.py run --save baseline.json
+  python microbenchmarks.py run --compare baseline.json --filter 'moves|encoding'
+  python microbenchmarks.py compare baseline.json results.json
+  Exits with status 1 when a benchmark regressed by more than --threshold. """
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  run = subparsers.add_parser('run', help='run the benchmarks')
+  run.add_argument('--filter', default=None, help='regex selecting benchmarks by name')
+  run.add_argument('--min-time', type=float, default=0.2, help='seconds per timing round')
+  run.add_argument('--repeat', type=int, default=5, help='timing rounds per benchmark')
+  run.add_argument('--save', default=None, help='write the results, e.g. as the new baseline')
+  run.add_argument('--compare', default=None, help='baseline results to compare against')
+  run.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio counted as a regression')
+  run.add_argument('--list', action='store_true', help='only list the benchmark names')
+
+  compare_parser = subparsers.add_parser('compare', help='compare two stored results')
+  compare_parser.add_argument('baseline')
+  compare_parser.add_argument('results')
+  compare_parser.add_argument('--threshold', type=float, default=0.2)
+
+  args = parser.parse_args()
+
+  if args.command == 'run' and args.list:
+    for name, (unit, _) in BENCHMARKS.items():
+      if args.filter is None or re.search(args.filter, name):
+        print(f"{name} ({unit})")
+    sys.exit(0)
+
+  if args.command == 'run':
+    results = run_benchmarks(args.filter, args.min_time, args.repeat)
+    if args.save is not None:
+      save_results(args.save, results)
+    if args.compare is None:
+      sys.exit(0)
+    baseline = load_results(args.compare)
+  else:
+    baseline = load_results(args.baseline)
+    results = load_results(args.results)['results']
+
+  if baseline['environment'].get('platform') != environment_info()['platform'] and args.command == 'run':
+    print(f"Warning: the baseline was measured on {baseline['environment'].get('platform')}")
+  # Only compare what was run, a filtered run should not report the rest as missing
+  baseline_results = {name: result for name, result in baseline['results'].items()
+                      if args.command == 'compare' or args.filter is None or re.search(args.filter, name)}
+  rows = compare(baseline_results, results, args.threshold)
+  print(format_report(rows))
+  regressions = [row[0] for row in rows if row[4] == 'regression']
+  if regressions:
+    print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+    sys.exit(1)
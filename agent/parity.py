@@ -0,0 +1,74 @@
+import argparse
+import json
+import random
+
+import numpy as np
+
+from cube_simulator import CubeSimulator, generate_actions
+
+
+def record_trace(env, num_steps, seed=0):
+  """ Record a trace of random moves and the states reported by the environment, starting from the solved cube """
+  rng = random.Random(seed)
+  actions = generate_actions(env.cube_size)
+
+  trace = {'cube_size': env.cube_size,
+           'initial_state': env.reset(0),
+           'steps': []}
+  for _ in range(num_steps):
+    action = rng.choice(actions)
+    state, reward, done = env.step(action)
+    trace['steps'].append({'action': list(action), 'state': state, 'done': done})
+  return trace
+
+
+def check_trace(trace):
+  """ Replay a recorded trace in the simulator and return the indices of the steps that differ """
+  sim = CubeSimulator(trace['cube_size'])
+  mismatches = []
+
+  if not np.array_equal(sim.reset(0), trace['initial_state']):
+    mismatches.append(-1)
+
+  for i, step in enumerate(trace['steps']):
+    state, reward, done = sim.step(tuple(step['action']))
+    if not np.array_equal(state, step['state']) or done != step['done']:
+      mismatches.append(i)
+  return mismatches
+
+
+if __name__ == "__main__":
+  """ Record a trace from a running Godot server or check the simulator against a recorded one """
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  record = subparsers.add_parser('record', help='record a trace from the Godot server')
+  record.add_argument('trace_path')
+  record.add_argument('--cube-size', type=int, default=3)
+  record.add_argument('--steps', type=int, default=1000)
+  record.add_argument('--seed', type=int, default=0)
+  record.add_argument('--server-address', default='127.0.0.1')
+  record.add_argument('--server-port', type=int, default=4242)
+
+  check = subparsers.add_parser('check', help='replay a recorded trace in the simulator')
+  check.add_argument('trace_path')
+
+  args = parser.parse_args()
+
+  if args.command == 'record':
+    from environment import RubiksCubeEnv
+
+    env = RubiksCubeEnv(args.server_address, args.server_port, cube_size=args.cube_size)
+    trace = record_trace(env, args.steps, args.seed)
+    env.close()
+    with open(args.trace_path, 'w') as f:
+      json.dump(trace, f)
+    print(f"Recorded {args.steps} steps to {args.trace_path}")
+  else:
+    with open(args.trace_path, 'r') as f:
+      trace = json.load(f)
+    mismatches = check_trace(trace)
+    if mismatches:
+      print(f"Simulator differs from the trace at steps {mismatches[:20]} ({len(mismatches)} total)")
+      raise SystemExit(1)
+    print(f"Simulator matches all {len(trace['steps'])} steps of {args.trace_path}")
@@ -0,0 +1,312 @@
+import argparse
+import os
+import time
+from functools import lru_cache
+from math import factorial
+
+import numpy as np
+import torch
+
+from cube_simulator import (BACK, BOTTOM, FRONT, LEFT, NUM_FACES, _sticker_normals, _sticker_positions,
+                            get_move_tables, get_rotation_tables, get_solved_state)
+from dataset_format import _replace_atomically
+from encoding import encode_states
+
+# Exact distance-to-solved table of the 2x2x2 cube.
+#
+# A 2x2x2 state is its 8 corners. A state is first rotated as a whole to put the reference corner
+# (BOTTOM/LEFT/BACK) in its solved place and orientation, the other 7 corners are then indexed by their
+# permutation (7! ranks) and the orientation of the first 6 of them (3^6 ranks, the last one follows from
+# the total twist being a multiple of 3).
+# Only X and Y layers can be turned, so unlike on a real cube the distance also depends on which axis of
+# the rotated cube was the Z axis of the original one, which adds a factor of 3 to the index.
+CUBE_SIZE = 2
+NUM_CORNERS = 8
+NUM_FREE_CORNERS = NUM_CORNERS - 1
+NUM_AXES = 3
+NUM_CORNER_INDICES = factorial(NUM_FREE_CORNERS) * 3 ** (NUM_FREE_CORNERS - 1)
+TABLE_SIZE = NUM_CORNER_INDICES * NUM_AXES
+# Table entry of the indices the action set never reaches
+UNREACHABLE = 255
+REFERENCE_CORNER_COLORS = (1 << BOTTOM) | (1 << LEFT) | (1 << BACK)
+
+
+@lru_cache(maxsize=None)
+def _corner_stickers():
+  """ Sticker indices of every corner, (8, 3) with the reference corner first
+
+  The first sticker of a corner is the one facing TOP or BOTTOM and the other two follow in the same
+  rotational direction for every corner, so a corner's orientation is the slot of its TOP/BOTTOM colored
+  sticker and quarter turns keep the total twist a multiple of 3.
+  """
+  positions = _sticker_positions(CUBE_SIZE)
+  normals = _sticker_normals(CUBE_SIZE)
+  centers = positions - normals
+  solved_state = get_solved_state(CUBE_SIZE)
+
+  corners = []
+  for center in np.unique(centers, axis=0):
+    stickers = np.flatnonzero((centers == center).all(axis=1))
+    first = stickers[normals[stickers, 1] != 0][0]
+    second, third = stickers[stickers != first]
+    if round(np.linalg.det(normals[[first, second, third]])) < 0:
+      second, third = third, second
+    corners.append([first, second, third])
+
+  corners.sort(key=lambda stickers: (1 << solved_state[stickers]).sum() != REFERENCE_CORNER_COLORS)
+  corners = np.array(corners)
+  corners.setflags(write=False)
+  return corners
+
+
+@lru_cache(maxsize=None)
+def _corner_colors():
+  """ Colors read from the 3 sticker slots of a corner holding piece p with orientation o, (24, 3) indexed by
+  p * 3 + o. A piece with orientation o has the k-th sticker of its solved order in slot (o + k) % 3. """
+  solved_colors = get_solved_state(CUBE_SIZE)[_corner_stickers()]
+  colors = np.empty((NUM_CORNERS * 3, 3), dtype=np.uint8)
+  for orientation in range(3):
+    colors[orientation::3, (orientation + np.arange(3)) % 3] = solved_colors
+  return colors
+
+
+@lru_cache(maxsize=None)
+def _corner_of_colors():
+  """ Inverse of _corner_colors, lookup from the colors code c0 * 36 + c1 * 6 + c2 to p * 3 + o """
+  codes = _corner_colors().astype(np.intp) @ np.array([NUM_FACES ** 2, NUM_FACES, 1])
+  corner_of_colors = np.full(NUM_FACES ** 3, -1, dtype=np.intp)
+  corner_of_colors[codes] = np.arange(len(codes))
+  return corner_of_colors
+
+
+def _read_corners(states, corner_stickers):
+  """ Pieces and orientations at the given corners of a (N, 24) batch, two (N, len(corner_stickers)) arrays """
+  colors = states[:, corner_stickers].astype(np.intp)
+  codes = (colors[..., 0] * NUM_FACES + colors[..., 1]) * NUM_FACES + colors[..., 2]
+  return np.divmod(_corner_of_colors()[codes], 3)
+
+
+@lru_cache(maxsize=None)
+def _rotation_to_reference():
+  """ For every sticker index, the whole-cube rotation that moves that sticker to the first sticker of
+  the reference corner """
+  rotations = get_rotation_tables(CUBE_SIZE)
+  reference_sticker = _corner_stickers()[0, 0]
+  rotation_of_sticker = np.full(rotations.shape[1], -1, dtype=np.intp)
+  rotation_of_sticker[rotations[:, reference_sticker]] = np.arange(len(rotations))
+  return rotation_of_sticker
+
+
+@lru_cache(maxsize=None)
+def _z_axis_of_rotation():
+  """ For every whole-cube rotation, the axis (face // 2) the original FRONT face is rotated onto """
+  front_sticker = FRONT * CUBE_SIZE ** 2
+  return np.array([np.flatnonzero(rotation == front_sticker)[0] // CUBE_SIZE ** 2 // 2
+                   for rotation in get_rotation_tables(CUBE_SIZE)])
+
+
+@lru_cache(maxsize=None)
+def _rotation_from_z_axis():
+  """ For every axis, a whole-cube rotation that brings it back to the Z axis """
+  rotations = get_rotation_tables(CUBE_SIZE)
+  inverses = np.argsort(rotations, axis=1)
+  z_axis_of_inverse = [_z_axis_of_rotation()[np.flatnonzero((rotations == inverse).all(axis=1))[0]]
+                       for inverse in inverses]
+  return np.array([z_axis_of_inverse.index(axis) for axis in range(NUM_AXES)])
+
+
+def _check_states(states):
+  states = np.asarray(states, dtype=np.uint8)
+  if states.size != len(states) * NUM_FACES * CUBE_SIZE ** 2:
+    raise ValueError("The pattern database only covers the 2x2x2 cube")
+  return states.reshape(len(states), NUM_FACES * CUBE_SIZE ** 2)
+
+
+def _canonicalize(states):
+  """ Rotate a (N, 24) batch of states so the reference corner is solved, returns the rotated states and
+  the axis the Z axis was rotated onto """
+  corner_stickers = _corner_stickers()
+  pieces, orientations = _read_corners(states, corner_stickers)
+
+  rows = np.arange(len(states))
+  position = (pieces == 0).argmax(axis=1)
+  # The reference corner's first sticker is the one in the slot given by its orientation
+  rotation_ids = _rotation_to_reference()[corner_stickers[position, orientations[rows, position]]]
+  rotated = np.take_along_axis(states, get_rotation_tables(CUBE_SIZE)[rotation_ids], axis=1)
+  return rotated, _z_axis_of_rotation()[rotation_ids]
+
+
+def state_indices(states):
+  """ Perfect hash of a (N, ...) batch of 2x2x2 states into [0, TABLE_SIZE)
+
+  States share an index exactly when they are rotations of each other that keep the Z axis in place, so
+  the index determines the distance to solved.
+  """
+  states, z_axes = _canonicalize(_check_states(states))
+  pieces, orientations = _read_corners(states, _corner_stickers()[1:])
+  pieces -= 1
+
+  # Lehmer code of the permutation
+  permutation_rank = np.zeros(len(states), dtype=np.int64)
+  for i in range(NUM_FREE_CORNERS):
+    smaller_after = (pieces[:, i + 1:] < pieces[:, i:i + 1]).sum(axis=1)
+    permutation_rank = permutation_rank * (NUM_FREE_CORNERS - i) + smaller_after
+
+  orientation_rank = np.zeros(len(states), dtype=np.int64)
+  for i in range(NUM_FREE_CORNERS - 1):
+    orientation_rank = orientation_rank * 3 + orientations[:, i]
+  corner_index = permutation_rank * 3 ** (NUM_FREE_CORNERS - 1) + orientation_rank
+  return corner_index * NUM_AXES + z_axes
+
+
+def index_states(indices):
+  """ Inverse of state_indices, one (N, 24) state for each of an array of table indices """
+  indices = np.asarray(indices, dtype=np.int64)
+  corner_index, z_axes = np.divmod(indices, NUM_AXES)
+  permutation_rank, orientation_rank = np.divmod(corner_index, 3 ** (NUM_FREE_CORNERS - 1))
+
+  orientations = np.zeros((len(indices), NUM_FREE_CORNERS), dtype=np.int64)
+  for i in reversed(range(NUM_FREE_CORNERS - 1)):
+    orientation_rank, orientations[:, i] = np.divmod(orientation_rank, 3)
+  orientations[:, -1] = -orientations[:, :-1].sum(axis=1) % 3
+
+  # Decode the Lehmer code, picking the digit-th of the pieces not used yet
+  digits = np.zeros((len(indices), NUM_FREE_CORNERS), dtype=np.int64)
+  for i in reversed(range(NUM_FREE_CORNERS)):
+    permutation_rank, digits[:, i] = np.divmod(permutation_rank, NUM_FREE_CORNERS - i)
+  available = np.ones((len(indices), NUM_FREE_CORNERS), dtype=bool)
+  pieces = np.zeros_like(digits)
+  for i in range(NUM_FREE_CORNERS):
+    pieces[:, i] = (available & (available.cumsum(axis=1) == digits[:, i:i + 1] + 1)).argmax(axis=1)
+    available[np.arange(len(indices)), pieces[:, i]] = False
+
+  states = np.tile(get_solved_state(CUBE_SIZE), (len(indices), 1))
+  states[:, _corner_stickers()[1:]] = _corner_colors()[(pieces + 1) * 3 + orientations]
+  rotations = get_rotation_tables(CUBE_SIZE)[_rotation_from_z_axis()[z_axes]]
+  return np.take_along_axis(states, rotations, axis=1)
+
+
+@lru_cache(maxsize=None)
+def _coordinate_move_tables():
+  """ How every action changes the parts of a table index, so the search never touches stickers
+
+  An action maps the permutation rank, the orientation rank and the Z axis of an index independently,
+  depending on the Z axis only. Returns (permutation_moves, orientation_moves, axis_moves) of shapes
+  (3, actions, 7!), (3, actions, 3^6) and (3, actions).
+  """
+  tables = get_move_tables(CUBE_SIZE)
+  num_orientations = 3 ** (NUM_FREE_CORNERS - 1)
+  num_permutations = factorial(NUM_FREE_CORNERS)
+  permutation_moves = np.empty((NUM_AXES, len(tables), num_permutations), dtype=np.int64)
+  orientation_moves = np.empty((NUM_AXES, len(tables), num_orientations), dtype=np.int64)
+  axis_moves = np.empty((NUM_AXES, len(tables)), dtype=np.int64)
+
+  for axis in range(NUM_AXES):
+    permutations = index_states(np.arange(num_permutations) * num_orientations * NUM_AXES + axis)
+    orientations = index_states(np.arange(num_orientations) * NUM_AXES + axis)
+    for action, table in enumerate(tables):
+      corner_indices, new_axes = np.divmod(state_indices(permutations[:, table]), NUM_AXES)
+      permutation_moves[axis, action] = corner_indices // num_orientations
+      axis_moves[axis, action] = new_axes[0]
+      corner_indices = state_indices(orientations[:, table]) // NUM_AXES
+      orientation_moves[axis, action] = corner_indices % num_orientations
+  return permutation_moves, orientation_moves, axis_moves
+
+
+def build_pattern_database(log=True):
+  """ Breadth-first search from the solved states, returns the (TABLE_SIZE,) uint8 table of distances
+  to solved """
+  permutation_moves, orientation_moves, axis_moves = _coordinate_move_tables()
+  num_orientations = orientation_moves.shape[2]
+  distances = np.full(TABLE_SIZE, UNREACHABLE, dtype=np.uint8)
+
+  frontier = np.unique(state_indices(get_solved_state(CUBE_SIZE)[get_rotation_tables(CUBE_SIZE)]))
+  distances[frontier] = 0
+  depth = 0
+  while len(frontier):
+    depth += 1
+    corner_indices, axes = np.divmod(frontier, NUM_AXES)
+    permutations, orientations = np.divmod(corner_indices, num_orientations)
+    for action in range(axis_moves.shape[1]):
+      children = ((permutation_moves[axes, action, permutations] * num_orientations
+                   + orientation_moves[axes, action, orientations]) * NUM_AXES + axis_moves[axes, action])
+      children = children[distances[children] == UNREACHABLE]
+      distances[children] = depth
+    frontier = np.flatnonzero(distances == depth)
+    if log and len(frontier):
+      print(f"Depth {depth}: {len(frontier):,} states")
+  return distances
+
+
+def save_pattern_database(path, distances):
+  """ Store the table as a .npy file, which load_pattern_database memory-maps """
+  _replace_atomically(path, lambda f: np.save(f, distances))
+
+
+def load_pattern_database(path):
+  """ Memory-map a table written by save_pattern_database """
+  return np.load(path, mmap_mode='r')
+
+
+class PatternDatabaseHeuristic:
+  """ Exact, and therefore admissible, 2x2x2 heuristic for astar_search(heuristic_fn=...) """
+  def __init__(self, distances):
+    self.distances = distances
+
+  def __call__(self, states):
+    """ Distances to solved of a (N, ...) batch of states, as a list of floats """
+    return self.distances[state_indices(states)].astype(np.float64).tolist()
+
+
+def network_error_by_depth(model, distances, samples_per_depth=1000, seed=0, device=None):
+  """ Compare the model's estimates with the exact distances on states sampled uniformly at each depth
+
+  Returns {depth: {'count', 'mae', 'bias', 'max_error'}}, bias is the mean of estimate - distance.
+  """
+  rng = np.random.default_rng(seed)
+  distances = np.asarray(distances)
+  errors = {}
+  for depth in range(int(distances[distances != UNREACHABLE].max()) + 1):
+    candidates = np.flatnonzero(distances == depth)
+    indices = rng.choice(candidates, size=min(samples_per_depth, len(candidates)), replace=False)
+    with torch.no_grad():
+      estimates = model(encode_states(index_states(indices), device)).squeeze(1).cpu().numpy()
+    error = estimates - depth
+    errors[depth] = {'count': len(indices), 'mae': float(np.abs(error).mean()), 'bias': float(error.mean()),
+                     'max_error': float(np.abs(error).max())}
+  return errors
+
+
+if __name__ == "__main__":
+  """ Build the 2x2x2 table or measure a network against it """
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  build = subparsers.add_parser('build', help='build the table by breadth-first search')
+  build.add_argument('path', nargs='?', default='./data/pattern_database_2x2x2.npy')
+
+  error = subparsers.add_parser('error', help='measure the error of a 2x2x2 network per depth')
+  error.add_argument('network_path')
+  error.add_argument('--database', default='./data/pattern_database_2x2x2.npy')
+  error.add_argument('--samples-per-depth', type=int, default=1000)
+  error.add_argument('--seed', type=int, default=0)
+
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    start = time.perf_counter()
+    distances = build_pattern_database()
+    reachable = distances != UNREACHABLE
+    print(f"{reachable.sum():,} reachable states, maximum depth {distances[reachable].max()}, "
+          f"built in {time.perf_counter() - start:.1f}s")
+    os.makedirs(os.path.dirname(args.path) or '.', exist_ok=True)
+    save_pattern_database(args.path, distances)
+  else:
+    from astar import load_model, device
+
+    model = load_model(args.network_path, CUBE_SIZE)
+    errors = network_error_by_depth(model, load_pattern_database(args.database),
+                                    args.samples_per_depth, args.seed, device)
+    for depth, depth_errors in errors.items():
+      print(f"Depth {depth:2d}: MAE {depth_errors['mae']:.3f}, bias {depth_errors['bias']:+.3f}, "
+            f"max error {depth_errors['max_error']:.3f} over {depth_errors['count']} states")
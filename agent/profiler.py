@@ -0,0 +1,142 @@
+import collections
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+
+class _Phase:
+  """ Context manager timing one occurrence of a phase """
+  __slots__ = ('profiler', 'name', 'start')
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    end = time.perf_counter()
+    profiler = self.profiler
+    profiler.seconds[self.name] += end - self.start
+    profiler.calls[self.name] += 1
+    if profiler.events is not None:
+      profiler.events.append((self.name, self.start, end, threading.get_ident()))
+
+
+class Profiler:
+  """ Time spent per phase of a solve and counters such as socket round trips and bytes
+
+  Solvers, make_heuristic and RubiksCubeEnv take a profiler and wrap their hot paths in
+  `with profiler.phase(name)`: env_io, encoding, inference, open_list, hashing and moves (applying the move
+  tables). Phases do not nest, so their times add up, the remainder of a solve is reported as unaccounted.
+  take_record returns the totals since the previous record. With trace=True every phase occurrence is also
+  kept for write_chrome_trace.
+
+  A profiler is meant for one search at a time, concurrent searches should each have their own.
+  """
+  enabled = True
+
+  def __init__(self, trace=False):
+    self.seconds = collections.defaultdict(float)
+    self.calls = collections.Counter()
+    self.counters = collections.Counter()
+    self.events = [] if trace else None
+    # (name, start, end, thread, args) spans of the records, only kept when tracing
+    self.records = []
+    self.record_start = time.perf_counter()
+    self.origin = self.record_start
+
+  def phase(self, name):
+    return _Phase(self, name)
+
+  def count(self, name, value=1):
+    self.counters[name] += value
+
+  def take_record(self, name='solve', **fields):
+    """ Phase times, calls and counters since the previous record, together with the given fields, then
+    start the next record """
+    end = time.perf_counter()
+    seconds = end - self.record_start
+    record = dict(fields)
+    record['seconds'] = seconds
+    record['phases'] = {phase: {'seconds': self.seconds[phase], 'calls': self.calls[phase]}
+                        for phase in sorted(self.seconds)}
+    record['unaccounted_seconds'] = seconds - sum(self.seconds.values())
+    record['counters'] = dict(self.counters)
+
+    if self.events is not None:
+      self.records.append((name, self.record_start, end, threading.get_ident(), record))
+    self.reset(end)
+    return record
+
+  def reset(self, start=None):
+    """ Drop the totals collected so far and start the next record now, traced events are kept """
+    self.seconds.clear()
+    self.calls.clear()
+    self.counters.clear()
+    self.record_start = start if start is not None else time.perf_counter()
+
+  def chrome_trace(self):
+    """ The traced phases and records in the Chrome trace event format (chrome://tracing, Perfetto) """
+    if self.events is None:
+      raise ValueError("Create the profiler with trace=True to record a trace")
+    pid = os.getpid()
+
+    def event(name, category, start, end, thread):
+      return {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread,
+              'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+
+    events = [event(name, 'phase', start, end, thread) for name, start, end, thread in self.events]
+    for name, start, end, thread, record in self.records:
+      events.append(dict(event(name, 'record', start, end, thread),
+                         args={key: value for key, value in record.items() if key != 'phases'}))
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+  def write_chrome_trace(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.chrome_trace(), f)
+
+
+class NullProfiler:
+  """ Stand-in used when profiling is off, every hook is a no-op """
+  enabled = False
+
+  _phase = nullcontext()
+
+  def phase(self, name):
+    return self._phase
+
+  def count(self, name, value=1):
+    pass
+
+  def take_record(self, name='solve', **fields):
+    return None
+
+  def reset(self, start=None):
+    pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def write_records(path, records):
+  """ Write per-solve records as JSON lines """
+  with open(path, 'w') as f:
+    for record in records:
+      f.write(json.dumps(record) + '\n')
+
+
+def summarize_records(records):
+  """ Share of the total time per phase over a list of records """
+  total = sum(record['seconds'] for record in records)
+  phases = collections.defaultdict(float)
+  for record in records:
+    for phase, values in record['phases'].items():
+      phases[phase] += values['seconds']
+    phases['unaccounted'] += record['unaccounted_seconds']
+  return {phase: {'seconds': seconds, 'share': seconds / total if total > 0 else 0.0}
+          for phase, seconds in sorted(phases.items(), key=lambda item: -item[1])}
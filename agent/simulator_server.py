@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import itertools
+import json
+import socket
+import struct
+import time
+
+import numpy as np
+
+from cube_simulator import CubeSimulator, action_to_index, generate_actions, is_solved_state
+from environment import (LENGTH_PREFIX, OP_APPLY_MOVES, OP_BENCHMARK, OP_GET_STATE, OP_INITIALIZE, OP_IS_SOLVED,
+                         OP_NEIGHBOURS, OP_RESET, OP_STEP, STATUS_ERROR, STATUS_OK, parse_range)
+
+
+class SimulatorSession:
+  """ One client connection of the stand-in server, answering the commands of ServerNode.gd with a
+  CubeSimulator: the JSON text commands, and the binary protocol once the client sent "protocol:binary" """
+  def __init__(self, seed=None):
+    self.seed = seed
+    self.simulator = None
+    self.binary = False
+
+  def handle_text(self, command):
+    """ Answer a text command like ServerNode.process_command """
+    try:
+      return self._handle_text(command)
+    except (ValueError, IndexError) as error:
+      return {'error': str(error)}
+
+  def handle_binary(self, request):
+    """ Answer a binary request like ServerNode.process_binary_command, returns the status byte followed by
+    the response payload """
+    try:
+      return self._handle_binary(request)
+    except (ValueError, IndexError, struct.error) as error:
+      return self._error(str(error))
+
+  def _handle_text(self, command):
+    parts = command.split(':')
+    name = parts[0]
+    if name == 'protocol':
+      if len(parts) == 2 and parts[1] == 'binary':
+        self.binary = True
+        return {'status': 'binary'}
+      return {'error': 'Unknown protocol'}
+    if name == 'initialize':
+      params = parts[1].split(',') if len(parts) == 2 else []
+      if len(params) not in (2, 3):
+        return {'error': 'Invalid init parameters'}
+      self._initialize(int(params[0]))
+      return {'status': 'initialized'}
+    if self.simulator is None:
+      return {'error': 'Not initialized'}
+
+    if name == 'reset':
+      return self.simulator.reset(int(parts[1]) if len(parts) == 2 and parts[1] else 1)
+    if name == 'step':
+      action = parts[1].split(',') if len(parts) == 2 else []
+      if len(action) != 3:
+        return {'error': 'Invalid action format'}
+      side, layer, angle = (int(value) for value in action)
+      # The text protocol names the sides 0 (TOP) and 2 (LEFT)
+      return self.simulator.step((0 if side == 0 else 1, layer, angle))
+    if name == 'is_solved':
+      return self.simulator.is_solved(np.asarray(json.loads(parts[1]), dtype=np.uint8))
+    if name == 'get_state':
+      return self.simulator.get_state()
+    if name == 'benchmark':
+      num_steps = int(parts[1]) if len(parts) == 2 else 10000
+      seconds = self._benchmark(num_steps)
+      return {'steps': num_steps, 'seconds': seconds, 'headless': True,
+              'steps_per_second': num_steps / seconds if seconds > 0 else 0.0}
+    return {'error': 'Unknown command'}
+
+  def _handle_binary(self, request):
+    if not request:
+      return self._error("Empty request")
+    opcode = request[0]
+    if opcode == OP_INITIALIZE:
+      if len(request) not in (3, 4):
+        return self._error("Invalid init parameters")
+      self._initialize(request[1])
+      return self._ok(b'')
+    if self.simulator is None:
+      return self._error("Not initialized")
+
+    simulator = self.simulator
+    if opcode == OP_RESET:
+      if len(request) != 3:
+        return self._error("Invalid reset parameters")
+      simulator.reset(struct.unpack_from('<H', request, 1)[0])
+      return self._ok(simulator.state.tobytes())
+    if opcode == OP_STEP:
+      if len(request) != 4:
+        return self._error("Invalid action format")
+      self._apply(request[1:4])
+      return self._ok(self._state_and_done())
+    if opcode == OP_GET_STATE:
+      return self._ok(simulator.state.tobytes())
+    if opcode == OP_APPLY_MOVES:
+      if len(request) < 3 or len(request) != 3 + 3 * struct.unpack_from('<H', request, 1)[0]:
+        return self._error("Invalid move list")
+      for offset in range(3, len(request), 3):
+        self._apply(request[offset:offset + 3])
+      return self._ok(self._state_and_done())
+    if opcode == OP_NEIGHBOURS:
+      return self._ok(simulator.state[simulator.move_tables].tobytes())
+    if opcode == OP_IS_SOLVED:
+      return self._ok(bytes([int(is_solved_state(np.frombuffer(request, np.uint8, offset=1),
+                                                 simulator.cube_size))]))
+    if opcode == OP_BENCHMARK:
+      if len(request) != 5:
+        return self._error("Invalid benchmark parameters")
+      return self._ok(struct.pack('<d', self._benchmark(struct.unpack_from('<I', request, 1)[0])))
+    return self._error("Unknown command")
+
+  def _initialize(self, cube_size):
+    if cube_size < 1:
+      raise ValueError("Invalid cube size")
+    self.simulator = CubeSimulator(cube_size, self.seed)
+
+  def _apply(self, action):
+    """ Apply a (side, layer, angle) action without building the nested state lists step returns """
+    side, layer, angle = action
+    if side > 1 or layer >= self.simulator.cube_size or angle > 1:
+      raise ValueError("Invalid action")
+    simulator = self.simulator
+    simulator.state = simulator.state[simulator.move_tables[action_to_index(action, simulator.cube_size)]]
+
+  def _benchmark(self, num_steps):
+    """ Apply num_steps random moves, reading the state after each like a step does """
+    actions = generate_actions(self.simulator.cube_size)
+    action_indices = self.simulator.rng.integers(len(actions), size=num_steps)
+    start = time.perf_counter()
+    for action_index in action_indices:
+      self.simulator.step(actions[action_index])
+    return time.perf_counter() - start
+
+  def _state_and_done(self):
+    return self.simulator.state.tobytes() + bytes([int(is_solved_state(self.simulator.state,
+                                                                       self.simulator.cube_size))])
+
+  def _ok(self, payload):
+    return bytes([STATUS_OK]) + payload
+
+  def _error(self, message):
+    return bytes([STATUS_ERROR]) + message.encode()
+
+
+async def _serve_connection(reader, writer, seed):
+  """ Serve one client until it disconnects. Like the Godot server, every chunk received in text mode is
+  one command, binary requests are answered in order so clients can pipeline them. """
+  writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  session = SimulatorSession(seed)
+  buffer = b''
+  try:
+    while True:
+      data = await reader.read(65536)
+      if not data:
+        break
+      if not session.binary:
+        writer.write(json.dumps(session.handle_text(data.decode())).encode())
+      else:
+        buffer += data
+        while len(buffer) >= LENGTH_PREFIX.size:
+          length, = LENGTH_PREFIX.unpack_from(buffer)
+          if len(buffer) < LENGTH_PREFIX.size + length:
+            break
+          response = session.handle_binary(buffer[LENGTH_PREFIX.size:LENGTH_PREFIX.size + length])
+          buffer = buffer[LENGTH_PREFIX.size + length:]
+          writer.write(LENGTH_PREFIX.pack(len(response)) + response)
+      await writer.drain()
+  except ConnectionError:
+    pass
+  finally:
+    writer.close()
+
+
+async def start_servers(host, ports, seed=None):
+  """ Start one stand-in server per port, returns the asyncio servers. Unlike the Godot server a port
+  accepts any number of clients, each with its own cube. With a seed the scrambles of the i-th
+  connection to a port are seeded from (seed, port, i). """
+  servers = []
+  for port in ports:
+    connections = itertools.count()
+
+    async def serve(reader, writer, port=port, connections=connections):
+      connection_seed = [seed, port, next(connections)] if seed is not None else None
+      await _serve_connection(reader, writer, connection_seed)
+    servers.append(await asyncio.start_server(serve, host, port))
+  return servers
+
+
+async def _main(host, ports, seed):
+  servers = await start_servers(host, ports, seed)
+  print(f"Simulator servers listening on {host} ports {ports[0]}-{ports[-1]}")
+  await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+if __name__ == "__main__":
+  """ Stand-in for the Godot environment on a range of ports: python simulator_server.py --ports 4242-4249 """
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--ports', type=parse_range, default=parse_range('4242'))
+  parser.add_argument('--seed', type=int, default=None, help='seed the scrambles of every connection')
+  args = parser.parse_args()
+
+  try:
+    asyncio.run(_main(args.host, args.ports, args.seed))
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,446 @@
+import argparse
+import heapq
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+from cube_simulator import (generate_actions, get_move_tables, get_pruning_table, get_solved_keys, pack_state,
+                            pack_states, random_scrambles)
+from backward_frontier import load_backward_frontier
+from encoding import encode_states
+from profiler import NULL_PROFILER
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def batch_heuristic(states_encoded, model):
+  """ Estimate the cost to solve every state of a (batch, features) tensor with a single forward pass """
+  with torch.no_grad():
+    cost_estimates = model(states_encoded.to(device))
+  return cost_estimates.squeeze(1).tolist()
+
+
+def make_heuristic(model=None, heuristic_fn=None, heuristic_cache=None, profiler=NULL_PROFILER):
+  """ Build the heuristic_fn(states) -> list of floats the solvers use, states being a (N, stickers) uint8
+  array. Evaluates the model unless an explicit heuristic_fn is given, through heuristic_cache if any.
+  The encoding and inference phases of the model are timed by profiler. """
+  if heuristic_fn is None:
+    def heuristic_fn(states):
+      with profiler.phase('encoding'):
+        states_encoded = encode_states(states, device)
+      with profiler.phase('inference'):
+        return batch_heuristic(states_encoded, model)
+  if heuristic_cache is None:
+    return heuristic_fn
+  return lambda states: heuristic_cache.evaluate(states, heuristic_fn)
+
+
+def reconstruct_path(came_from, current_state):
+  """ Reconstruct the actions from the start state to the current state using the came_from parent pointers"""
+  total_path = []
+  while current_state in came_from:
+    current_state, action = came_from[current_state]
+    # Prepend action because we are tracing back the path
+    total_path.insert(0, action)
+  return total_path
+
+
+class Solver:
+  """ Base class of the search strategies
+
+  A solver searches from a flat sticker state with the move tables of its cube size, scoring states with
+  heuristic_fn (see make_heuristic). solve returns the actions that reach a solved state, or None once
+  max_explored_states nodes were expanded, together with a dict of search statistics:
+    solution_length, nodes_expanded, seconds, nodes_per_second,
+    peak_nodes - the most nodes held in memory at once,
+    peak_memory_bytes - peak Python allocations during the search, only measured with trace_memory as
+    tracemalloc slows the search down noticeably.
+  The profiler (see profiler.py) times the moves, hashing and open_list phases of the search.
+  With prune_moves a node is only expanded with the actions cube_simulator.get_pruning_table allows after
+  the last two moves of its path, which keeps a shortest path to every state with fewer children.
+  """
+  name = None
+
+  def __init__(self, heuristic_fn, cube_size, max_explored_states=200, trace_memory=False,
+               profiler=NULL_PROFILER, prune_moves=True):
+    self.heuristic_fn = heuristic_fn
+    self.cube_size = cube_size
+    self.max_explored_states = max_explored_states
+    self.trace_memory = trace_memory
+    self.profiler = profiler
+
+    self.move_tables = get_move_tables(cube_size)
+    self.solved_keys = get_solved_keys(cube_size)
+    self.actions = generate_actions(cube_size)
+    # Indexed by [second to last action, last action], -1 before the first move
+    self.pruning_table = get_pruning_table(cube_size)
+    if not prune_moves:
+      self.pruning_table = np.ones_like(self.pruning_table)
+
+  def solve(self, state):
+    """ Search from a (6, n, n) or flat state, returns (actions or None, stats) """
+    state = np.asarray(state, dtype=np.uint8).reshape(-1)
+    stats = {'nodes_expanded': 0, 'peak_nodes': 0, 'peak_memory_bytes': None}
+
+    if self.trace_memory:
+      tracemalloc.start()
+    start = time.perf_counter()
+    try:
+      actions = self._search(state, stats)
+    finally:
+      stats['seconds'] = time.perf_counter() - start
+      if self.trace_memory:
+        stats['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    stats['solution_length'] = len(actions) if actions is not None else None
+    stats['nodes_per_second'] = stats['nodes_expanded'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return actions, stats
+
+  def _search(self, state, stats):
+    raise NotImplementedError
+
+
+class WeightedAStarSolver(Solver):
+  """ Batch weighted A*: f = g + lambda_weight * h, expanding the batch_size nodes with the lowest f score
+  per iteration and scoring all their children with one heuristic call """
+  name = 'astar'
+
+  def __init__(self, heuristic_fn, cube_size, max_explored_states=200, lambda_weight=1, batch_size=1,
+               trace_memory=False, profiler=NULL_PROFILER, prune_moves=True):
+    super().__init__(heuristic_fn, cube_size, max_explored_states, trace_memory, profiler, prune_moves)
+    self.lambda_weight = lambda_weight
+    self.batch_size = batch_size
+
+  def _search(self, initial_state, stats):
+    profiler = self.profiler
+    initial_key = pack_state(initial_state)
+    initial_f_score = self.heuristic_fn(initial_state[np.newaxis])[0] * self.lambda_weight
+
+    # Open list is a heap of (f score, insertion order, state key), outdated entries are skipped when popped
+    open_heap = [(initial_f_score, 0, initial_key)]
+    push_count = 1
+    closed_set = set()
+
+    # Initialize the g and f scores for each state, came_from keeps (parent key, action) pointers
+    g_score = {initial_key: 0}
+    f_score = {initial_key: initial_f_score}
+    came_from = {}
+    # (second to last, last) action indices of the came_from path of every state, for the pruning table
+    move_history = {initial_key: (-1, -1)}
+    # Sticker arrays of the states waiting in the open list
+    open_states = {initial_key: initial_state}
+
+    while open_heap and stats['nodes_expanded'] < self.max_explored_states:
+      # Take up to batch_size nodes with the lowest f scores
+      batch = []
+      with profiler.phase('open_list'):
+        while open_heap and len(batch) < min(self.batch_size, self.max_explored_states - stats['nodes_expanded']):
+          _, _, current_key = heapq.heappop(open_heap)
+          if current_key not in closed_set:
+            closed_set.add(current_key)
+            batch.append(current_key)
+
+      for current_key in batch:
+        stats['nodes_expanded'] += 1
+        # Check if the current state is the goal state
+        if current_key in self.solved_keys:
+          stats['peak_nodes'] = len(g_score)
+          return reconstruct_path(came_from, current_key)
+
+      # Apply the allowed actions to every state of the batch at once
+      with profiler.phase('moves'):
+        batch_states = np.stack([open_states.pop(current_key) for current_key in batch])
+        allowed = self.pruning_table[tuple(np.array([move_history[key] for key in batch]).T)]
+        parents, action_indices = np.nonzero(allowed)
+        children_states = batch_states[parents[:, np.newaxis], self.move_tables[action_indices]]
+
+      with profiler.phase('hashing'):
+        children_keys = pack_states(children_states)
+        shortcut = self._shortcut(children_states, children_keys)
+        if shortcut is not None:
+          child, remaining_actions = shortcut
+          stats['peak_nodes'] = len(g_score)
+          parent_key, action = batch[parents[child]], self.actions[action_indices[child]]
+          return reconstruct_path(came_from, parent_key) + [action] + remaining_actions
+
+        children = []
+        for new_state, new_state_key, parent, action_index in zip(children_states, children_keys, parents,
+                                                                  action_indices):
+          new_state_key = new_state_key.tobytes()
+          if new_state_key not in closed_set:
+            children.append((new_state_key, new_state, batch[parent], int(action_index)))
+
+      if not children:
+        continue
+
+      # Score the children of the whole batch at once
+      heuristics = self.heuristic_fn(np.stack([child[1] for child in children]))
+
+      with profiler.phase('open_list'):
+        for (new_state_key, new_state, parent_key, action_index), h_score in zip(children, heuristics):
+          # A node expanded earlier in the same batch may have closed this state already
+          if new_state_key in closed_set:
+            continue
+
+          tentative_g_score = g_score[parent_key] + 1
+          tentative_f_score = tentative_g_score + h_score * self.lambda_weight
+
+          # If the new state is not in the open list or the new path has a lower f score, push it with the new scores
+          if tentative_f_score < f_score.get(new_state_key, float('inf')):
+            came_from[new_state_key] = (parent_key, self.actions[action_index])
+            move_history[new_state_key] = (move_history[parent_key][1], action_index)
+            g_score[new_state_key] = tentative_g_score
+            f_score[new_state_key] = tentative_f_score
+            open_states[new_state_key] = new_state
+            heapq.heappush(open_heap, (tentative_f_score, push_count, new_state_key))
+            push_count += 1
+
+    stats['peak_nodes'] = len(g_score)
+    return None
+
+  def _shortcut(self, children_states, children_keys):
+    """ (index of a child, actions that solve it) to end the search before the child is expanded, None to go
+    on searching """
+    return None
+
+
+class BidirectionalSolver(WeightedAStarSolver):
+  """ Meet-in-the-middle search: weighted A* forward from the scramble against a precomputed backward
+  frontier (see backward_frontier.py), the states within frontier.depth moves of solved. The search stops
+  as soon as a generated child is in the frontier and follows the frontier's moves from there, so
+  scrambles up to the frontier depth need no search at all and deeper ones only have to get that close.
+  Among the children of a batch that hit the frontier the one closest to solved is taken. frontier is a
+  BackwardFrontier or the path of a saved one. """
+  name = 'bidirectional'
+
+  def __init__(self, heuristic_fn, cube_size, frontier, max_explored_states=200, lambda_weight=1, batch_size=1,
+               trace_memory=False, profiler=NULL_PROFILER, prune_moves=True):
+    super().__init__(heuristic_fn, cube_size, max_explored_states, lambda_weight, batch_size, trace_memory,
+                     profiler, prune_moves)
+    if isinstance(frontier, str):
+      frontier = load_backward_frontier(frontier)
+    if frontier.cube_size != cube_size:
+      raise ValueError(f"The frontier is for cube size {frontier.cube_size}, not {cube_size}")
+    self.frontier = frontier
+
+  def _search(self, initial_state, stats):
+    with self.profiler.phase('hashing'):
+      in_frontier = self.frontier.lookup(pack_states(initial_state[np.newaxis]))[0] >= 0
+    if not in_frontier:
+      return super()._search(initial_state, stats)
+
+    # Counted like the expansion of the start node that finds its way through the frontier
+    stats['nodes_expanded'] = 1
+    stats['peak_nodes'] = 1
+    with self.profiler.phase('hashing'):
+      return self.frontier.solution(initial_state)
+
+  def _shortcut(self, children_states, children_keys):
+    distances = self.frontier.distances(children_keys)
+    hits = np.flatnonzero(distances >= 0)
+    if not len(hits):
+      return None
+    child = hits[np.argmin(distances[hits])]
+    return child, self.frontier.solution(children_states[child])
+
+
+class IDAStarSolver(Solver):
+  """ Iterative-deepening A*: depth-first searches bounded by f = g + lambda_weight * h, raising the bound to
+  the smallest f that exceeded it. Memory only holds the current path and its children, which are scored
+  with one heuristic call per expanded node. Sharing a HeuristicCache avoids re-evaluating the nodes every
+  iteration visits again. """
+  name = 'ida'
+
+  def __init__(self, heuristic_fn, cube_size, max_explored_states=200, lambda_weight=1, trace_memory=False,
+               profiler=NULL_PROFILER, prune_moves=True):
+    super().__init__(heuristic_fn, cube_size, max_explored_states, trace_memory, profiler, prune_moves)
+    self.lambda_weight = lambda_weight
+
+  def _search(self, initial_state, stats):
+    initial_key = pack_state(initial_state)
+    threshold = self.heuristic_fn(initial_state[np.newaxis])[0] * self.lambda_weight
+    path_keys = {initial_key}
+    path_actions = []
+
+    def depth_first(state, key, g_score, f_score, second_last_action, last_action):
+      """ Returns True when a solved state was found, the smallest f score over the bound otherwise """
+      if f_score > threshold:
+        return f_score
+      if key in self.solved_keys:
+        return True
+      if stats['nodes_expanded'] >= self.max_explored_states:
+        return float('inf')
+      stats['nodes_expanded'] += 1
+      stats['peak_nodes'] = max(stats['peak_nodes'], (len(path_actions) + 1) * len(self.actions))
+
+      with self.profiler.phase('moves'):
+        action_indices = np.flatnonzero(self.pruning_table[second_last_action, last_action])
+        children_states = state[self.move_tables[action_indices]]
+      with self.profiler.phase('hashing'):
+        children_keys = pack_states(children_states)
+      heuristics = np.asarray(self.heuristic_fn(children_states))
+
+      next_threshold = float('inf')
+      # Most promising children first
+      for i in np.argsort(heuristics, kind='stable'):
+        child_key = children_keys[i].tobytes()
+        if child_key in path_keys:
+          continue
+        path_keys.add(child_key)
+        path_actions.append(self.actions[action_indices[i]])
+        result = depth_first(children_states[i], child_key, g_score + 1,
+                             g_score + 1 + heuristics[i] * self.lambda_weight, last_action, action_indices[i])
+        if result is True:
+          return True
+        path_keys.remove(child_key)
+        path_actions.pop()
+        next_threshold = min(next_threshold, result)
+      return next_threshold
+
+    while stats['nodes_expanded'] < self.max_explored_states:
+      result = depth_first(initial_state, initial_key, 0, threshold, -1, -1)
+      if result is True:
+        return path_actions
+      if result == float('inf'):
+        break
+      threshold = result
+    return None
+
+
+class BeamSearchSolver(Solver):
+  """ Beam search: keeps the beam_width children with the lowest heuristic of every layer, scoring each
+  layer with one heuristic call. Not complete, but memory stays at beam_width states per layer. """
+  name = 'beam'
+
+  def __init__(self, heuristic_fn, cube_size, max_explored_states=200, beam_width=100, max_depth=50,
+               trace_memory=False, profiler=NULL_PROFILER, prune_moves=True):
+    super().__init__(heuristic_fn, cube_size, max_explored_states, trace_memory, profiler, prune_moves)
+    self.beam_width = beam_width
+    self.max_depth = max_depth
+
+  def _search(self, initial_state, stats):
+    num_actions = len(self.actions)
+    if pack_state(initial_state) in self.solved_keys:
+      return []
+
+    beam = initial_state[np.newaxis]
+    # Last two action indices of the path to every beam state
+    second_last_actions, last_actions = np.array([-1]), np.array([-1])
+    seen = {pack_state(initial_state)}
+    # Flat child index (parent position * num_actions + action) of every kept state, per layer
+    layers = []
+
+    for _ in range(self.max_depth):
+      if stats['nodes_expanded'] + len(beam) > self.max_explored_states:
+        break
+      stats['nodes_expanded'] += len(beam)
+
+      with self.profiler.phase('moves'):
+        # Flat child indices of the allowed actions of every beam state
+        children = np.flatnonzero(self.pruning_table[second_last_actions, last_actions])
+        parents, action_indices = np.divmod(children, num_actions)
+        children_states = beam[parents[:, np.newaxis], self.move_tables[action_indices]]
+
+      with self.profiler.phase('hashing'):
+        children_keys = [key.tobytes() for key in pack_states(children_states)]
+        candidates = []
+        solved = None
+        for i, key in enumerate(children_keys):
+          if key in self.solved_keys:
+            solved = i
+            break
+          if key not in seen:
+            # Also drops duplicates within the layer
+            seen.add(key)
+            candidates.append(i)
+      if solved is not None:
+        layers.append(children[[solved]])
+        stats['peak_nodes'] = max(stats['peak_nodes'], len(children_states) + sum(map(len, layers)))
+        return self._reconstruct(layers, num_actions)
+      if not candidates:
+        break
+
+      candidates = np.array(candidates)
+      heuristics = np.asarray(self.heuristic_fn(children_states[candidates]))
+      with self.profiler.phase('open_list'):
+        kept = candidates[np.argsort(heuristics, kind='stable')[:self.beam_width]]
+      layers.append(children[kept])
+      beam = children_states[kept]
+      second_last_actions, last_actions = last_actions[parents[kept]], action_indices[kept]
+      stats['peak_nodes'] = max(stats['peak_nodes'], len(children_states) + sum(map(len, layers)))
+    return None
+
+  def _reconstruct(self, layers, num_actions):
+    """ Follow the kept child indices back from the last entry of the last layer """
+    actions = []
+    position = 0
+    for kept in reversed(layers):
+      parent, action = divmod(int(kept[position]), num_actions)
+      actions.insert(0, self.actions[action])
+      position = parent
+    return actions
+
+
+SOLVERS = {solver.name: solver for solver in [WeightedAStarSolver, IDAStarSolver, BeamSearchSolver,
+                                               BidirectionalSolver]}
+
+
+def compare_solvers(solvers, cube_size, scramble_depths, seed=0):
+  """ Solve the same seeded scrambles with every solver, returns {name: averaged stats} """
+  states = random_scrambles(cube_size, scramble_depths, np.random.default_rng(seed))
+  results = {}
+  for solver in solvers:
+    runs = [solver.solve(state)[1] for state in states]
+    solved = [run for run in runs if run['solution_length'] is not None]
+    nodes_expanded = sum(run['nodes_expanded'] for run in runs)
+    seconds = sum(run['seconds'] for run in runs)
+    results[solver.name] = {
+      'solve_rate': len(solved) / len(runs),
+      'solution_length': float(np.mean([run['solution_length'] for run in solved])) if solved else None,
+      'nodes_expanded': nodes_expanded / len(runs),
+      'nodes_per_second': nodes_expanded / seconds if seconds > 0 else 0.0,
+      'peak_nodes': max(run['peak_nodes'] for run in runs),
+      'peak_memory_bytes': max((run['peak_memory_bytes'] or 0) for run in runs) or None,
+    }
+  return results
+
+
+if __name__ == "__main__":
+  """ Compare the solvers on seeded scrambles: python solvers.py networks/best_value_network_3x3x3.pth --cube-size 3 """
+  from astar import load_model
+  from heuristic_cache import HeuristicCache
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('network_path')
+  parser.add_argument('--cube-size', type=int, default=3)
+  parser.add_argument('--scramble-depth', type=int, default=8)
+  parser.add_argument('--num-scrambles', type=int, default=20)
+  parser.add_argument('--max-explored-states', type=int, default=10_000)
+  parser.add_argument('--batch-size', type=int, default=32, help='nodes expanded per A* iteration')
+  parser.add_argument('--beam-width', type=int, default=1000)
+  parser.add_argument('--frontier', default=None, help='backward frontier file, adds the bidirectional solver')
+  parser.add_argument('--trace-memory', action='store_true', help='measure peak memory with tracemalloc')
+  parser.add_argument('--no-move-pruning', action='store_true', help='expand every action of every node')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  model = load_model(args.network_path, args.cube_size)
+  common = {'cube_size': args.cube_size, 'max_explored_states': args.max_explored_states,
+            'trace_memory': args.trace_memory, 'prune_moves': not args.no_move_pruning}
+  solvers = [WeightedAStarSolver(make_heuristic(model), batch_size=args.batch_size, **common),
+             IDAStarSolver(make_heuristic(model, heuristic_cache=HeuristicCache()), **common),
+             BeamSearchSolver(make_heuristic(model), beam_width=args.beam_width, **common)]
+  if args.frontier is not None:
+    solvers.append(BidirectionalSolver(make_heuristic(model), frontier=args.frontier, batch_size=args.batch_size,
+                                       **common))
+
+  results = compare_solvers(solvers, args.cube_size, [args.scramble_depth] * args.num_scrambles, args.seed)
+  for name, result in results.items():
+    memory = f"{result['peak_memory_bytes'] / 2**20:.1f} MiB" if result['peak_memory_bytes'] else 'not traced'
+    length = f"{result['solution_length']:.1f}" if result['solution_length'] is not None else '-'
+    print(f"{name:13s} solve rate {result['solve_rate']:.0%}, {length} moves, "
+          f"{result['nodes_expanded']:.0f} nodes, {result['nodes_per_second']:,.0f} nodes/s, "
+          f"peak {result['peak_nodes']:,} nodes / {memory}")
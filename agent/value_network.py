@@ -2,12 +2,20 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import BatchSampler, DataLoader, Dataset, IterableDataset, RandomSampler, SequentialSampler
+from torch.utils.data import get_worker_info
+import argparse
 import json
+import math
+import os
+import time
 import numpy as np
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import random
+from encoding import encode_states, one_hot_encode
+from dataset_format import open_dataset, read_header, read_manifest
+from cube_simulator import random_scrambles
 
 # Setup TensorBoard and the device
 writer = SummaryWriter()
@@ -29,40 +37,138 @@ def load_and_split_dataset(file_path, test_ratio=0.2):
   return train_data, test_data
 
 
+def split_binary_dataset(file_path, test_ratio=0.2):
+  """ Split a binary dataset into shuffled training and test index arrays without reading the samples """
+  num_samples = read_header(file_path)['num_samples']
+  indices = np.random.permutation(num_samples)
+
+  split_index = int(num_samples * (1 - test_ratio))
+  return indices[:split_index], indices[split_index:]
+
+
 class CubeDataset(Dataset):
-  def __init__(self, data):
-    self.data = data
+  def __init__(self, data, indices=None):
+    """ data is either a list of {'state', 'cost_to_go'} samples loaded from JSON or the path of a binary
+    dataset, which is memory-mapped. indices optionally restricts the dataset to a split. """
+    if isinstance(data, str):
+      self.states, self.costs_to_go = open_dataset(data)
+    else:
+      self.states = np.array([sample['state'] for sample in data], dtype=np.uint8)
+      self.costs_to_go = np.array([sample['cost_to_go'] for sample in data], dtype=np.uint8)
+    self.indices = np.arange(len(self.states)) if indices is None else np.asarray(indices)
 
   def __len__(self):
-    return len(self.data)
+    return len(self.indices)
 
   def __getitem__(self, idx):
-    state = self.data[idx]['state']
-    cost_to_go = self.data[idx]['cost_to_go']
-    # Flatten and one-hot encode the state
-    state_oh = self.one_hot_encode(state)
-    return state_oh, torch.tensor([cost_to_go], dtype=torch.float)
-
-  def one_hot_encode(self, state):
-    # Initialize a list to hold the one-hot encoded state
-    state_oh = []
-
-    # Iterate over each face's colors
-    for face in state:
-      for pair in face:
-        for color in pair:
-          # Create a one-hot encoded vector for this color
-          color_oh = [0] * 6
-          color_oh[color] = 1
-          state_oh.extend(color_oh)
-
-    return torch.tensor(state_oh, dtype=torch.float)
+    """ Get a single sample, or a whole batch when idx is a list of indices (see make_batch_loader) """
+    rows = self.indices[idx]
+    if np.ndim(rows) == 0:
+      # Flatten and one-hot encode the state
+      state_oh = one_hot_encode(self.states[rows])
+      return state_oh, torch.tensor([self.costs_to_go[rows]], dtype=torch.float)
+
+    # Sorted rows keep reads from the memory map sequential, the order inside a batch does not matter
+    rows = np.sort(rows)
+    states_oh = encode_states(self.states[rows])
+    costs_to_go = torch.from_numpy(self.costs_to_go[rows].astype(np.float32)).unsqueeze(1)
+    return states_oh, costs_to_go
 
   def get_random_samples(self, num_samples=10):
-    indices = random.sample(range(len(self.data)), num_samples)
+    indices = random.sample(range(len(self)), num_samples)
     return [self[idx] for idx in indices]
 
 
+def make_batch_loader(dataset, batch_size, shuffle):
+  """ DataLoader that fetches each batch with a single fancy index into the dataset arrays """
+  sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+  return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
+
+
+def split_shards(directory, test_ratio=0.2):
+  """ Split the shards of a sharded dataset directory into training and test shards
+
+  Whole shards go to either side, so the test share is test_ratio rounded to whole shards: of ten shards any
+  ratio below 0.15 holds out one, 10% of the samples. A dataset of a single shard is split by sample instead, its shards are then
+  (path, indices) pairs, which ShardedCubeDataset accepts like paths.
+  """
+  shards = [os.path.join(directory, shard['file']) for shard in read_manifest(directory)['shards']]
+  random.shuffle(shards)
+  if len(shards) == 1 and test_ratio > 0:
+    train_indices, test_indices = split_binary_dataset(shards[0], test_ratio)
+    return [(shards[0], train_indices)], [(shards[0], test_indices)]
+
+  # Keep at least one shard on each side whenever there is more than one
+  num_test = min(max(round(len(shards) * test_ratio), int(test_ratio > 0)), len(shards) - 1)
+  return shards[num_test:], shards[:num_test]
+
+
+class ShardedCubeDataset(IterableDataset):
+  """ Streams encoded batches from the shards of a sharded dataset, memory-mapping one shard at a time.
+  Use it with DataLoader(dataset, batch_size=None), each DataLoader worker reads its own subset of shards.
+  A shard is a path, or a (path, indices) pair restricting it to some of its samples (see split_shards). """
+  def __init__(self, shards, batch_size, shuffle=True):
+    self.shards = [(shard, None) if isinstance(shard, str) else shard for shard in shards]
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.num_batches = sum(math.ceil((read_header(path)['num_samples'] if indices is None else len(indices))
+                                     / batch_size)
+                           for path, indices in self.shards)
+
+  def __len__(self):
+    return self.num_batches
+
+  def __iter__(self):
+    shards = self.shards
+    worker_info = get_worker_info()
+    if worker_info is not None:
+      shards = shards[worker_info.id::worker_info.num_workers]
+    if self.shuffle:
+      shards = random.sample(shards, len(shards))
+
+    for shard_path, indices in shards:
+      shard = CubeDataset(shard_path, indices)
+      order = np.random.permutation(len(shard)) if self.shuffle else np.arange(len(shard))
+      for start in range(0, len(order), self.batch_size):
+        yield shard[order[start:start + self.batch_size]]
+
+
+class ScrambleDataset(IterableDataset):
+  """ Generates encoded batches of freshly scrambled cubes labelled with their scramble depth, no stored dataset.
+  Use it with DataLoader(dataset, batch_size=None). Each DataLoader worker draws from its own RNG, seeded
+  from (seed, worker id) or from fresh entropy when seed is None. num_batches sets the length of an epoch,
+  None streams forever. """
+  def __init__(self, cube_size, batch_size, min_scramble_moves, max_scramble_moves, num_batches=None, seed=None):
+    self.cube_size = cube_size
+    self.batch_size = batch_size
+    self.min_scramble_moves = min_scramble_moves
+    self.max_scramble_moves = max_scramble_moves
+    self.num_batches = num_batches
+    self.seed = seed
+
+  def __len__(self):
+    if self.num_batches is None:
+      raise TypeError("an endless ScrambleDataset has no length")
+    return self.num_batches
+
+  def __iter__(self):
+    worker_info = get_worker_info()
+    worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+    rng = np.random.default_rng(None if self.seed is None else [self.seed, worker_id])
+
+    num_batches = None
+    if self.num_batches is not None:
+      # Share the epoch between the workers
+      num_batches = self.num_batches // num_workers + int(worker_id < self.num_batches % num_workers)
+
+    generated = 0
+    while num_batches is None or generated < num_batches:
+      depths = rng.integers(self.min_scramble_moves, self.max_scramble_moves + 1, size=self.batch_size)
+      states = random_scrambles(self.cube_size, depths, rng)
+      yield encode_states(states), torch.from_numpy(depths.astype(np.float32)).unsqueeze(1)
+      generated += 1
+
+
 class ResidualBlock(nn.Module):
   def __init__(self):
     super(ResidualBlock, self).__init__()
@@ -104,25 +210,50 @@ class ValueNetwork(nn.Module):
     return x
 
 
-def train_model(model, train_loader, test_loader, optimizer, criterion, epochs=10, cube_size='2x2x2'):
-  """ Train the model using the training set and evaluate it using the test set"""
+def train_model(model, train_loader, test_loader, optimizer, criterion, epochs=10, cube_size='2x2x2',
+                amp=False, compile_model=False, accumulation_steps=1):
+  """ Train the model using the training set and evaluate it using the test set
+  amp runs forward passes under bf16 autocast, compile_model runs a torch.compile'd model and
+  accumulation_steps sums gradients over that many batches before each optimizer step."""
   model.to(device)  # Move model to the appropriate device
+  train_step_model = torch.compile(model) if compile_model else model
   best_loss = float('inf')
+  global_step = 0
   for epoch in tqdm(range(epochs)):
     model.train()
-    total_loss = 0
+    # Losses are summed on the device so the loop never waits for the GPU
+    total_loss = torch.zeros((), device=device)
+    epoch_start = time.perf_counter()
+    optimizer_steps = 0
+    num_batches = 0
+    optimizer.zero_grad()
     for batch_idx, (data, target) in enumerate(train_loader):
-      data, target = data.to(device), target.to(device)  # Move data to device
-      optimizer.zero_grad()
-      output = model(data)
-      loss = criterion(output, target)
-      loss.backward()
+      # Move data to device
+      data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+      with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=amp):
+        output = train_step_model(data)
+      loss = criterion(output.float(), target)
+      (loss / accumulation_steps).backward()
+      if (batch_idx + 1) % accumulation_steps == 0:
+        optimizer.step()
+        optimizer.zero_grad()
+        optimizer_steps += 1
+      total_loss += loss.detach()
+      num_batches += 1
+    if num_batches % accumulation_steps != 0:
+      # Apply the gradients left over from an incomplete accumulation
       optimizer.step()
-      total_loss += loss.item()
+      optimizer.zero_grad()
+      optimizer_steps += 1
+    global_step += optimizer_steps
+
+    elapsed = time.perf_counter() - epoch_start
     writer.add_scalar('Training Loss', loss.item(),
                       epoch)
-    average_loss = total_loss / len(train_loader)
-    print(f'Epoch {epoch}, Average Training Loss: {average_loss:.4f}')
+    writer.add_scalar('Steps per Second', optimizer_steps / elapsed, global_step)
+    writer.add_scalar('Batches per Second', num_batches / elapsed, global_step)
+    average_loss = total_loss.item() / num_batches
+    print(f'Epoch {epoch}, Average Training Loss: {average_loss:.4f}, {optimizer_steps / elapsed:.2f} steps/s')
     if average_loss < best_loss:
       best_loss = average_loss
       torch.save(model.state_dict(),
@@ -143,6 +274,9 @@ def compute_accuracy(output, target, threshold=0.5):
 
 def test_model(model, test_loader, criterion):
   """ Evaluate the model using the test set"""
+  if len(test_loader) == 0:
+    print("Test set is empty, skipping evaluation")
+    return float('nan')
   model.eval()
   total_loss = 0
   total_accuracy = 0
@@ -163,38 +297,62 @@ def test_model(model, test_loader, criterion):
 
 
 if __name__ == "__main__":
-  cube_size = '2x2x2'
-  # cube_size = '3x3x3'
-  # cube_size = '4x4x4'
-  dataset_path = f'data/rubiks_cube_data_{cube_size}.json'
-  # dataset_path = f'/kaggle/input/rubiks-cube-data/rubiks_cube_data_{cube_size}.json'
-  train_data, test_data = load_and_split_dataset(dataset_path, test_ratio=0.01)
-
-  train_dataset = CubeDataset(train_data)
-  train_loader = DataLoader(train_dataset, batch_size=10_000, shuffle=True)
-
-  test_dataset = CubeDataset(test_data)
-  test_loader = DataLoader(test_dataset, batch_size=1000, shuffle=False)
-
-  # If training from a checkpoint
-  # network_path = f'networks/best_value_network_{cube_size}.pth'
-  # network_path = f'/kaggle/input/rubiks-cube-data/best_value_network_{cube_size}.pth'
-
-  # model = ValueNetwork(144).to(device) # For 2x2x2 cube
-  # model = ValueNetwork(324).to(device) # For 3x3x3 cube
-  # model = ValueNetwork(576).to(device)  # For 4x4x4 cube
-  # model.load_state_dict(torch.load(network_path, map_location=device))
-
-  # If training from scratch
-  model = ValueNetwork(144).to(device)  # For 2x2x2 cube
-  # model = ValueNetwork(324).to(device)  # For 3x3x3 cube
-  # model = ValueNetwork(576).to(device)  # For 4x4x4 cube
-
-  optimizer = optim.Adam(model.parameters(), lr=1e-3)
+  parser = argparse.ArgumentParser(description='Train the value network')
+  parser.add_argument('--cube-size', type=int, default=2, choices=[2, 3, 4])
+  parser.add_argument('--dataset-dir', default=None,
+                      help='sharded dataset directory (default: data/rubiks_cube_data_NxNxN)')
+  parser.add_argument('--on-the-fly', action='store_true',
+                      help='train on scrambles generated on the fly instead of a stored dataset')
+  parser.add_argument('--max-scramble-moves', type=int, default=None,
+                      help='deepest on-the-fly scramble (default: 12 for 2x2x2, 15 otherwise)')
+  parser.add_argument('--batches-per-epoch', type=int, default=100, help='on-the-fly batches per epoch')
+  parser.add_argument('--test-ratio', type=float, default=0.01)
+  parser.add_argument('--checkpoint', default=None, help='state dict to resume training from')
+  parser.add_argument('--epochs', type=int, default=2)
+  parser.add_argument('--batch-size', type=int, default=10_000)
+  parser.add_argument('--lr', type=float, default=1e-3)
+  parser.add_argument('--amp', action='store_true', help='bf16 autocast for forward passes')
+  parser.add_argument('--compile', action='store_true', help='torch.compile the model')
+  parser.add_argument('--accumulation-steps', type=int, default=1, help='batches per optimizer step')
+  parser.add_argument('--num-workers', type=int, default=0, help='DataLoader worker processes')
+  parser.add_argument('--pin-memory', action='store_true', help='pin batches for faster host to GPU copies')
+  parser.add_argument('--prefetch-factor', type=int, default=None, help='batches prefetched per worker')
+  args = parser.parse_args()
+
+  cube_size = f'{args.cube_size}x{args.cube_size}x{args.cube_size}'
+  dataset_dir = args.dataset_dir or f'data/rubiks_cube_data_{cube_size}'
+  # dataset_dir = f'/kaggle/input/rubiks-cube-data/rubiks_cube_data_{cube_size}'
+  loader_options = {'batch_size': None, 'num_workers': args.num_workers, 'pin_memory': args.pin_memory,
+                    'persistent_workers': args.num_workers > 0}
+  if args.num_workers > 0 and args.prefetch_factor is not None:
+    loader_options['prefetch_factor'] = args.prefetch_factor
+
+  if args.on_the_fly:
+    max_scramble_moves = args.max_scramble_moves or (12 if args.cube_size == 2 else 15)
+    train_dataset = ScrambleDataset(args.cube_size, args.batch_size, 0, max_scramble_moves,
+                                    num_batches=args.batches_per_epoch)
+    test_dataset = ScrambleDataset(args.cube_size, 1000, 0, max_scramble_moves, num_batches=10, seed=0)
+  else:
+    # Single-file datasets (see dataset_format.py) can be used with CubeDataset and make_batch_loader instead
+    train_shards, test_shards = split_shards(dataset_dir, test_ratio=args.test_ratio)
+    train_dataset = ShardedCubeDataset(train_shards, batch_size=args.batch_size, shuffle=True)
+    test_dataset = ShardedCubeDataset(test_shards, batch_size=1000, shuffle=False)
+
+  train_loader = DataLoader(train_dataset, **loader_options)
+  test_loader = DataLoader(test_dataset, batch_size=None)
+
+  # 144 for 2x2x2, 324 for 3x3x3, 576 for 4x4x4
+  model = ValueNetwork(6 * 6 * args.cube_size * args.cube_size).to(device)
+  if args.checkpoint:
+    # network_path = f'/kaggle/input/rubiks-cube-data/best_value_network_{cube_size}.pth'
+    model.load_state_dict(torch.load(args.checkpoint, map_location=device))
+
+  optimizer = optim.Adam(model.parameters(), lr=args.lr)
   criterion = nn.MSELoss()
 
   train_model(model, train_loader, test_loader,
-              optimizer, criterion, epochs=2, cube_size=cube_size)
+              optimizer, criterion, epochs=args.epochs, cube_size=cube_size,
+              amp=args.amp, compile_model=args.compile, accumulation_steps=args.accumulation_steps)
 
   torch.save(model.state_dict(), f'networks/value_network_{cube_size}.pth')
   writer.close()
@@ -26,9 +26,18 @@ var cube_state = [] # colors on each side
 
 var prev_positions # previous face positions
 var current_positions # current face positions
+var solved_positions # face positions in the solved state
 
 var is_rotating = false
 
+# Headless mode keeps only a flat sticker array (get_cube_state order) updated through precomputed move
+# permutation tables and leaves the scene nodes alone, they are rebuilt when rendering is enabled again
+var headless = false
+var sticker_state := PackedByteArray()
+var move_tables = [] # PackedInt32Array per (side 0 TOP / 1 LEFT, layer, angle 0 +90 / 1 -90) action
+var move_tables_size = 0
+var move_history = [] # moves applied headless since the last reset, replayed onto the nodes
+
 var rng = RandomNumberGenerator.new()
 
 func _ready():
@@ -75,6 +84,23 @@ func set_animation(enabled):
 	""" Enable or disable animation """
 	animate = enabled
 
+func set_headless(enabled):
+	""" Enable or disable headless mode, leaving it synchronizes the scene nodes with the sticker state """
+	if headless and not enabled:
+		headless = false
+		sync_nodes()
+	headless = enabled
+
+func sync_nodes():
+	""" Rebuild the pieces and replay the moves applied since the last reset without animation """
+	var moves = move_history.duplicate()
+	var animate_before = animate
+	animate = false
+	reset_cube(false)
+	for move in moves:
+		rotate_side(move[0], move[1], move[2])
+	animate = animate_before
+
 func create_cube():
 	""" Create cube """
 	# Prepare an array for storing cube's state
@@ -114,21 +140,28 @@ func create_cube():
 	var ret = get_initial_faces_and_positions()
 	cube_faces = ret[0]
 	current_positions = ret[1]
+	solved_positions = ret[1]
 
 func reset_cube(scramble, random_moves=1):
 	""" Reset cube to the solved state """
 	#print("Reseting environment...")
-	# Perform cleanup
-	for child in get_children():
-		# Check if the child is an instance of CSGBox3D
-		if child is CSGBox3D:
-			child.queue_free()  # Remove only CSGBox3D nodes
-			
-	cube_pieces = Array()
-	cube_faces # face objects
-	cube_state = [] # colors on each side
-	
-	create_cube()
+	if move_tables_size != cube_size:
+		build_move_tables()
+	sticker_state = solved_sticker_state()
+	move_history = []
+
+	if not headless:
+		# Perform cleanup
+		for child in get_children():
+			# Check if the child is an instance of CSGBox3D
+			if child is CSGBox3D:
+				child.queue_free()  # Remove only CSGBox3D nodes
+				
+		cube_pieces = Array()
+		cube_faces # face objects
+		cube_state = [] # colors on each side
+		
+		create_cube()
 	if scramble:
 		#print("Scrambling the cube...")
 		scramble_cube(random_moves)
@@ -171,10 +204,32 @@ func scramble_cube(random_moves=3):
 
 func get_cube_state() -> Array:
 	""" Get cube state """
+	if headless:
+		var state = []
+		for side in range(6):
+			var rows = []
+			for row in range(cube_size):
+				var start = (side * cube_size + row) * cube_size
+				rows.append(Array(sticker_state.slice(start, start + cube_size)))
+			state.append(rows)
+		return state
 	return cube_state
 
+func get_cube_state_bytes() -> PackedByteArray:
+	""" Get cube state as one byte per sticker, flattened in get_cube_state order """
+	if headless:
+		return sticker_state.duplicate()
+	var state = PackedByteArray()
+	for side in cube_state:
+		for row in side:
+			for face in row:
+				state.append(face)
+	return state
+
 func is_solved():
 	""" Check if the cube is solved """
+	if headless:
+		return is_solved_bytes(sticker_state)
 	for side in cube_state:
 		var first_face = side[0][0]
 		for row in side:
@@ -197,6 +252,16 @@ func is_solved_state(state_string):
 					return false
 	return true
 	
+func is_solved_bytes(state: PackedByteArray):
+	""" Check if a state given as get_cube_state_bytes is a solved state """
+	var stickers_per_side = state.size() / 6
+	for side in range(6):
+		var first_face = state[side * stickers_per_side]
+		for i in range(side * stickers_per_side, (side + 1) * stickers_per_side):
+			if state[i] != first_face:
+				return false
+	return true
+	
 func get_initial_faces_and_positions():
 	""" Get initial state of cube's faces with their positions """
 	var all_faces = []
@@ -271,8 +336,130 @@ func print_faces(faces):
 		print(row)
 	
 
+func solved_sticker_state() -> PackedByteArray:
+	""" Flat solved state, every sticker colored with its side """
+	var state = PackedByteArray()
+	for side in range(6):
+		for i in range(cube_size * cube_size):
+			state.append(side)
+	return state
+
+func sticker_positions() -> Array:
+	""" Position of every sticker in get_cube_state order, in doubled integer coordinates
+
+	Mirrors get_initial_faces_and_positions: TOP/BOTTOM rows are indexed by x and columns by z,
+	LEFT/RIGHT rows by y and columns by z, FRONT/BACK rows by y and columns by x. Pieces sit at
+	2 * index - (cube_size - 1) and stickers one unit further along the face normal.
+	"""
+	var far = cube_size
+	var positions = []
+	for side in range(6):
+		for row in range(cube_size):
+			for col in range(cube_size):
+				var r = 2 * row - (cube_size - 1)
+				var c = 2 * col - (cube_size - 1)
+				match side:
+					CubeSide.TOP:
+						positions.append(Vector3i(r, far, c))
+					CubeSide.BOTTOM:
+						positions.append(Vector3i(r, -far, c))
+					CubeSide.LEFT:
+						positions.append(Vector3i(-far, r, c))
+					CubeSide.RIGHT:
+						positions.append(Vector3i(far, r, c))
+					CubeSide.FRONT:
+						positions.append(Vector3i(c, r, -far))
+					CubeSide.BACK:
+						positions.append(Vector3i(c, r, far))
+	return positions
+
+func rotate_position(position: Vector3i, axis_side: int, angle: int) -> Vector3i:
+	""" Rotate a doubled position the way rotate_pieces does (angle 0 is +90 degrees, 1 is -90 degrees) """
+	if axis_side == 0:  # Y axis (TOP)
+		return Vector3i(position.z, position.y, -position.x) if angle == 0 else Vector3i(-position.z, position.y, position.x)
+	# X axis (LEFT)
+	return Vector3i(position.x, -position.z, position.y) if angle == 0 else Vector3i(position.x, position.z, -position.y)
+
+func build_move_tables():
+	""" Precompute a sticker permutation per action, the new state is state[table[i]] for every sticker i """
+	var normals = [Vector3i(0, 1, 0), Vector3i(0, -1, 0), Vector3i(-1, 0, 0),
+				   Vector3i(1, 0, 0), Vector3i(0, 0, -1), Vector3i(0, 0, 1)]
+	var positions = sticker_positions()
+	var index_of = {}
+	for i in range(positions.size()):
+		index_of[positions[i]] = i
+
+	move_tables = []
+	for axis_side in [0, 1]:
+		for layer in range(cube_size):
+			for angle in [0, 1]:
+				var table = PackedInt32Array()
+				table.resize(positions.size())
+				for i in range(positions.size()):
+					table[i] = i
+				for i in range(positions.size()):
+					var center = positions[i] - normals[i / (cube_size * cube_size)]
+					var moving
+					if axis_side == 0:
+						# TOP layer 0 is the top-most slice
+						moving = center.y == (cube_size - 1) - 2 * layer
+					else:
+						# LEFT layer 0 is the left-most slice
+						moving = center.x == 2 * layer - (cube_size - 1)
+					if moving:
+						table[index_of[rotate_position(positions[i], axis_side, angle)]] = i
+				move_tables.append(table)
+	move_tables_size = cube_size
+
+func apply_move_to_stickers(side, layer, angle):
+	""" Apply a rotate_side move to the sticker array through the move tables """
+	if move_tables_size != cube_size:
+		# Not reset since the cube size changed, the nodes are the only model
+		return
+	var axis_side
+	var axis_layer
+	match side:
+		CubeSide.TOP:
+			axis_side = 0
+			axis_layer = layer
+		CubeSide.BOTTOM:
+			axis_side = 0
+			axis_layer = cube_size - 1 - layer
+		CubeSide.LEFT:
+			axis_side = 1
+			axis_layer = layer
+		CubeSide.RIGHT:
+			axis_side = 1
+			axis_layer = cube_size - 1 - layer
+	var table = move_tables[(axis_side * cube_size + axis_layer) * 2 + (0 if angle == 90 else 1)]
+	var new_state = PackedByteArray()
+	new_state.resize(sticker_state.size())
+	for i in range(table.size()):
+		new_state[i] = sticker_state[table[i]]
+	sticker_state = new_state
+
+func benchmark(num_steps):
+	""" Apply num_steps random moves, reading the state after each like a server step, and return the
+	elapsed seconds. Leaves the cube scrambled. """
+	var animate_before = animate
+	animate = false
+	var start = Time.get_ticks_usec()
+	for i in range(num_steps):
+		var side = CubeSide.TOP if rng.randi_range(0, 1) == 0 else CubeSide.LEFT
+		rotate_side(side, rng.randi_range(0, cube_size - 1), 90 if rng.randi_range(0, 1) == 0 else -90)
+		get_cube_state_bytes()
+		is_solved()
+	var elapsed = (Time.get_ticks_usec() - start) / 1e6
+	animate = animate_before
+	return elapsed
+
 func rotate_side(side, layer, angle):
 	""" Rotate given side and layer by angle """
+	apply_move_to_stickers(side, layer, angle)
+	if headless:
+		move_history.append([side, layer, angle])
+		return
+
 	is_rotating = true
 	if active_rotation_pieces:
 			disband_rotation_pieces(active_rotation_pieces)
@@ -469,19 +656,13 @@ func disband_rotation_pieces(rotation_pieces: Node3D):
 
 func update_cube_state(): 
 	""" Update cube_state array with new pieces positions """
-	var temp_cube_state = cube_state.duplicate(true)
-	var temp_cube_faces = cube_faces.duplicate(true)
+	# Each tracked face keeps the color of the side it started on, so a slot takes the color
+	# of the tracked face that now sits at the slot's solved position
 	for side in range(6):
 		for row in range(cube_size):
 			for col in range(cube_size):
-				var pos = prev_positions[side][row][col]
-				# Check if there was a change in position
-				if pos != current_positions[side][row][col]:
-					var res = find_face_pos(pos)
-					var new_side = res[0]
-					var new_row = res[1]
-					var new_col = res[2]
-					cube_state[side][row][col] = temp_cube_state[new_side][new_row][new_col]
+				var res = find_face_pos(solved_positions[side][row][col])
+				cube_state[side][row][col] = res[0]
 				
 func find_face_pos(pos):
 	""" Find position of a face """
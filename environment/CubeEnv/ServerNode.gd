@@ -7,6 +7,16 @@ var connected = false
 
 var cube_instance
 
+# Binary protocol, switched to per connection by the "protocol:binary" text command.
+# Every message is a little-endian u32 payload length followed by the payload. Requests start with an
+# opcode byte, responses with a status byte, states are 6 * n * n sticker bytes in get_cube_state order.
+enum Opcode { INITIALIZE = 1, RESET, STEP, GET_STATE, APPLY_MOVES, NEIGHBOURS, IS_SOLVED, BENCHMARK }
+enum Status { OK = 0, ERROR = 1 }
+const LENGTH_PREFIX_SIZE = 4
+
+var binary_mode = false
+var receive_buffer := PackedByteArray()
+
 func _ready():
 	pass
 	#server.listen(4242)
@@ -28,17 +38,23 @@ func _process(delta):
 	if server.is_connection_available():
 		peer = server.take_connection()
 		connected = true
+		binary_mode = false
+		receive_buffer = PackedByteArray()
 		print("Client connected")
 
 	if connected:
 		peer.poll()  # Update the state of the connection
 		if peer.get_status() == StreamPeerTCP.STATUS_CONNECTED:
 			if peer.get_available_bytes() > 0:
-				var message = peer.get_utf8_string(peer.get_available_bytes())
-				#print("Received from client: " + message):w
-				# Process the message and respond
-				var response = process_command(message)
-				peer.put_data(response.to_utf8_buffer())
+				if binary_mode:
+					receive_buffer.append_array(peer.get_data(peer.get_available_bytes())[1])
+					process_frames()
+				else:
+					var message = peer.get_utf8_string(peer.get_available_bytes())
+					#print("Received from client: " + message):w
+					# Process the message and respond
+					var response = process_command(message)
+					peer.put_data(response.to_utf8_buffer())
 		elif peer.get_status() == StreamPeerTCP.STATUS_ERROR or peer.get_status() == StreamPeerTCP.STATUS_NONE:
 			print("Client disconnected. Closing application.")
 			connected = false
@@ -50,13 +66,16 @@ func process_command(command: String) -> String:
 	var json = JSON.new()
 	match parts[0]:
 		"initialize":
+			# size,animation[,headless]
 			var init_params = parts[1].split(",")
-			if init_params.size() == 2:
+			if init_params.size() == 2 or init_params.size() == 3:
 				var cube_size = int(init_params[0])
 				var animation_enabled = (init_params[1] == "1")
 				cube_instance.set_cube_size(cube_size)
 				cube_instance.set_animation(animation_enabled)
 				cube_instance.reset_cube(false)
+				# After the reset, so leaving headless mode rebuilds the pieces once at the new size
+				cube_instance.set_headless(init_params.size() == 3 and init_params[2] == "1")
 				return JSON.stringify({"status": "initialized"})
 			else:
 				return JSON.stringify({'error': 'Invalid init parameters'})
@@ -91,9 +110,121 @@ func process_command(command: String) -> String:
 		"get_state":
 			var state = cube_instance.get_cube_state()
 			return JSON.stringify(state)
+		"protocol":
+			if parts.size() == 2 and parts[1] == "binary":
+				binary_mode = true
+				return JSON.stringify({"status": "binary"})
+			return JSON.stringify({'error': 'Unknown protocol'})
+		"benchmark":
+			var num_steps = int(parts[1]) if parts.size() == 2 else 10000
+			var seconds = cube_instance.benchmark(num_steps)
+			return JSON.stringify({"steps": num_steps, "seconds": seconds, "headless": cube_instance.headless,
+								   "steps_per_second": num_steps / seconds if seconds > 0 else 0.0})
 		_:
 			return JSON.stringify({'error': 'Unknown command'})
 
+func process_frames():
+	""" Answer every complete request in the receive buffer, in order, so clients can pipeline requests """
+	while receive_buffer.size() >= LENGTH_PREFIX_SIZE:
+		var length = receive_buffer.decode_u32(0)
+		if receive_buffer.size() < LENGTH_PREFIX_SIZE + length:
+			return
+		var request = receive_buffer.slice(LENGTH_PREFIX_SIZE, LENGTH_PREFIX_SIZE + length)
+		receive_buffer = receive_buffer.slice(LENGTH_PREFIX_SIZE + length)
+
+		var response = process_binary_command(request)
+		var frame = PackedByteArray()
+		frame.resize(LENGTH_PREFIX_SIZE)
+		frame.encode_u32(0, response.size())
+		frame.append_array(response)
+		peer.put_data(frame)
+
+func process_binary_command(request: PackedByteArray) -> PackedByteArray:
+	""" Process a binary request, returns the status byte followed by the response payload """
+	if request.size() == 0:
+		return binary_error("Empty request")
+	match request[0]:
+		Opcode.INITIALIZE:
+			# size, animation[, headless]
+			if request.size() != 3 and request.size() != 4:
+				return binary_error("Invalid init parameters")
+			cube_instance.set_cube_size(request[1])
+			cube_instance.set_animation(request[2] == 1)
+			cube_instance.reset_cube(false)
+			cube_instance.set_headless(request.size() == 4 and request[3] == 1)
+			return binary_ok(PackedByteArray())
+		Opcode.RESET:
+			if request.size() != 3:
+				return binary_error("Invalid reset parameters")
+			cube_instance.reset_cube(true, request.decode_u16(1))
+			return binary_ok(cube_instance.get_cube_state_bytes())
+		Opcode.STEP:
+			if request.size() != 4:
+				return binary_error("Invalid action format")
+			apply_binary_action(request, 1)
+			return binary_ok(state_and_done())
+		Opcode.GET_STATE:
+			return binary_ok(cube_instance.get_cube_state_bytes())
+		Opcode.APPLY_MOVES:
+			# u16 move count followed by (side, layer, angle) bytes, answered with the final state only
+			if request.size() < 3 or request.size() != 3 + 3 * request.decode_u16(1):
+				return binary_error("Invalid move list")
+			var animate = cube_instance.animate
+			cube_instance.set_animation(false)
+			for offset in range(3, request.size(), 3):
+				apply_binary_action(request, offset)
+			cube_instance.set_animation(animate)
+			return binary_ok(state_and_done())
+		Opcode.NEIGHBOURS:
+			# State after every action in generate_actions order, the cube itself is left unchanged
+			var animate = cube_instance.animate
+			cube_instance.set_animation(false)
+			var neighbours = PackedByteArray()
+			for side in [0, 1]:
+				for layer in range(cube_instance.cube_size):
+					for angle in [0, 1]:
+						rotate_action(side, layer, angle)
+						neighbours.append_array(cube_instance.get_cube_state_bytes())
+						rotate_action(side, layer, 1 - angle)
+			cube_instance.set_animation(animate)
+			return binary_ok(neighbours)
+		Opcode.IS_SOLVED:
+			return binary_ok(PackedByteArray([int(cube_instance.is_solved_bytes(request.slice(1)))]))
+		Opcode.BENCHMARK:
+			# u32 step count, answered with the elapsed seconds as a double
+			if request.size() != 5:
+				return binary_error("Invalid benchmark parameters")
+			var seconds = PackedByteArray()
+			seconds.resize(8)
+			seconds.encode_double(0, cube_instance.benchmark(request.decode_u32(1)))
+			return binary_ok(seconds)
+		_:
+			return binary_error("Unknown command")
+
+func apply_binary_action(request: PackedByteArray, offset: int):
+	""" Apply the (side, layer, angle) action stored at offset """
+	rotate_action(request[offset], request[offset + 1], request[offset + 2])
+
+func rotate_action(side: int, layer: int, angle: int):
+	""" Apply an action given as the agent's side 0/1 and angle 0 (90 degrees) / 1 (-90 degrees) """
+	cube_instance.rotate_side(0 if side == 0 else 2, layer, 90 if angle == 0 else -90)
+
+func state_and_done() -> PackedByteArray:
+	""" Current state followed by the solved flag """
+	var payload = cube_instance.get_cube_state_bytes()
+	payload.append(int(cube_instance.is_solved()))
+	return payload
+
+func binary_ok(payload: PackedByteArray) -> PackedByteArray:
+	var response = PackedByteArray([Status.OK])
+	response.append_array(payload)
+	return response
+
+func binary_error(message: String) -> PackedByteArray:
+	var response = PackedByteArray([Status.ERROR])
+	response.append_array(message.to_utf8_buffer())
+	return response
+
 func _notification(what):
 	""" Send notification that server is closing the connection """
 	if what == NOTIFICATION_PREDELETE: